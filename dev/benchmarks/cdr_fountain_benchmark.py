@@ -0,0 +1,118 @@
+"""
+Benchmarks the tower region lookup and the in_florence flag of cdr_fountain
+on synthetic dwell time records.
+
+The vectorized versions are timed at increasing sizes (up to 10M records by
+default). The row-wise apply versions they replace scan every tower for every
+record, so they are only timed on the smaller sizes, where both versions are
+also checked to give identical output.
+
+Run from the repository root:
+    python dev/benchmarks/cdr_fountain_benchmark.py --rows 100000 1000000
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from src.output import cdr_fountain
+
+
+def make_dwell_times(rows, towers=1000, records_per_customer=15, seed=0):
+    """
+    Makes synthetic records with the same columns as the dwell time table read
+    by cdr_fountain.get_dwell_time_df, ordered by customer.
+    """
+    random = np.random.RandomState(seed)
+
+    cust_id = np.arange(rows, dtype=np.int64) // records_per_customer
+    tower_id = random.randint(0, towers, rows).astype(np.int64)
+    in_florence_comune = tower_id < towers // 2
+    near_airport = (tower_id % 50) == 0
+
+    users = pd.DataFrame({
+        'cust_id': cust_id,
+        'prev_cust_id': np.roll(cust_id, 1),
+        'tower_id': tower_id,
+        'prev_tower_id': np.roll(tower_id, 1),
+        'dwell_time': pd.to_timedelta(random.randint(1, 240, rows), unit='m'),
+        'near_airport': near_airport,
+        'in_florence_comune': in_florence_comune
+    }, columns=['cust_id', 'prev_cust_id', 'tower_id', 'prev_tower_id',
+                'dwell_time', 'near_airport', 'in_florence_comune'])
+
+    tower_vertices = pd.DataFrame({
+        'tower_id': np.arange(towers, dtype=np.int64),
+        'lat': random.uniform(43.7, 43.8, towers),
+        'lon': random.uniform(11.2, 11.3, towers),
+        'region_name': ['region %d' % (i % 40) for i in range(towers)]
+    }, columns=['tower_id', 'lat', 'lon', 'region_name'])
+
+    return users, tower_vertices
+
+
+def apply_in_florence(users):
+    return users.apply(
+        lambda x: (x['in_florence_comune'] | x['near_airport']), axis=1)
+
+
+def get_in_florence(users):
+    return users['in_florence_comune'] | users['near_airport']
+
+
+def apply_tower_regions(users, tower_vertices):
+    return users.apply(lambda x: tower_vertices.loc[
+        tower_vertices['tower_id'] == x['tower_id']].iloc[0]['region_name'] if
+    x['in_florence'] == False else x['tower_id'], axis=1)
+
+
+def timed(label, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    print('%-50s %8.2fs' % (label, time.time() - start))
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[10000, 100000, 1000000, 10000000])
+    parser.add_argument('--apply-rows', type=int, default=100000,
+                        help='largest size to time the apply versions on')
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        users, tower_vertices = make_dwell_times(rows)
+
+        in_florence = timed('vectorized in_florence, %d rows' % rows,
+                            get_in_florence, users)
+        transitions = timed('get_transitions, %d rows' % rows,
+                            cdr_fountain.get_transitions, users.copy())
+        regions = timed('get_tower_regions, %d stays' % len(transitions),
+                        cdr_fountain.get_tower_regions, transitions,
+                        tower_vertices)
+
+        if rows > args.apply_rows:
+            continue
+
+        applied = timed('apply in_florence, %d rows' % rows,
+                        apply_in_florence, users)
+        assert (applied == in_florence).all()
+
+        applied = timed('apply tower_region, %d stays' % len(transitions),
+                        apply_tower_regions, transitions, tower_vertices)
+        assert applied.tolist() == regions.tolist()
+
+
+if __name__ == '__main__':
+    main()
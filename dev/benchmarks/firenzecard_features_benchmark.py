@@ -0,0 +1,183 @@
+"""
+Benchmarks the feature extraction of firenzecard.add_features, which
+extract_features runs on the FirenzeCard logs merged with their museum
+locations, on synthetic logs the size of the summer logs or on the summer
+logs themselves.
+
+The wall time and the peak memory allocated are reported for the vectorized
+features with dense and with sparse museum columns, and for the previous
+implementation, with its per row timedelta conversions and int64 museum
+columns, which is also checked to give the same features.
+
+Run from the repository root:
+    python dev/benchmarks/firenzecard_features_benchmark.py --rows 400000
+    python dev/benchmarks/firenzecard_features_benchmark.py \\
+        --logs firenzedata_raw.csv --locations firenzedata_locations.csv
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+from features import firenzecard
+
+
+def make_logs(rows, museums=72, entries_per_card=8, seed=0):
+    """
+    Makes synthetic logs with the columns of optourism.firenze_card_logs,
+    merged with their museum locations, over the summer of 2016
+    """
+    random = np.random.RandomState(seed)
+
+    user_id = np.arange(rows) // entries_per_card
+    museum_id = random.randint(1, museums + 1, rows)
+    activation = np.datetime64('2016-06-01') + \
+        random.randint(0, 122 * 24 * 60, rows // entries_per_card + 1) * \
+        np.timedelta64(1, 'm')
+    entry_time = activation[user_id] + \
+        random.randint(0, 72 * 3600, rows) * np.timedelta64(1, 's')
+    adults = random.randint(0, 2, rows)
+
+    return pd.DataFrame({
+        'museum_id': museum_id,
+        'museum_name': np.array(['museum %d' % museum
+                                 for museum in range(museums + 1)])[museum_id],
+        'latitude': 43.77 + museum_id / 1000.0,
+        'longitude': 11.25 + museum_id / 1000.0,
+        'user_id': user_id,
+        'entry_time': pd.Series(entry_time).astype(str),
+        'adults_first_use': adults,
+        'adults_reuse': 1 - adults,
+        'total_adults': np.ones(rows, dtype=np.int64),
+        'minors': random.randint(0, 2, rows)
+    })
+
+
+def read_logs(logs_path, locations_path):
+    """
+    Reads exported summer logs and their locations, as extract_features does
+    """
+    df = pd.read_csv(logs_path)
+    df_locations = pd.read_csv(locations_path)
+
+    return pd.merge(df_locations, df, on=['museum_id', 'museum_name'],
+                    how='inner')
+
+
+def add_features_loop(df):
+    """
+    The feature extraction that add_features replaced
+    """
+    df['entry_time'] = pd.to_datetime(df['entry_time'])
+    df['time'] = pd.to_datetime(df['entry_time']).dt.time
+    df['date'] = pd.to_datetime(df['entry_time']).dt.date
+    df['hour'] = pd.to_datetime(df['entry_time']).dt.hour
+    df['day_of_week'] = df['entry_time'].dt.dayofweek
+
+    df = df.sort_values('entry_time', ascending=True)
+    df['total_people'] = df['total_adults'] + df['minors']
+
+    df['time_since_previous_museum'] = \
+        df.groupby('user_id')['entry_time'].diff()
+    df['time_since_previous_museum'] = \
+        df['time_since_previous_museum'].apply(
+            lambda x: pd.Timedelta(x) / pd.Timedelta('1 hour'))
+
+    df = df.sort_values('entry_time', ascending=True)
+    df['total_duration_card_use'] = df[df.user_id.notnull()].groupby(
+        'user_id')['entry_time'].transform(lambda x: x.iat[-1] - x.iat[0])
+    df['total_duration_card_use'] = df['total_duration_card_use'].apply(
+        lambda x: pd.Timedelta(x) / pd.Timedelta('1 hour'))
+
+    df['entry_is_adult'] = np.where(df['total_adults'] == 1, 1, 0)
+    df['is_card_with_minors'] = np.where(df['minors'] == 1, 1, 0)
+
+    entrances_per_card_per_museum = pd.DataFrame(
+        df.groupby('user_id', as_index=True)['museum_id'].value_counts()
+        .rename('entrances_per_card_per_museum'))
+
+    df = pd.merge(entrances_per_card_per_museum.reset_index(), df,
+                  on=['user_id', 'museum_id'], how='inner')
+
+    for n in range(1, df['museum_id'].nunique()):
+        df['is_in_museum_' + str(n)] = np.where(df['museum_id'] == n, 1, 0)
+
+    return df
+
+
+def assert_same_features(left, right):
+    """
+    Checks that two feature frames have the same rows. Entries at the same
+    time may be in either order, as both sort them with an unstable sort.
+    """
+    columns = ['user_id', 'entry_time', 'museum_id', 'adults_first_use',
+               'minors']
+
+    left = left.sort_values(columns).reset_index(drop=True)
+    right = right.sort_values(columns).reset_index(drop=True)
+
+    for frame in [left, right]:
+        for column in frame.columns:
+            if hasattr(frame[column], 'sparse'):
+                frame[column] = frame[column].sparse.to_dense()
+            elif hasattr(frame[column], 'to_dense'):
+                frame[column] = frame[column].to_dense()
+
+    pd.testing.assert_frame_equal(left, right, check_dtype=False)
+
+
+def measured(label, function, *args, **kwargs):
+    tracemalloc.start()
+    start = time.time()
+    result = function(*args, **kwargs)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    frame = result.memory_usage(deep=True).sum()
+    print('%-40s %8.2fs %8.1fMB peak %8.1fMB frame' %
+          (label, elapsed, peak / 1e6, frame / 1e6))
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[400000])
+    parser.add_argument('--logs', help='CSV export of the summer logs')
+    parser.add_argument('--locations', help='CSV export of the locations')
+    parser.add_argument('--skip-loop', action='store_true',
+                        help='only time the vectorized features')
+    args = parser.parse_args()
+
+    if args.logs:
+        logs = [('summer logs', read_logs(args.logs, args.locations))]
+    else:
+        logs = [('%d rows' % rows, make_logs(rows)) for rows in args.rows]
+
+    for label, df in logs:
+        dense = measured('add_features, %s' % label,
+                         firenzecard.add_features, df.copy())
+        sparse = measured('add_features sparse, %s' % label,
+                          firenzecard.add_features, df.copy(), sparse=True)
+        assert_same_features(sparse, dense)
+
+        if args.skip_loop:
+            continue
+
+        looped = measured('loop, %s' % label, add_features_loop, df.copy())
+        assert_same_features(looped, dense)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Benchmarks fountain_deck_gl.format_cdr_properties on synthetic tower
+densities and Voronoi geometries, and checks it against a tower by tower
+reference of the intended densities: each tower's density divided by its own
+area, when the area is known and positive, then scaled so that the densest
+tower has a density of 1. The first row of a tower wins when its id is
+repeated.
+
+The synthetic towers have float ids, as read from the database, and some of
+them have no geometry, no area or an area of 0. Duplicate ids are added with
+larger densities, so that keeping the wrong row or scaling by the wrong
+maximum shows up.
+
+An empty frame and a frame without any known density are checked to give
+no towers and towers without a density.
+
+Run from the repository root:
+    python dev/benchmarks/fountain_properties_benchmark.py --towers 100000
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+import fountain_deck_gl
+
+
+def make_densities(towers, duplicates=0.05, seed=0):
+    """
+    Makes synthetic densities with the columns read by
+    fountain_deck_gl.cdr_main, and geometries keyed by the string tower id
+    """
+    random = np.random.RandomState(seed)
+
+    tower_id = np.arange(towers, dtype=np.float64)
+    density = random.uniform(1, 1000, towers)
+
+    # Repeated ids come after the first row of their tower, with densities
+    # above any first row
+    repeated = random.choice(towers, int(towers * duplicates))
+    tower_id = np.concatenate([tower_id, tower_id[repeated]])
+    density = np.concatenate([density,
+                              random.uniform(10000, 20000, len(repeated))])
+
+    densities = pd.DataFrame({'tower_id': tower_id, 'density': density},
+                             columns=['tower_id', 'density'])
+
+    geometries = {}
+    for i in range(towers):
+        kind = i % 20
+        if kind == 0:
+            continue
+        elif kind == 1:
+            area = None
+        elif kind == 2:
+            area = 0
+        else:
+            area = random.uniform(0.1, 10)
+
+        geometries[str(i)] = {'geometry': None, 'area': area}
+
+    return geometries, densities
+
+
+def reference_cdr_properties(geometries, densities, id_col_name='tower_id',
+                             density_col_name='density'):
+    """
+    Computes the intended properties one tower at a time
+    """
+    first_rows = {}
+    for tower_id, density in zip(densities[id_col_name],
+                                 densities[density_col_name]):
+        tower_id = str(int(tower_id))
+        if tower_id not in first_rows:
+            first_rows[tower_id] = density
+
+    tower_densities = {}
+    for tower_id, density in first_rows.items():
+        area = None
+        if tower_id in geometries:
+            area = geometries[tower_id]['area']
+
+        if area is not None and area > 0:
+            density = density / area
+
+        tower_densities[tower_id] = density
+
+    maximum = max(tower_densities.values())
+
+    props = {}
+    for tower_id, density in tower_densities.items():
+        area = geometries[tower_id]['area'] if tower_id in geometries else None
+        props[tower_id] = {'area': area, 'density': density / maximum}
+
+    return props
+
+
+def check(props, expected):
+    assert sorted(props) == sorted(expected)
+
+    for tower_id, prop in expected.items():
+        assert props[tower_id]['area'] == prop['area']
+        assert abs(props[tower_id]['density'] - prop['density']) < 1e-12
+
+    assert max(prop['density'] for prop in props.values()) == 1
+
+
+def check_missing_densities():
+    geometries, densities = make_densities(10, duplicates=0)
+
+    empty = densities.iloc[:0]
+    assert fountain_deck_gl.format_cdr_properties(geometries, empty) == {}
+
+    densities['density'] = np.nan
+    props = fountain_deck_gl.format_cdr_properties(geometries, densities)
+    assert len(props) == 10
+    assert all(prop['density'] is None for prop in props.values())
+
+
+def timed(label, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    print('%-50s %8.2fs' % (label, time.time() - start))
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--towers', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    check_missing_densities()
+
+    for towers in args.towers:
+        geometries, densities = make_densities(towers)
+
+        props = timed('format_cdr_properties, %d rows' % len(densities),
+                      fountain_deck_gl.format_cdr_properties, geometries,
+                      densities)
+        expected = timed('reference, %d rows' % len(densities),
+                         reference_cdr_properties, geometries, densities)
+        check(props, expected)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Benchmarks the assignment of call coordinates to the Voronoi cells of the
+towers with gpdutils.assign_points_to_cells, the point construction and
+point in shape checks of gpdutils, and the tessellation of gpdutils.
+make_voronoi_in_shp, on synthetic towers and calls.
+
+The STRtree assignment is timed at increasing sizes (up to 5M calls by
+default) and checked against the nearest tower of each call, since a call is
+in the Voronoi cell of its nearest tower. The per point loop over all of the
+cells it replaces is only timed on a small sample, where both are also
+checked to give identical cells.
+
+The cells clipped to a concave, U-shaped boundary are checked to fall apart
+into several polygons, which gpdutils.get_polygon_parts splits into the
+polygons plot_polygon_collection draws, and to still hold the calls nearest
+to their tower.
+
+Run from the repository root:
+    python dev/benchmarks/gpdutils_benchmark.py --rows 100000 1000000
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely.geometry
+from scipy.spatial import cKDTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from src.utils.plotting import gpdutils
+
+
+def make_towers(towers=85, seed=0):
+    """
+    Makes synthetic towers spread over Florence, with their Voronoi cells
+    """
+    random = np.random.RandomState(seed)
+
+    data = pd.DataFrame({'lat': random.uniform(43.72, 43.82, towers),
+                         'lon': random.uniform(11.18, 11.32, towers)})
+    points = gpdutils.convert_point_data_to_data_frame(data)
+
+    return points, gpdutils.create_voronoi(points).geometry
+
+
+def make_calls(rows, seed=1):
+    random = np.random.RandomState(seed)
+
+    return (random.uniform(11.18, 11.32, rows),
+            random.uniform(43.72, 43.82, rows))
+
+
+def assign_loop(lon, lat, cells):
+    """
+    The per point check of every cell that the STRtree replaces
+    """
+    geometries = list(cells)
+    assigned = np.full(len(lon), -1, dtype=np.int64)
+
+    for index in range(len(lon)):
+        point = shapely.geometry.Point(lon[index], lat[index])
+        for position, geometry in enumerate(geometries):
+            if geometry.intersects(point):
+                assigned[index] = position
+                break
+
+    return assigned
+
+
+def check_concave_boundary():
+    """
+    Clips the cells of towers to a U-shaped boundary, which cuts the cells
+    reaching across the gap of the U in two
+    """
+    boundary = shapely.geometry.Polygon([(0, 0), (3, 0), (3, 3), (2, 3),
+                                         (2, 1), (1, 1), (1, 3), (0, 3)])
+    shape = gpd.GeoDataFrame(geometry=[boundary])
+
+    data = pd.DataFrame({'lon': [0.5, 2.5, 0.5, 2.5, 1.5, 1.5],
+                         'lat': [2.5, 2.5, 1.5, 1.5, 0.5, 2.0]})
+    towers = gpdutils.convert_point_data_to_data_frame(data)
+    cells = gpdutils.create_voronoi(towers, shape=shape).geometry
+
+    assert 'MultiPolygon' in set(cells.geom_type)
+
+    polygons, positions = gpdutils.get_polygon_parts(cells)
+    assert all(polygon.geom_type == 'Polygon' for polygon in polygons)
+
+    areas = np.bincount(positions, weights=[polygon.area
+                                            for polygon in polygons],
+                        minlength=len(cells))
+    assert np.allclose(areas, cells.area.values)
+    assert np.isclose(areas.sum(), boundary.area)
+
+    lon, lat = make_calls(10000)
+    lon = (lon - 11.18) / 0.14 * 3
+    lat = (lat - 43.72) / 0.1 * 3
+    assigned = gpdutils.assign_points_to_cells(lon, lat, cells)
+    inside = gpdutils.within_shape(gpd.GeoSeries(
+        gpdutils.points_from_xy(lon, lat)), boundary)
+    assert ((assigned >= 0) == inside).all()
+
+    distances, nearest = cKDTree(data[['lon', 'lat']].values).query(
+        np.column_stack([lon, lat]))
+    assert (nearest[inside] == assigned[inside]).all()
+
+
+def timed(label, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    print('%-50s %8.2fs' % (label, time.time() - start))
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[100000, 1000000, 5000000])
+    parser.add_argument('--loop-rows', type=int, default=20000,
+                        help='number of calls to time the loop on')
+    parser.add_argument('--towers', type=int, nargs='+',
+                        default=[1000, 10000],
+                        help='numbers of towers to time the tessellation on')
+    args = parser.parse_args()
+
+    check_concave_boundary()
+
+    for count in args.towers:
+        towers, cells = make_towers(count)
+        shape = gpd.GeoDataFrame(geometry=[
+            shapely.geometry.Point(11.25, 43.77).buffer(0.05)])
+
+        timed('make_voronoi_in_shp, %d towers' % count,
+              gpdutils.make_voronoi_in_shp, towers, shape)
+
+    towers, cells = make_towers()
+    tower_xy = gpdutils.get_coordinates(towers.geometry)
+    tower_cells = gpdutils.assign_points_to_cells(tower_xy[:, 0],
+                                                  tower_xy[:, 1], cells)
+    assert (tower_cells == np.arange(len(towers))).all()
+    tree = cKDTree(tower_xy)
+    boundary = gpd.GeoDataFrame(geometry=[cells.unary_union])
+
+    lon, lat = make_calls(args.loop_rows)
+    looped = timed('loop over cells, %d calls' % args.loop_rows,
+                   assign_loop, lon, lat, cells)
+    assigned = timed('assign_points_to_cells, %d calls' % args.loop_rows,
+                     gpdutils.assign_points_to_cells, lon, lat, cells)
+    assert (looped == assigned).all()
+
+    for rows in args.rows:
+        lon, lat = make_calls(rows)
+
+        points = timed('points_from_xy, %d calls' % rows,
+                       gpdutils.points_from_xy, lon, lat)
+        inside = timed('within_shape, %d calls' % rows,
+                       gpdutils.within_shape, gpd.GeoSeries(points),
+                       boundary.unary_union)
+        assigned = timed('assign_points_to_cells, %d calls' % rows,
+                         gpdutils.assign_points_to_cells, lon, lat, cells)
+
+        assert ((assigned >= 0) == inside).all()
+
+        distances, nearest = tree.query(np.column_stack([lon, lat]))
+        assert (tower_cells[nearest][inside] == assigned[inside]).all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Compares the JSON and binary exports of the trips for the deck.gl paths
+visualization on synthetic trips: the size of the files, raw and gzipped, the
+time to write them and the time to load them back. Loading the JSON with the
+json module stands in for JSON.parse in the browser, loading the binary file
+makes views on its arrays the same way load-trips-binary.js does.
+
+Run from the repository root:
+    python dev/benchmarks/paths_export_benchmark.py --trips 20000
+"""
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+from utils.export import binaryutils, jsonutils
+
+
+def make_trips(trips, vertices_per_trip=300, seed=0):
+    """
+    Makes synthetic trips in the format of paths_deck_gl.get_trips, random
+    walks through Florence over a day
+    """
+    random = np.random.RandomState(seed)
+
+    for color in range(trips):
+        count = random.randint(vertices_per_trip // 2, vertices_per_trip * 2)
+        lon = 11.25 + np.cumsum(random.normal(0, 0.0005, count))
+        lat = 43.77 + np.cumsum(random.normal(0, 0.0005, count))
+        times = np.sort(random.uniform(0, 1440, count))
+
+        yield {
+            'color': color,
+            'startTime': float(times[0]),
+            'endTime': float(times[-1]),
+            'segments': np.column_stack([lon, lat, times]).tolist()
+        }
+
+
+def timed(label, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    print('%-40s %8.2fs' % (label, time.time() - start))
+
+    return result
+
+
+def gzipped_size(path):
+    with open(path, 'rb') as infile, gzip.open(path + '.gz', 'wb') as outfile:
+        shutil.copyfileobj(infile, outfile)
+
+    return os.path.getsize(path + '.gz')
+
+
+def load_json(path):
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--trips', type=int, default=20000)
+    parser.add_argument('--precision', type=int, default=6)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    json_path = os.path.join(directory, 'trips.json')
+    binary_path = os.path.join(directory, 'trips.bin')
+
+    try:
+        timed('write JSON', jsonutils.write_json_array,
+              make_trips(args.trips), json_path, precision=args.precision)
+        timed('write binary', binaryutils.write_trips_binary,
+              make_trips(args.trips), binary_path)
+
+        trips = timed('load JSON', load_json, json_path)
+        arrays = timed('load binary', binaryutils.read_trips_binary,
+                       binary_path)
+
+        vertices = sum(len(trip['segments']) for trip in trips)
+        assert vertices == len(arrays['timestamps'])
+        assert np.allclose(arrays['positions'][0], trips[0]['segments'][0][:2])
+
+        for label, path in [('JSON', json_path), ('binary', binary_path)]:
+            print('%-10s %10.1f MB %10.1f MB gzipped' % (
+                label, os.path.getsize(path) / 1e6, gzipped_size(path) / 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
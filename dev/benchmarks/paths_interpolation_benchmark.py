@@ -0,0 +1,178 @@
+"""
+Benchmarks the path interpolation of paths_deck_gl.get_trips on synthetic
+CDR records and tower routes.
+
+The vectorized interpolation is timed at increasing sizes, giving the
+segments both as lists for the JSON output and as arrays for the binary
+output. The record by record loop it replaces is only timed on the smaller
+sizes, where both are also checked to give identical trips.
+
+Run from the repository root:
+    python dev/benchmarks/paths_interpolation_benchmark.py --rows 1000000
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+import paths_deck_gl
+
+COLUMNS = ['cust_id', 'lon', 'lat', 'minutes', 'tower_id']
+
+
+def make_records(rows, towers=500, records_per_user=20, routes_per_tower=50,
+                 seed=0):
+    """
+    Makes synthetic records with the columns of the paths_deck_gl.cdr_main
+    query, ordered by user and time, and routes between most of the tower
+    pairs in them
+    """
+    random = np.random.RandomState(seed)
+
+    tower_lon = np.round(random.uniform(11.2, 11.3, towers), 6)
+    tower_lat = np.round(random.uniform(43.7, 43.8, towers), 6)
+
+    cust_id = np.arange(rows, dtype=np.int64) // records_per_user
+    tower_id = random.randint(0, towers, rows)
+    stay = random.rand(rows) < 0.3
+    stay[0] = False
+    tower_id[stay] = tower_id[np.flatnonzero(stay) - 1]
+
+    minutes = np.sort(random.randint(0, 24 * 60, rows) +
+                      cust_id * 24 * 60) % (24 * 60)
+
+    records = pd.DataFrame({
+        'cust_id': cust_id,
+        'lon': tower_lon[tower_id],
+        'lat': tower_lat[tower_id],
+        'minutes': minutes.astype(float),
+        'tower_id': tower_id
+    }, columns=COLUMNS)
+
+    routes = {}
+    for start in range(towers):
+        for end in random.randint(0, towers, routes_per_tower):
+            steps = random.randint(0, 40)
+            key = '{0},{1};{2},{3}'.format(tower_lon[start], tower_lat[start],
+                                           tower_lon[end], tower_lat[end])
+            routes[key] = [
+                (tower_lat[start] + (tower_lat[end] - tower_lat[start]) *
+                 step / steps,
+                 tower_lon[start] + (tower_lon[end] - tower_lon[start]) *
+                 step / steps) for step in range(steps)]
+
+    return records, routes
+
+
+def get_trips_loop(records, routes):
+    """
+    The record by record interpolation that get_trips replaced
+    """
+    data = None
+    prev_user = None
+    prev_time = None
+    prev_tower = None
+    prev_lat = None
+    prev_lon = None
+    id_counter = 0
+
+    for user, lon, lat, timestamp, tower in records:
+        if prev_user is not None and prev_user != user:
+            data['endTime'] = prev_time
+            yield data
+
+        if prev_user is None or prev_user != user:
+            data = {'color': id_counter, 'startTime': timestamp,
+                    'segments': []}
+            id_counter += 1
+        elif prev_tower is not None and prev_tower != tower:
+            key = '{0},{1};{2},{3}'.format(prev_lon, prev_lat, lon, lat)
+
+            if key in routes:
+                route = routes[key]
+                delta = (timestamp - prev_time) / (len(route) + 1)
+
+                for i in range(len(route)):
+                    stop_lat, stop_lon = route[i]
+                    data['segments'].append(
+                        [stop_lon, stop_lat, prev_time + delta * (i + 1)])
+
+        data['segments'].append([lon, lat, timestamp])
+
+        prev_user = user
+        prev_time = timestamp
+        prev_tower = tower
+        prev_lat = lat
+        prev_lon = lon
+
+    if data is not None:
+        data['endTime'] = prev_time
+        yield data
+
+
+def get_chunks(records, chunk_size):
+    """
+    Splits records into chunks of whole users, like dbutils.read_sql_chunks
+    """
+    cust_id = records['cust_id'].values
+    bounds = [0]
+
+    for split in range(chunk_size, len(records), chunk_size):
+        split = np.searchsorted(cust_id, cust_id[split], side='right')
+        if split > bounds[-1]:
+            bounds.append(split)
+
+    bounds.append(len(records))
+
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if stop > start:
+            yield records.iloc[start:stop]
+
+
+def timed(label, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    print('%-50s %8.2fs' % (label, time.time() - start))
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[100000, 1000000, 10000000])
+    parser.add_argument('--loop-rows', type=int, default=1000000,
+                        help='largest size to time the loop on')
+    parser.add_argument('--chunk-size', type=int, default=500000)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        records, routes = make_records(rows)
+
+        trips = timed('get_trips lists, %d rows' % rows, lambda: list(
+            paths_deck_gl.get_trips(get_chunks(records, args.chunk_size),
+                                    routes)))
+        timed('get_trips arrays, %d rows' % rows, lambda: list(
+            paths_deck_gl.get_trips(get_chunks(records, args.chunk_size),
+                                    routes, as_arrays=True)))
+
+        if rows > args.loop_rows:
+            continue
+
+        tuples = list(records.itertuples(index=False))
+        looped = timed('loop, %d rows' % rows,
+                       lambda: list(get_trips_loop(tuples, routes)))
+        assert looped == trips
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmarks the trip segmentation engines of trip_segmenter.get_trips on
+synthetic customer day time series.
+
+The numpy engine is timed on the full synthetic data set (50M rows by
+default), single process and across a pool of processes. The pandas engine is
+only timed on a smaller validation subset, on which both engines are also
+checked to give identical output.
+
+Run from the repository root:
+    python dev/benchmarks/trip_segmenter_benchmark.py --rows 50000000
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from src.features import trip_segmenter as ts
+
+
+def make_daily_call_counts(rows, days_per_customer=20, seed=0):
+    """
+    Makes a synthetic time series with the same columns as
+    trip_segmenter.get_daily_call_counts, ordered by customer and date.
+    """
+    random = np.random.RandomState(seed)
+
+    cust_id = np.arange(rows, dtype=np.int64) // days_per_customer
+    first = np.ones(rows, dtype=bool)
+    first[1:] = cust_id[1:] != cust_id[:-1]
+
+    steps = random.randint(1, 6, rows).astype(np.int64)
+    steps[first] = random.randint(0, 30, first.sum())
+    offsets = np.cumsum(steps)
+    offsets -= np.maximum.accumulate(np.where(first, offsets - steps, 0))
+
+    date = np.datetime64('2016-06-01') + offsets.astype('timedelta64[D]')
+    date_diff = np.empty(rows)
+    date_diff[1:] = offsets[1:] - offsets[:-1] - 1
+    date_diff[first] = np.nan
+
+    calls = random.randint(1, 10, rows)
+    calls_in_florence = random.binomial(calls, 0.3)
+    calls_near_airport = random.binomial(1, 0.05, rows)
+
+    same_cust = (~first).astype(object)
+    same_cust[0] = None
+
+    return pd.DataFrame({
+        'cust_id': cust_id,
+        'same_cust': same_cust,
+        'date': date.astype('datetime64[ns]'),
+        'date_diff': date_diff,
+        'calls': calls,
+        'calls_in_florence': calls_in_florence,
+        'calls_near_airport': calls_near_airport
+    }, columns=['cust_id', 'same_cust', 'date', 'date_diff', 'calls',
+                'calls_in_florence', 'calls_near_airport'])
+
+
+def timed(label, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    print('%-40s %8.2fs' % (label, time.time() - start))
+
+    return result
+
+
+def validate(rows):
+    counts = make_daily_call_counts(rows, seed=1)
+
+    pandas_counts, pandas_group = timed(
+        'pandas engine, %d rows' % rows, ts.get_trips, counts.copy())
+    numpy_counts, numpy_group = timed(
+        'numpy engine, %d rows' % rows, ts.get_trips, counts.copy(),
+        engine='numpy')
+
+    assert (pandas_counts['trip'].values == numpy_counts['trip'].values).all()
+    assert pandas_group.equals(numpy_group)
+    print('engines give identical trips and trips_group')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=50000000)
+    parser.add_argument('--validate-rows', type=int, default=2000000)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    validate(args.validate_rows)
+
+    counts = timed('make %d synthetic rows' % args.rows,
+                   make_daily_call_counts, args.rows)
+
+    arrays = (counts['cust_id'].values, counts['date'].values,
+              counts['calls_in_florence'].values,
+              counts['calls_near_airport'].values)
+
+    states = timed('segment_trip_states', ts.segment_trip_states, *arrays)
+    parallel = timed('segment_trip_states_parallel',
+                     ts.segment_trip_states_parallel, *arrays,
+                     processes=args.processes)
+    assert (states == parallel).all()
+
+    timed('get_trip_ids', ts.get_trip_ids, states)
+    timed('get_trips numpy engine', ts.get_trips, counts, engine='numpy',
+          processes=args.processes)
+
+
+if __name__ == '__main__':
+    main()
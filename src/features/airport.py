@@ -1,6 +1,6 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 import trip_segmenter as ts
+from ..utils.database import dbcache
 
 
 def get_airport_arrivals(db_connection, csv_path=''):
@@ -17,10 +17,10 @@ def get_airport_arrivals(db_connection, csv_path=''):
             arriving per day at the Florence airport.
     """
 
-    arrivals_data = pd.read_sql("""
+    arrivals_data = dbcache.read_sql_cached("""
         SELECT "day", SUM(total_passengers) AS passengers
         FROM optourism.florence_airport_arrivals GROUP BY "day"
-        """, con=db_connection)
+        """, db_connection)
 
     if csv_path:
         arrivals_data.to_csv(csv_path)
@@ -35,17 +35,19 @@ def get_near_airport(features, csv_path=''):
 
     Args:
         features (Pandas.DataFrame): a set of user trips with features for
-            trip number and when the call was placed in the timeline of the trip
+            trip number and when the call was placed in the timeline of the
+            trip, with the categorical 'trip' column returned by get_trips
         csv_path (string): file path for where to save CSV data to
 
     Returns:
         Pandas.DataFrame: The filtered subset of trip features for just trips
             whose first call is in the airport.
     """
-    at_airport_data = features.loc[features['trip'].isin(['first', 'trip']) &
-                                   features['calls_near_airport'] > 0]
+    starts_trip = ts.is_trip_state(features['trip'], ['first', 'start'])
+    at_airport_data = features.loc[starts_trip &
+                                   (features['calls_near_airport'] > 0)]
 
-    data = at_airport_data.groupby('date_').nunique('cust_id')
+    data = at_airport_data.groupby('date')[['cust_id']].nunique()
 
     if csv_path:
         data.to_csv(csv_path)
@@ -67,7 +69,8 @@ def get_italians_near_airport(db_connection, csv_path=''):
         trips whose first call is in the airport.
     """
 
-    features = ts.get_italian_trips(db_connection, only_start=True)
+    features, trips_group = ts.get_italian_trips(db_connection,
+                                                 only_start=True)
     return get_near_airport(features, csv_path)
 
 
@@ -85,7 +88,8 @@ def get_foreigners_near_airport(db_connection, csv_path=''):
         trips whose first call is in the airport.
     """
 
-    features = ts.get_foreign_trips(db_connection, only_start=True)
+    features, trips_group = ts.get_foreign_trips(db_connection,
+                                                 only_start=True)
     return get_near_airport(features, csv_path)
 
 
@@ -102,9 +106,9 @@ def get_tourist_center_visits(db_connection, csv_path=''):
             tourist information center.
     """
 
-    visits = pd.read_sql("""
+    visits = dbcache.read_sql_cached("""
         SELECT * FROM optourism.info_center_ae_daily
-        """, con=db_connection)
+        """, db_connection)
 
     columns = list(visits)
     columns.remove('visit_date')
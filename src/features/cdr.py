@@ -1,4 +1,4 @@
-import pandas as pd
+from ..utils.database import dbcache
 
 
 def filter_data(db_connection):
@@ -79,10 +79,10 @@ def get_towers_in_florence(db_connection):
             Florence city
     """
 
-    towers_data = pd.read_sql("""
+    towers_data = dbcache.read_sql_cached("""
         SELECT DISTINCT lat, lon
         FROM optourism.cdr_labeled_towers
         WHERE in_florence_city = TRUE
-        """, con=db_connection)
+        """, db_connection)
 
     return towers_data
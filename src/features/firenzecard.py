@@ -10,20 +10,32 @@
 import sys
 import pandas as pd
 import numpy as np
+import scipy.sparse
 import plotly
 from plotly.graph_objs import *
 import plotly.plotly as py
 import plotly.graph_objs as go
 sys.path.append('../src/')
+from utils.database import dbutils, dbcache
 #from IPython.core.debugger import Tracer
 
+# Types of the optourism.firenze_card_logs columns, see sql/firenze_card_logs.sql.
+# The CSV reader can't read a NULL into an int64 column, so only user_id, the
+# key of the logs, is read as int64 and the counts are left to be inferred,
+# as float when they have NULLs like pd.read_sql returned them.
+FIRENZE_CARD_LOGS_DTYPES = {
+    'user_id': np.int64,
+    'museum_name': str
+}
+
+
 def get_national_museums(db_connection, export_to_csv, export_path):
 
     """
     Get national museum data from DB
     """
 
-    df = pd.read_sql('select * from optourism.state_national_museum_visits', con=db_connection)
+    df = dbcache.read_sql_cached('select * from optourism.state_national_museum_visits', db_connection)
 
     if export_to_csv:
         df.to_csv(f"{export_path}_nationalmuseums_raw.csv", index=False)
@@ -37,7 +49,9 @@ def get_firenze_data(db_connection, export_to_csv, export_path):
     Get FirenzeCard logs from DB
     """
 
-    df = pd.read_sql('select * from optourism.firenze_card_logs', con=db_connection)
+    df = dbcache.read_sql_cached('select * from optourism.firenze_card_logs', db_connection,
+                                 reader=dbutils.read_sql_bulk,
+                                 dtype=FIRENZE_CARD_LOGS_DTYPES, parse_dates=['entry_time'])
 
     if export_to_csv:
         df.to_csv(f"{export_path}_firenzedata_raw.csv", index=False)
@@ -45,13 +59,13 @@ def get_firenze_data(db_connection, export_to_csv, export_path):
     return df
 
 
-def get_firenze_locations(db_connection, export_to_csv, export_path):
+def get_firenze_locations(db_connection, export_to_csv=False, export_path=None):
 
     """
     Get latitude and longitude fields from DB
     """
 
-    df = pd.read_sql('select * from optourism.firenze_card_locations', con=db_connection)
+    df = dbcache.read_sql_cached('select * from optourism.firenze_card_locations', db_connection)
 
     if export_to_csv:
         df.to_csv(f"{export_path}_firenzedata_locations.csv", index=False)
@@ -59,7 +73,8 @@ def get_firenze_locations(db_connection, export_to_csv, export_path):
     return df
 
 
-def extract_features(db_connection, path_firenzedata, path_firenzelocations_data, export_to_csv, export_path):
+def extract_features(db_connection, path_firenzedata, path_firenzelocations_data, export_to_csv, export_path,
+                     sparse=False):
 
     """
     Feature extraction for FirenzeCard data
@@ -71,6 +86,7 @@ def extract_features(db_connection, path_firenzedata, path_firenzelocations_data
     path_firenzelocations_data: path to firenzelocations data csv file
     export_to_csv: boolean
     export_path: path to export data
+    sparse: boolean, store the museum id columns as sparse columns
 
     Returns
     -------
@@ -84,8 +100,8 @@ def extract_features(db_connection, path_firenzedata, path_firenzelocations_data
               - day_of_week: day of the week
               - time_until_next_museum: how much time elapsed until next museum visit on a card?
               - duration_of_use: how many total days/hours was a card used?
-              - (museum id column): per museum, a feature indicating whether a person was in that museum or not.
-              column number is indicative of museum id.
+              - (museum id column): per museum, a uint8 feature indicating whether a person was in that museum or
+              not. column number is indicative of museum id.
               - number of museums visited so far
               - persons_per_card_per_museum
               - day of use
@@ -102,26 +118,105 @@ def extract_features(db_connection, path_firenzedata, path_firenzelocations_data
         df_locations = get_firenze_locations(db_connection, True, f"{export_path}_firenzedata_locations.csv")
 
     df = pd.merge(df_locations, df, on=['museum_id', 'museum_name'], how='inner')
+    df = add_features(df, sparse=sparse)
+
+    if export_to_csv:
+        df.to_csv(f"{export_path}_firenzedata_feature_extracted.csv", index=False)
+
+    return df
+
+
+def get_museum_indicators(museum_id, count):
+
+    """
+    One-hot encode museum ids as a sparse matrix
+
+    Parameters
+    ----------
+    museum_id: array of the museum id of each entry
+    count: number of columns, for the museum ids 1 to count
+
+    Returns
+    -------
+
+     1. scipy.sparse.csr_matrix of uint8, with a 1 in column n - 1 of the entries in museum n
+    """
+
+    museum_id = np.asarray(museum_id)
+    rows = np.flatnonzero((museum_id >= 1) & (museum_id <= count))
+    columns = museum_id[rows].astype(np.int64) - 1
+
+    return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.uint8), (rows, columns)),
+                                   shape=(len(museum_id), count), dtype=np.uint8)
+
+
+def get_sparse_frame(matrix, index, columns):
+
+    """
+    Make a dataframe of sparse columns out of a sparse matrix
+
+    Parameters
+    ----------
+    matrix: scipy.sparse matrix with a column for each of the columns
+    index: index of the dataframe, one label per row of the matrix
+    columns: names of the columns
 
-    df['entry_time'] = pd.to_datetime(df['entry_time'])
-    df['time'] = pd.to_datetime(df['entry_time']).dt.time
-    df['date'] = pd.to_datetime(df['entry_time']).dt.date
-    df['hour'] = pd.to_datetime(df['entry_time']).dt.hour
-    df['day_of_week'] = df['entry_time'].dt.dayofweek
+    Returns
+    -------
+
+     1. Pandas dataframe of sparse columns with a fill value of 0
+    """
+
+    if hasattr(pd.DataFrame, 'sparse'):
+        return pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+
+    # Pandas before 0.25 has no sparse accessor, its dataframes keep SparseArray columns sparse instead
+    matrix = scipy.sparse.csc_matrix(matrix)
+    arrays = {}
+
+    for n, column in enumerate(columns):
+        values = np.zeros(matrix.shape[0], dtype=matrix.dtype)
+        start, end = matrix.indptr[n], matrix.indptr[n + 1]
+        values[matrix.indices[start:end]] = matrix.data[start:end]
+        arrays[column] = pd.SparseArray(values, fill_value=0)
+
+    return pd.DataFrame(arrays, index=index, columns=columns)
+
+
+def add_features(df, sparse=False):
+
+    """
+    Add the extracted features to FirenzeCard logs merged with their locations (called by extract_features)
+
+    Parameters
+    ----------
+    df: Pandas dataframe of the logs with their museum locations
+    sparse: boolean, store the is_in_museum_N columns as sparse columns
+
+    Returns
+    -------
+
+     1. Pandas dataframe with the extracted features, see extract_features
+    """
+
+    # Parsed once, every other time feature is derived from it
+    entry_time = pd.to_datetime(df['entry_time'])
+    df['entry_time'] = entry_time
+    df['time'] = entry_time.dt.time
+    df['date'] = entry_time.dt.date
+    df['hour'] = entry_time.dt.hour
+    df['day_of_week'] = entry_time.dt.dayofweek
 
     df = df.sort_values('entry_time', ascending=True)
     df['total_people'] = df['total_adults'] + df['minors']
 
+    one_hour = np.timedelta64(1, 'h')
+
     # todo remove overnights from time_since_previous museum - to only count on given days
-    df['time_since_previous_museum'] = df.groupby('user_id')['entry_time'].diff()
-    df['time_since_previous_museum'] = df['time_since_previous_museum'].apply(
-        lambda x: pd.Timedelta(x) / pd.Timedelta('1 hour'))
+    df['time_since_previous_museum'] = df.groupby('user_id')['entry_time'].diff() / one_hour
 
-    df = df.sort_values('entry_time', ascending=True)
-    df['total_duration_card_use'] = df[df.user_id.notnull()].groupby(
-        'user_id')['entry_time'].transform(lambda x: x.iat[-1] - x.iat[0])
-    df['total_duration_card_use'] = df['total_duration_card_use'].apply(
-        lambda x: pd.Timedelta(x) / pd.Timedelta('1 hour'))
+    card_times = df[df.user_id.notnull()].groupby('user_id')['entry_time']
+    df['total_duration_card_use'] = (card_times.transform('last') - card_times.transform('first')) / one_hour
 
     df['entry_is_adult'] = np.where(df['total_adults'] == 1, 1, 0)
     df['is_card_with_minors'] = np.where(df['minors'] == 1, 1, 0)
@@ -131,16 +226,21 @@ def extract_features(db_connection, path_firenzedata, path_firenzelocations_data
 
     df = pd.merge(entrances_per_card_per_museum.reset_index(), df, on=['user_id', 'museum_id'], how='inner')
 
-    for n in range(1, df['museum_id'].nunique()):
-        df['is_in_museum_' + str(n)] = np.where(df['museum_id'] == n, 1, 0)
-    if export_to_csv:
-        df.to_csv(f"{export_path}_firenzedata_feature_extracted.csv", index=False)
+    # The columns are is_in_museum_1 up to one less than the number of museums, as the analyses use them
+    count = df['museum_id'].nunique() - 1
+    columns = ['is_in_museum_' + str(n) for n in range(1, count + 1)]
+    indicators = get_museum_indicators(df['museum_id'].values, count)
 
-    return df
+    if sparse:
+        museums = get_sparse_frame(indicators, df.index, columns)
+    else:
+        museums = pd.DataFrame(indicators.toarray(), index=df.index, columns=columns)
+
+    return pd.concat([df, museums], axis=1)
 
 
-def interpolate_on_timedelta(df, groupby_object,timedelta, timedelta_range=,
-                             count_column,timeunit, start_date, end_date):
+def interpolate_on_timedelta(df, groupby_object, timedelta, timedelta_range,
+                             count_column, timeunit, start_date=None, end_date=None):
     """
     Interpolate data on a given timedelta
     """
@@ -1,28 +1,135 @@
+import multiprocessing
+import os
+import numpy as np
 import pandas as pd
 import logging as log
-from ..utils.database import dbutils
+from ..utils.database import dbutils, dbcache
+
+# Integer codes for the trip state of each customer day, indexes into
+# TRIP_STATES which holds the names used in the 'trip' column
+TRIP_NONE = 0
+TRIP_FIRST = 1
+TRIP_LAST = 2
+TRIP_CONTINUE = 3
+TRIP_END = 4
+TRIP_START = 5
+
+TRIP_STATES = ['', 'first', 'last', 'continue', 'end', 'start']
+
+# Types of the columns read by get_daily_call_counts
+DAILY_CALL_COUNTS_DTYPES = {
+    'cust_id': np.int64,
+    'date_diff': np.float64,
+    'calls': np.int64,
+    'calls_in_florence': np.int64,
+    'calls_near_airport': np.int64
+}
+
+
+def get_trip_state_code(name):
+    """
+    Gets the integer code of a trip state name
+
+    Args:
+        name (string): one of the names in TRIP_STATES, e.g. 'start'
+
+    Returns:
+        int: the TRIP_* code for the name
+    """
+    return TRIP_STATES.index(name)
+
+
+def get_trip_state_name(code):
+    """
+    Gets the name of a trip state code
+
+    Args:
+        code (int): one of the TRIP_* codes
+
+    Returns:
+        string: the name of the trip state, '' when not on a trip
+    """
+    return TRIP_STATES[code]
+
+
+def get_trip_state_categorical(states):
+    """
+    Wraps an array of trip state codes in a categorical with the trip state
+    names as categories, so the codes are stored as int8 but read as names
+
+    Args:
+        states (numpy.ndarray): TRIP_* code of every day
+
+    Returns:
+        Pandas.Categorical: the trip states with categories TRIP_STATES
+    """
+    return pd.Categorical.from_codes(np.asarray(states, dtype=np.int8),
+                                     categories=TRIP_STATES)
+
+
+def is_trip_state(trips, names):
+    """
+    Checks which days have one of the given trip states. Compares the int8
+    codes of the categorical 'trip' column instead of the names.
+
+    Args:
+        trips (Pandas.Series): the categorical 'trip' column returned by
+                               get_trips
+        names (list): the trip state names to check for, e.g. ['first']
+
+    Returns:
+        numpy.ndarray: boolean mask of the days with one of the trip states
+    """
+    codes = [get_trip_state_code(name) for name in names]
+
+    return np.isin(trips.cat.codes.values, codes)
 
 
-def get_daily_call_counts(db_connection, timeseries_table):
+def get_daily_call_counts(db_connection, timeseries_table, chunk_size=None,
+                          since=None):
     """
     Gets the time series data per customer from the database. This data
     contains every unique customer ID from the time series set along with
     the every unique call date for each customer with the associated number
     of calls made or received.
 
+    When a chunk_size is given the data is streamed from a server side cursor
+    instead of being read all at once, in chunks that never split the rows of
+    one customer.
+
     Args:
         db_connection (Psycopg.connection): The database connection
         timeseries_table (string): The name of the database table that contains
                                    the time series data
+        chunk_size (int): Optional number of rows to read from the database at
+                          a time
+        since (datetime): Optional date, only the rows with a later date_ are
+                          read. same_cust and date_diff are then relative to
+                          the rows that are read.
 
     Returns:
         Pandas.DataFrame: The time series data for each unique user. It has the
-                          columns cust_id, date, date_diff, calls,
-                          calls_in_florence, calls_near_airport
+                          columns cust_id, same_cust, date, date_diff, calls,
+                          calls_in_florence, calls_near_airport. If chunk_size
+                          is given this is an iterator of DataFrames with the
+                          same columns, ordered by customer and date.
     """
 
+    if chunk_size:
+        return _get_daily_call_count_chunks(db_connection, timeseries_table,
+                                            chunk_size, since=since)
+
     log.info('Start reading from DB')
 
+    if since is not None:
+        query = _get_ordered_daily_call_counts_query(timeseries_table, since)
+
+        return dbcache.read_sql_cached(query, db_connection,
+                                       params={'since': since},
+                                       reader=dbutils.read_sql_bulk,
+                                       dtype=DAILY_CALL_COUNTS_DTYPES,
+                                       parse_dates=['date'])
+
     query = """
         SELECT cust_id, 
         (cust_id - LAG(cust_id) OVER ())=0 AS same_cust, 
@@ -34,9 +141,58 @@ def get_daily_call_counts(db_connection, timeseries_table):
         FROM %s
     """ % timeseries_table
 
+    counts = dbcache.read_sql_cached(query, db_connection,
+                                     reader=dbutils.read_sql_bulk,
+                                     dtype=DAILY_CALL_COUNTS_DTYPES,
+                                     parse_dates=['date'])
+
     log.info('Finished reading from DB')
 
-    return pd.read_sql(query, con=db_connection)
+    return counts
+
+
+def _get_ordered_daily_call_counts_query(timeseries_table, since=None):
+    """
+    Makes the daily call counts query with its window functions and results
+    ordered by customer and date, optionally for only the dates after a
+    %(since)s query parameter
+    """
+    where = 'WHERE date_ > %(since)s' if since is not None else ''
+
+    return """
+        SELECT cust_id, 
+        (cust_id - LAG(cust_id) OVER w)=0 AS same_cust, 
+        date_ AS date, 
+        EXTRACT(DAYS FROM date_ - LAG(date_) OVER w) - 1 AS date_diff, 
+        calls, 
+        calls_in_florence_city AS calls_in_florence,
+        calls_near_airport
+        FROM %s
+        %s
+        WINDOW w AS (ORDER BY cust_id, date_)
+        ORDER BY cust_id, date_
+    """ % (timeseries_table, where)
+
+
+def _get_daily_call_count_chunks(db_connection, timeseries_table, chunk_size,
+                                 since=None):
+    """
+    Streams the time series data per customer from the database in customer
+    aligned chunks. The window functions are ordered explicitly because a
+    server side cursor gives no guarantee on the physical order of the rows.
+    """
+
+    query = _get_ordered_daily_call_counts_query(timeseries_table, since)
+
+    log.info('Start streaming from DB')
+
+    for chunk in dbutils.read_sql_chunks(query, db_connection,
+                                         key_column='cust_id',
+                                         chunk_size=chunk_size,
+                                         params={'since': since}):
+        yield chunk
+
+    log.info('Finished streaming from DB')
 
 
 # TODO: cleanup or snip
@@ -50,40 +206,106 @@ def get_active_counts(counts):
     return counts_subset
 
 
-def get_italian_trips(db_connection):
+def get_italian_trips(db_connection, only_start=False, chunk_size=None,
+                      engine='pandas', processes=None, state_path=None):
     """
     Gets the time series data for all Italian visitors from the database
 
     Args:
         db_connection (Psycopg.connection): The database connection
+        only_start (bool): Whether to only label the start of trips
+        chunk_size (int): Optional number of rows to read and segment at a
+                          time, which bounds the memory used by the reads
+        engine (string): The trip segmentation engine, see get_trips. With
+                         'sql' the trips are segmented in the database and
+                         only the trips_group is returned, counts is None.
+        processes (int): Number of processes for the numpy engine
+        state_path (string): Optional file path for the persisted state of
+                             incremental segmentation. When given only the
+                             days since the last run are read and segmented,
+                             see get_trips_incremental.
 
     Returns:
-        Pandas.DataFrame: The time series data for each unique Italian visitor.
-                          It has the columns cust_id, date, date_diff, calls,
-                          calls_in_florence, calls_near_airport
+        tuple (Pandas.DataFrame, Pandas.DataFrame): the time series data for
+            each unique Italian visitor labelled with the trip state of each day,
+            as returned by get_trips, and the number of days of each trip
+            indexed by cust_id and trip_id. With state_path the counts only
+            hold the days read in this run, see get_trips_incremental. With
+            engine='sql' the counts are None.
     """
+    if state_path:
+        return get_trips_incremental(db_connection,
+                                     'optourism.italians_timeseries_daily',
+                                     state_path, only_start=only_start,
+                                     chunk_size=chunk_size)
+
+    if engine == 'sql':
+        return None, get_trips_sql(db_connection,
+                                   'optourism.italians_timeseries_daily',
+                                   only_start=only_start)
+
     counts = get_daily_call_counts(db_connection,
-                                   'optourism.italians_timeseries_daily')
+                                   'optourism.italians_timeseries_daily',
+                                   chunk_size=chunk_size)
+
+    if chunk_size:
+        return concat_trips(get_trips_in_chunks(counts, only_start=only_start,
+                                                engine=engine,
+                                                processes=processes))
 
-    return get_trips(counts)
+    return get_trips(counts, only_start=only_start, engine=engine,
+                     processes=processes)
 
 
-def get_foreign_trips(db_connection):
+def get_foreign_trips(db_connection, only_start=False, chunk_size=None,
+                      engine='pandas', processes=None, state_path=None):
     """
     Gets the time series data for all Foreign visitors from the database
 
     Args:
         db_connection (Psycopg.connection): The database connection
+        only_start (bool): Whether to only label the start of trips
+        chunk_size (int): Optional number of rows to read and segment at a
+                          time, which bounds the memory used by the reads
+        engine (string): The trip segmentation engine, see get_trips. With
+                         'sql' the trips are segmented in the database and
+                         only the trips_group is returned, counts is None.
+        processes (int): Number of processes for the numpy engine
+        state_path (string): Optional file path for the persisted state of
+                             incremental segmentation. When given only the
+                             days since the last run are read and segmented,
+                             see get_trips_incremental.
 
     Returns:
-        Pandas.DataFrame: The time series data for each unique Foreign visitor.
-                          It has the columns cust_id, date, date_diff, calls,
-                          calls_in_florence, calls_near_airport
+        tuple (Pandas.DataFrame, Pandas.DataFrame): the time series data for
+            each unique Foreign visitor labelled with the trip state of each day,
+            as returned by get_trips, and the number of days of each trip
+            indexed by cust_id and trip_id. With state_path the counts only
+            hold the days read in this run, see get_trips_incremental. With
+            engine='sql' the counts are None.
     """
+    if state_path:
+        return get_trips_incremental(db_connection,
+                                     'optourism.foreigners_timeseries_daily',
+                                     state_path, only_start=only_start,
+                                     chunk_size=chunk_size)
+
+    if engine == 'sql':
+        return None, get_trips_sql(db_connection,
+                                   'optourism.foreigners_timeseries_daily',
+                                   only_start=only_start)
+
     counts = get_daily_call_counts(db_connection,
-                                   'optourism.foreigners_timeseries_daily')
+                                   'optourism.foreigners_timeseries_daily',
+                                   chunk_size=chunk_size)
+
+    if chunk_size:
+        return concat_trips(get_trips_in_chunks(counts, only_start=only_start,
+                                                engine=engine,
+                                                processes=processes))
 
-    return get_trips(counts)
+    return get_trips(counts, only_start=only_start, engine=engine,
+                     processes=processes)
 
 
 def frequency(dataframe, column_name):
@@ -115,7 +337,41 @@ def frequency(dataframe, column_name):
     return out
 
 
-def get_trips(counts, only_start=False, gap_length=3):
+def get_trips(counts, only_start=False, gap_length=3, engine='pandas',
+              processes=None):
+    """
+    Labels every customer day with its state in a trip to Florence and groups
+    the days on a trip by customer and trip.
+
+    Args:
+        counts (Pandas.DataFrame): The time series data returned from a
+                                   get_daily_call_counts method call
+        only_start (bool): Whether to only label the start of trips
+        gap_length (int): Number of days without calls that ends a trip
+        engine (string): 'pandas' for the original Series based segmentation
+                         or 'numpy' for the vectorized segmentation engine.
+                         Both give the same output.
+        processes (int): Number of processes for the numpy engine to split
+                         the customers over
+
+    Returns:
+        tuple (Pandas.DataFrame, Pandas.DataFrame): the counts with added
+            columns for the trip state of each day, and the number of days of
+            each trip indexed by cust_id and trip_id. The 'trip' column is a
+            categorical of the TRIP_STATES names backed by int8 codes.
+    """
+    if engine == 'numpy':
+        return _get_trips_numpy(counts, only_start=only_start,
+                                gap_length=gap_length, processes=processes)
+
+    if engine != 'pandas':
+        raise ValueError('Unknown trip segmentation engine: %s' % engine)
+
+    return _get_trips_pandas(counts, only_start=only_start,
+                             gap_length=gap_length)
+
+
+def _get_trips_pandas(counts, only_start=False, gap_length=3):
     counts.iloc[0, 1] = False
 
     same_cust_false = counts['same_cust'] == False
@@ -145,14 +401,14 @@ def get_trips(counts, only_start=False, gap_length=3):
     counts['willbe_out_florence'] = counts['out_florence'].shift(-1)
     counts.loc[same_cust_false, 'was_out_florence'] = None
 
-    counts['trip'] = ''
+    counts['trip'] = np.zeros(len(counts), dtype=np.int8)
 
     # Do less specific first
     counts.loc[
         same_cust_false &
         in_florence_true,
         'trip'
-    ] = 'first'
+    ] = TRIP_FIRST
 
     if not only_start:
         counts.loc[
@@ -160,7 +416,7 @@ def get_trips(counts, only_start=False, gap_length=3):
             (counts['same_cust'].shift(-1) == False) &
             in_florence_true,
             'trip'
-        ] = 'last'
+        ] = TRIP_LAST
 
     # And more specific next
     counts.loc[
@@ -169,7 +425,7 @@ def get_trips(counts, only_start=False, gap_length=3):
         was_in_florence_true &
         in_florence_true,
         'trip'
-    ] = 'continue'
+    ] = TRIP_CONTINUE
 
     if not only_start:
         counts.loc[
@@ -179,7 +435,7 @@ def get_trips(counts, only_start=False, gap_length=3):
             in_florence_true &
             willbe_in_florence_false,
             'trip'
-        ] = 'end'
+        ] = TRIP_END
 
     counts.loc[
         same_cust_true &
@@ -187,9 +443,10 @@ def get_trips(counts, only_start=False, gap_length=3):
         was_in_florence_false &
         in_florence_true,
         'trip'
-    ] = 'start'
+    ] = TRIP_START
 
-    counts['on_trip'] = counts['trip'] != ''
+    counts['on_trip'] = counts['trip'] != TRIP_NONE
+    counts['trip'] = get_trip_state_categorical(counts['trip'].values)
 
     trips = counts[['cust_id', 'same_cust', 'date', 'date_diff',
                     'calls_in_florence', 'calls_out_florence', 'trip',
@@ -204,6 +461,747 @@ def get_trips(counts, only_start=False, gap_length=3):
     return counts, trips_group
 
 
+def segment_trip_states(cust_id, date, calls_in_florence, calls_near_airport,
+                        only_start=False, gap_length=3,
+                        next_in_florence=None):
+    """
+    Vectorized trip segmentation of customer days. Labels each day with one of
+    the TRIP_* codes using the same rules as the pandas engine of get_trips.
+
+    Args:
+        cust_id (numpy.ndarray): customer id of each day, with the days of a
+            customer in consecutive rows
+        date (numpy.ndarray): datetime64 date of each day, ascending for each
+            customer
+        calls_in_florence (numpy.ndarray): number of calls in Florence per day
+        calls_near_airport (numpy.ndarray): number of calls near the airport
+        only_start (bool): Whether to only label the start of trips
+        gap_length (int): Number of days without calls that ends a trip
+        next_in_florence (bool): Whether the customer in the row following the
+            last row was in Florence, or None when no row follows. Used when
+            segmenting one partition of a larger set of customers.
+
+    Returns:
+        numpy.ndarray: the int8 trip state code of every day
+    """
+    n = len(cust_id)
+    states = np.zeros(n, dtype=np.int8)
+
+    if n == 0:
+        return states
+
+    same_cust = np.zeros(n, dtype=bool)
+    same_cust[1:] = cust_id[1:] == cust_id[:-1]
+
+    days = np.asarray(date, dtype='datetime64[D]').astype(np.int64)
+    gap = np.zeros(n, dtype=bool)
+    gap[1:] = (days[1:] - days[:-1] - 1) < gap_length
+    gap &= same_cust
+
+    in_florence = (np.asarray(calls_in_florence) > 0) | \
+                  (np.asarray(calls_near_airport) > 0)
+
+    was_in_florence = np.zeros(n, dtype=bool)
+    was_in_florence[1:] = in_florence[:-1]
+    was_in_florence &= same_cust
+
+    willbe_in_florence = np.zeros(n, dtype=bool)
+    willbe_in_florence[:-1] = in_florence[1:]
+    willbe_in_florence[-1] = bool(next_in_florence)
+
+    # The next row starts a new customer, which can only be the case for the
+    # last row when the partition is followed by another one
+    last_of_cust = np.zeros(n, dtype=bool)
+    last_of_cust[:-1] = ~same_cust[1:]
+    last_of_cust[-1] = next_in_florence is not None
+
+    # Same precedence as the pandas engine, later assignments win
+    states[~same_cust & in_florence] = TRIP_FIRST
+
+    if not only_start:
+        states[same_cust & last_of_cust & in_florence] = TRIP_LAST
+
+    on_gap = same_cust & gap & in_florence
+    states[on_gap & was_in_florence] = TRIP_CONTINUE
+
+    if not only_start:
+        states[on_gap & was_in_florence & ~willbe_in_florence] = TRIP_END
+
+    states[on_gap & ~was_in_florence] = TRIP_START
+
+    return states
+
+
+def get_trip_ids(states):
+    """
+    Numbers the runs of consecutive days on a trip, the same way as the pandas
+    engine of get_trips does.
+
+    Args:
+        states (numpy.ndarray): trip state code of every day
+
+    Returns:
+        numpy.ndarray: the trip id of every day, 0 for days not on a trip
+    """
+    on_trip = states != TRIP_NONE
+
+    changed = np.ones(len(on_trip), dtype=np.int64)
+    changed[1:] = on_trip[1:] != on_trip[:-1]
+
+    return np.cumsum(changed) * on_trip
+
+
+def get_customer_partitions(cust_id, partitions):
+    """
+    Splits rows into contiguous ranges of about equal size that never split
+    the rows of a customer.
+
+    Args:
+        cust_id (numpy.ndarray): customer id of each row
+        partitions (int): the number of ranges to split the rows into
+
+    Returns:
+        list: (start, stop) row index tuples for each non-empty range
+    """
+    n = len(cust_id)
+    boundaries = np.flatnonzero(cust_id[1:] != cust_id[:-1]) + 1
+
+    targets = np.arange(1, partitions) * n // partitions
+    cuts = boundaries[np.minimum(np.searchsorted(boundaries, targets),
+                                 len(boundaries) - 1)] \
+        if len(boundaries) else np.array([], dtype=np.int64)
+
+    edges = np.unique(np.concatenate([[0], cuts, [n]]))
+
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _segment_partition(args):
+    """
+    Pool worker for segment_trip_states over one partition of customers
+    """
+    return segment_trip_states(*args)
+
+
+def segment_trip_states_parallel(cust_id, date, calls_in_florence,
+                                 calls_near_airport, only_start=False,
+                                 gap_length=3, processes=None):
+    """
+    Runs segment_trip_states over ranges of customers across a pool of
+    processes. The result is the same as a single segment_trip_states call.
+
+    Args:
+        cust_id (numpy.ndarray): customer id of each day
+        date (numpy.ndarray): datetime64 date of each day
+        calls_in_florence (numpy.ndarray): number of calls in Florence per day
+        calls_near_airport (numpy.ndarray): number of calls near the airport
+        only_start (bool): Whether to only label the start of trips
+        gap_length (int): Number of days without calls that ends a trip
+        processes (int): Number of processes, defaults to the number of CPUs
+
+    Returns:
+        numpy.ndarray: the int8 trip state code of every day
+    """
+    processes = processes or multiprocessing.cpu_count()
+    partitions = get_customer_partitions(cust_id, processes)
+
+    in_florence = (np.asarray(calls_in_florence) > 0) | \
+                  (np.asarray(calls_near_airport) > 0)
+
+    tasks = []
+    for start, stop in partitions:
+        next_in_florence = in_florence[stop] if stop < len(cust_id) else None
+        tasks.append((cust_id[start:stop], date[start:stop],
+                      calls_in_florence[start:stop],
+                      calls_near_airport[start:stop],
+                      only_start, gap_length, next_in_florence))
+
+    if len(tasks) <= 1:
+        return segment_trip_states(cust_id, date, calls_in_florence,
+                                   calls_near_airport, only_start=only_start,
+                                   gap_length=gap_length)
+
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        results = pool.map(_segment_partition, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    return np.concatenate(results)
+
+
+def _get_trips_numpy(counts, only_start=False, gap_length=3, processes=None):
+    """
+    The numpy engine of get_trips. Segments the trips on arrays and then adds
+    the same columns to counts as the pandas engine.
+    """
+    cust_id = counts['cust_id'].values
+    date = counts['date'].values
+    calls_in_florence = counts['calls_in_florence'].values
+    calls_near_airport = counts['calls_near_airport'].values
+
+    if processes is not None and processes > 1:
+        states = segment_trip_states_parallel(
+            cust_id, date, calls_in_florence, calls_near_airport,
+            only_start=only_start, gap_length=gap_length, processes=processes)
+    else:
+        states = segment_trip_states(
+            cust_id, date, calls_in_florence, calls_near_airport,
+            only_start=only_start, gap_length=gap_length)
+
+    trip_ids = get_trip_ids(states)
+
+    n = len(cust_id)
+    same_cust = np.zeros(n, dtype=bool)
+    same_cust[1:] = cust_id[1:] == cust_id[:-1]
+
+    in_florence = (calls_in_florence > 0) | (calls_near_airport > 0)
+    calls_out_florence = counts['calls'].values - calls_in_florence
+    out_florence = calls_out_florence > 0
+
+    counts['same_cust'] = same_cust.astype(object)
+    counts.loc[~same_cust, 'date_diff'] = None
+    counts['in_florence'] = in_florence
+    counts['calls_out_florence'] = calls_out_florence
+    counts['out_florence'] = out_florence
+    counts['was_in_florence'] = _shift_within_customer(in_florence, same_cust)
+    counts['willbe_in_florence'] = _shift_back(in_florence)
+    counts['was_out_florence'] = _shift_within_customer(out_florence,
+                                                        same_cust)
+    counts['willbe_out_florence'] = _shift_back(out_florence)
+    counts['trip'] = get_trip_state_categorical(states)
+    counts['on_trip'] = states != TRIP_NONE
+
+    on_trip = trip_ids != 0
+    trips = pd.DataFrame({'cust_id': cust_id[on_trip],
+                          'trip_id': trip_ids[on_trip]})
+    trips_group = trips.groupby(['cust_id', 'trip_id']).size().to_frame()
+
+    return counts, trips_group
+
+
+def _shift_within_customer(values, same_cust):
+    """
+    Object array of the previous value of each row, None on the first row of
+    each customer
+    """
+    shifted = np.empty(len(values), dtype=object)
+    shifted[1:] = values[:-1]
+    shifted[~same_cust] = None
+
+    return shifted
+
+
+def _shift_back(values):
+    """
+    Object array of the next value of each row, NaN on the last row
+    """
+    shifted = np.empty(len(values), dtype=object)
+    shifted[:-1] = values[1:]
+
+    if len(values):
+        shifted[-1] = np.nan
+
+    return shifted
+
+
+def get_trips_query(timeseries_table, only_start=False, gap_length=3):
+    """
+    Generates the query that labels every customer day with its TRIP_* code
+    and numbers the trips of each customer entirely in Postgres. The window
+    functions are partitioned by customer so Postgres does not depend on the
+    physical order of the table and can run them in parallel.
+
+    The labels follow the same rules as get_trips, except that the day after
+    the last day of a customer is treated as unknown rather than as the first
+    day of the next customer. The last day of a customer can then read 'end'
+    where get_trips reads 'continue'. The last day of the whole table is
+    labelled like the last day of any other customer, so it can read 'last'
+    where get_trips leaves it off a trip, see get_trips_sql.
+
+    Args:
+        timeseries_table (string): The name of the database table that contains
+                                   the time series data
+        only_start (bool): Whether to only label the start of trips
+        gap_length (int): Number of days without calls that ends a trip
+
+    Returns:
+        string: a query for the columns cust_id, date, trip and trip_number,
+            where trip_number numbers the trips of each customer from 1 and
+            is 0 for days not on a trip
+    """
+    if only_start:
+        end_state = ''
+        last_state = ''
+    else:
+        end_state = 'WHEN willbe_in_florence IS NOT TRUE THEN %d' % TRIP_END
+        last_state = """
+                WHEN prev_date IS NOT NULL
+                  AND willbe_in_florence IS NULL
+                  AND in_florence THEN %d""" % TRIP_LAST
+
+    return """
+        WITH days AS (
+            SELECT
+              cust_id,
+              date_ AS date,
+              (calls_in_florence_city > 0 OR calls_near_airport > 0)
+                AS in_florence,
+              LAG(date_) OVER w AS prev_date,
+              LAG(calls_in_florence_city > 0 OR calls_near_airport > 0)
+                OVER w AS was_in_florence,
+              LEAD(calls_in_florence_city > 0 OR calls_near_airport > 0)
+                OVER w AS willbe_in_florence
+            FROM %(table)s
+            WINDOW w AS (PARTITION BY cust_id ORDER BY date_)
+        ), labelled AS (
+            SELECT
+              cust_id,
+              date,
+              CASE
+                WHEN prev_date IS NOT NULL
+                  AND in_florence
+                  AND EXTRACT(DAYS FROM date - prev_date) - 1 < %(gap)d THEN
+                  CASE
+                    WHEN was_in_florence IS NOT TRUE THEN %(start)d
+                    %(end)s
+                    ELSE %(continue)d
+                  END%(last)s
+                WHEN prev_date IS NULL AND in_florence THEN %(first)d
+                ELSE %(none)d
+              END AS trip
+            FROM days
+        ), runs AS (
+            SELECT
+              cust_id,
+              date,
+              trip,
+              COALESCE(LAG(trip) OVER w, %(none)d) <> %(none)d
+                AS continues_trip
+            FROM labelled
+            WINDOW w AS (PARTITION BY cust_id ORDER BY date)
+        )
+        SELECT
+          cust_id,
+          date,
+          trip,
+          CASE WHEN trip = %(none)d THEN 0 ELSE
+            SUM(CASE WHEN trip <> %(none)d AND NOT continues_trip
+                THEN 1 ELSE 0 END)
+              OVER (PARTITION BY cust_id ORDER BY date
+                    ROWS UNBOUNDED PRECEDING)
+          END AS trip_number
+        FROM runs
+    """ % {
+        'table': timeseries_table,
+        'gap': gap_length,
+        'none': TRIP_NONE,
+        'first': TRIP_FIRST,
+        'continue': TRIP_CONTINUE,
+        'start': TRIP_START,
+        'end': end_state,
+        'last': last_state
+    }
+
+
+def get_trips_sql(db_connection, timeseries_table, only_start=False,
+                  gap_length=3, materialize_table=None):
+    """
+    The SQL engine for trip segmentation. Labels and numbers the trips in
+    Postgres with the query from get_trips_query and only reads back the
+    number of days of each trip.
+
+    The trip lengths are the same as those of get_trips except for the
+    customer on the last row of the table, ordered by customer and date.
+    get_trips never labels that row 'last', because there is no next row to
+    start another customer, so when the row is in Florence after a gap it is
+    left off a trip. Here it is labelled 'last' and counted as a trip of one
+    day, as it would be for any other customer.
+
+    Args:
+        db_connection (Psycopg.connection): The database connection
+        timeseries_table (string): The name of the database table that contains
+                                   the time series data
+        only_start (bool): Whether to only label the start of trips
+        gap_length (int): Number of days without calls that ends a trip
+        materialize_table (string): Optional name of a table to (re)create
+                                    with the labelled days, so they can be
+                                    queried later without segmenting again
+
+    Returns:
+        Pandas.DataFrame: the number of days of each trip indexed by cust_id
+            and trip_id, like the trips_group returned by get_trips. The
+            trip ids number the trips in order of customer and date.
+    """
+    trips_query = get_trips_query(timeseries_table, only_start=only_start,
+                                  gap_length=gap_length)
+
+    if materialize_table:
+        log.info('Materializing trip labels into %s' % materialize_table)
+
+        cursor = db_connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS %s' % materialize_table)
+        cursor.execute('CREATE TABLE %s AS %s' % (materialize_table,
+                                                  trips_query))
+        db_connection.commit()
+        cursor.close()
+
+        trips_query = 'SELECT * FROM %s' % materialize_table
+
+    query = """
+        SELECT
+          cust_id,
+          ROW_NUMBER() OVER (ORDER BY cust_id, trip_number) AS trip_id,
+          days
+        FROM (
+            SELECT cust_id, trip_number, COUNT(*) AS days
+            FROM (%s) AS trips
+            WHERE trip_number <> 0
+            GROUP BY cust_id, trip_number
+        ) AS trip_days
+    """ % trips_query
+
+    trips_group = pd.read_sql(query, con=db_connection)
+    trips_group = trips_group.set_index(['cust_id', 'trip_id'])
+
+    return trips_group.rename(columns={'days': 0})
+
+
+def get_trips_in_chunks(chunks, only_start=False, gap_length=3,
+                        engine='pandas', processes=None):
+    """
+    Segments trips for a stream of customer aligned chunks of time series data,
+    such as the one returned by get_daily_call_counts with a chunk_size. The
+    trip ids are offset per chunk so that they stay unique over the stream.
+
+    Args:
+        chunks (iterable): Pandas.DataFrame chunks of the time series data that
+                           never split the rows of one customer
+        only_start (bool): Whether to only label the start of trips
+        gap_length (int): Number of days without calls that ends a trip
+        engine (string): The trip segmentation engine, see get_trips
+        processes (int): Number of processes for the numpy engine
+
+    Yields:
+        tuple (Pandas.DataFrame, Pandas.DataFrame): the counts and trips_group
+            of each chunk, as returned by get_trips
+    """
+    offset = 0
+    chunks = iter(chunks)
+    chunk = next(chunks, None)
+
+    while chunk is not None:
+        next_chunk = next(chunks, None)
+
+        # The labels of the last row in a chunk depend on the row after it, so
+        # segment with the first row of the next chunk appended and drop it
+        if next_chunk is not None:
+            chunk = pd.concat([chunk, next_chunk.iloc[:1]], ignore_index=True)
+
+        counts, trips_group = get_trips(chunk, only_start=only_start,
+                                        gap_length=gap_length, engine=engine,
+                                        processes=processes)
+
+        trips_group = trips_group.reset_index()
+
+        if next_chunk is not None:
+            counts = counts.iloc[:-1]
+            next_cust_id = next_chunk['cust_id'].iloc[0]
+            trips_group = trips_group[trips_group['cust_id'] != next_cust_id]
+
+        trips_group['trip_id'] += offset
+
+        if not trips_group.empty:
+            offset = trips_group['trip_id'].max()
+
+        yield counts, trips_group.set_index(['cust_id', 'trip_id'])
+
+        chunk = next_chunk
+
+
+def concat_trips(trips):
+    """
+    Concatenates the results of get_trips_in_chunks into a single result
+
+    Args:
+        trips (iterable): tuples of counts and trips_group DataFrames
+
+    Returns:
+        tuple (Pandas.DataFrame, Pandas.DataFrame): the concatenated counts and
+            trips_group
+    """
+    all_counts = []
+    all_groups = []
+
+    for counts, trips_group in trips:
+        all_counts.append(counts)
+        all_groups.append(trips_group)
+
+    return (pd.concat(all_counts, ignore_index=True),
+            pd.concat(all_groups))
+
+
+def create_trip_state(only_start=False, gap_length=3):
+    """
+    Creates the empty per customer state for incremental trip segmentation
+
+    Args:
+        only_start (bool): Whether to only label the start of trips
+        gap_length (int): Number of days without calls that ends a trip
+
+    Returns:
+        dict: the segmentation settings, the watermark (last date read), the
+            next free trip id, the tail of every customer and the trips_group
+            of all of the trips so far
+    """
+    tails = pd.DataFrame({
+        'date': np.array([], dtype='datetime64[ns]'),
+        'in_florence': np.array([], dtype=bool),
+        'base_state': np.array([], dtype=np.int8),
+        'state': np.array([], dtype=np.int8),
+        'trip_id': np.array([], dtype=np.int64)
+    }, columns=['date', 'in_florence', 'base_state', 'state', 'trip_id'],
+        index=pd.Index([], name='cust_id'))
+
+    trips_group = pd.DataFrame(
+        {0: np.array([], dtype=np.int64)},
+        index=pd.MultiIndex.from_arrays([[], []],
+                                        names=['cust_id', 'trip_id']))
+
+    return {
+        'only_start': only_start,
+        'gap_length': gap_length,
+        'watermark': None,
+        'next_trip_id': 1,
+        'tails': tails,
+        'trips_group': trips_group
+    }
+
+
+def load_trip_state(state_path):
+    """
+    Loads the persisted incremental trip segmentation state
+
+    Args:
+        state_path (string): file path for the state pickle
+
+    Returns:
+        dict: the state as created by create_trip_state, None if there is no
+            state saved yet
+    """
+    if not os.path.isfile(state_path):
+        return None
+
+    return pd.read_pickle(state_path)
+
+
+def save_trip_state(state, state_path):
+    """
+    Persists the incremental trip segmentation state. The state is written to
+    a temporary file first so that a crash never leaves a partial state.
+
+    Args:
+        state (dict): the state as created by create_trip_state
+        state_path (string): file path for the state pickle
+    """
+    temp_path = '%s.tmp' % state_path
+    pd.to_pickle(state, temp_path)
+    os.rename(temp_path, state_path)
+
+
+def update_trips(state, counts):
+    """
+    Extends the trips in an incremental trip segmentation state with the days
+    that came after its watermark. The last day stored for each customer is
+    segmented together with the new days, so trips that were open continue
+    with the same trip id and the label of that last day is revised now that
+    it has a next day. The state is updated in place.
+
+    Every customer's last day is labelled as if another customer followed it,
+    and trip ids are numbered per run of trip days within a customer, so the
+    trip ids differ from get_trips but the trip lengths are the same.
+
+    Args:
+        state (dict): the state as created by create_trip_state
+        counts (Pandas.DataFrame): the new time series data, with the columns
+            of get_daily_call_counts and dates after the state's watermark
+
+    Returns:
+        Pandas.DataFrame: the new days with columns added for in_florence,
+            the categorical trip state, on_trip and trip_id
+    """
+    only_start = state['only_start']
+    gap_length = state['gap_length']
+    tails = state['tails']
+
+    if counts.empty:
+        return counts
+
+    cust_id = counts['cust_id'].values
+    date = counts['date'].values.astype('datetime64[ns]')
+    in_florence = (counts['calls_in_florence'].values > 0) | \
+                  (counts['calls_near_airport'].values > 0)
+
+    first_rows = np.ones(len(cust_id), dtype=bool)
+    first_rows[1:] = cust_id[1:] != cust_id[:-1]
+    customers = cust_id[first_rows]
+    tail = tails.reindex(customers[np.isin(customers, tails.index.values)])
+
+    # Put the stored last day of each customer in front of its new days
+    is_tail = np.concatenate([np.ones(len(tail), dtype=bool),
+                              np.zeros(len(cust_id), dtype=bool)])
+    order = np.lexsort((~is_tail,
+                        np.concatenate([tail.index.values, cust_id])))
+
+    all_cust_id = np.concatenate([tail.index.values, cust_id])[order]
+    all_date = np.concatenate([tail['date'].values.astype('datetime64[ns]'),
+                               date])[order]
+    all_in_florence = np.concatenate([tail['in_florence'].values.astype(bool),
+                                      in_florence])[order]
+    is_tail = is_tail[order]
+    no_calls = np.zeros(len(order), dtype=bool)
+
+    states = segment_trip_states(all_cust_id, all_date, all_in_florence,
+                                 no_calls, only_start=only_start,
+                                 gap_length=gap_length, next_in_florence=False)
+    base_states = segment_trip_states(all_cust_id, all_date, all_in_florence,
+                                      no_calls, only_start=True,
+                                      gap_length=gap_length,
+                                      next_in_florence=False)
+
+    # A stored last day now has a next day, so it loses the last label and
+    # a continued trip ends on it when the next day is out of Florence
+    tail_rows = np.flatnonzero(is_tail)
+    tail_base_states = tail['base_state'].values[order[tail_rows]]
+    tail_trip_ids = tail['trip_id'].values[order[tail_rows]]
+
+    revised = tail_base_states.astype(np.int8)
+    if not only_start:
+        revised[(tail_base_states == TRIP_CONTINUE) &
+                ~all_in_florence[tail_rows + 1]] = TRIP_END
+
+    states[tail_rows] = revised
+    base_states[tail_rows] = tail_base_states
+
+    # Runs of trip days that start on a stored day keep its trip id, all
+    # other runs get new trip ids
+    on_trip = states != TRIP_NONE
+    same_cust = np.zeros(len(order), dtype=bool)
+    same_cust[1:] = all_cust_id[1:] == all_cust_id[:-1]
+    continues = np.zeros(len(order), dtype=bool)
+    continues[1:] = on_trip[:-1]
+    run_start = on_trip & ~(continues & same_cust)
+
+    starts = np.flatnonzero(run_start)
+    stored_trip_ids = np.zeros(len(order), dtype=np.int64)
+    stored_trip_ids[tail_rows] = tail_trip_ids
+
+    run_trip_ids = stored_trip_ids[starts]
+    new_runs = ~is_tail[starts]
+    run_trip_ids[new_runs] = state['next_trip_id'] + \
+        np.arange(new_runs.sum(), dtype=np.int64)
+    state['next_trip_id'] += int(new_runs.sum())
+
+    run_index = np.maximum(np.cumsum(run_start) - 1, 0)
+    trip_ids = np.where(on_trip, run_trip_ids[run_index] if len(starts) else 0,
+                        0)
+
+    # Stored days that left their trip shorten it, new trip days lengthen it
+    left_trip = (tail_trip_ids != 0) & (revised == TRIP_NONE)
+    added = ~is_tail & on_trip
+
+    delta = pd.DataFrame({
+        'cust_id': np.concatenate([all_cust_id[tail_rows][left_trip],
+                                   all_cust_id[added]]),
+        'trip_id': np.concatenate([tail_trip_ids[left_trip],
+                                   trip_ids[added]]),
+        0: np.concatenate([-np.ones(left_trip.sum(), dtype=np.int64),
+                           np.ones(added.sum(), dtype=np.int64)])
+    }).groupby(['cust_id', 'trip_id']).sum()
+
+    trips_group = state['trips_group'].add(delta, fill_value=0)
+    state['trips_group'] = trips_group[trips_group[0] > 0].astype(np.int64)
+
+    last_rows = np.ones(len(order), dtype=bool)
+    last_rows[:-1] = ~same_cust[1:]
+
+    new_tails = pd.DataFrame({
+        'date': all_date[last_rows],
+        'in_florence': all_in_florence[last_rows],
+        'base_state': base_states[last_rows],
+        'state': states[last_rows],
+        'trip_id': trip_ids[last_rows]
+    }, columns=tails.columns, index=pd.Index(all_cust_id[last_rows],
+                                             name='cust_id'))
+
+    state['tails'] = pd.concat([tails[~tails.index.isin(new_tails.index)],
+                                new_tails])
+
+    watermark = pd.Timestamp(date.max())
+    if state['watermark'] is None or watermark > state['watermark']:
+        state['watermark'] = watermark
+
+    new_rows = np.empty(len(order), dtype=np.int64)
+    new_rows[order] = np.arange(len(order))
+    new_rows = new_rows[len(tail):]
+
+    counts['in_florence'] = in_florence
+    counts['trip'] = get_trip_state_categorical(states[new_rows])
+    counts['on_trip'] = on_trip[new_rows]
+    counts['trip_id'] = trip_ids[new_rows]
+
+    return counts
+
+
+def get_trips_incremental(db_connection, timeseries_table, state_path,
+                          only_start=False, gap_length=3, chunk_size=None):
+    """
+    Incremental trip segmentation. Reads only the days after the watermark of
+    the state persisted at state_path, extends and closes the trips with
+    them, and persists the updated state. The first run, without a persisted
+    state, reads and segments all of the days.
+
+    Args:
+        db_connection (Psycopg.connection): The database connection
+        timeseries_table (string): The name of the database table that contains
+                                   the time series data
+        state_path (string): file path for the persisted state pickle
+        only_start (bool): Whether to only label the start of trips
+        gap_length (int): Number of days without calls that ends a trip
+        chunk_size (int): Optional number of rows to read and segment at a
+                          time
+
+    Returns:
+        tuple (Pandas.DataFrame, Pandas.DataFrame): the new days labelled as
+            returned by update_trips, and the number of days of every trip so
+            far indexed by cust_id and trip_id
+    """
+    state = load_trip_state(state_path)
+
+    if state is None:
+        state = create_trip_state(only_start=only_start, gap_length=gap_length)
+    elif state['only_start'] != only_start or \
+            state['gap_length'] != gap_length:
+        raise ValueError('The trip state at %s was made with different '
+                         'segmentation settings' % state_path)
+
+    counts = get_daily_call_counts(db_connection, timeseries_table,
+                                   chunk_size=chunk_size,
+                                   since=state['watermark'])
+
+    if chunk_size:
+        chunks = [update_trips(state, chunk) for chunk in counts]
+        counts = pd.concat(chunks, ignore_index=True) if chunks \
+            else pd.DataFrame()
+    else:
+        counts = update_trips(state, counts)
+
+    save_trip_state(state, state_path)
+
+    return counts, state['trips_group']
+
+
 def get_length_gaps_between_trips(grouped_counts):
     """
     Gets the frequency of length of gaps between trips for a customer
@@ -267,10 +1265,9 @@ def get_trip_length_for_onetime_visitors(grouped_counts):
 
 
 def main():
-    connection = dbutils.connect()
-
-    italian_trips, italian_grouped = get_italian_trips(connection)
-    foreign_trips, foreign_grouped = get_foreign_trips(connection)
+    with dbutils.session() as connection:
+        italian_trips, italian_grouped = get_italian_trips(connection)
+        foreign_trips, foreign_grouped = get_foreign_trips(connection)
 
     italian_lengths = get_trip_length_for_onetime_visitors(italian_grouped)
     foreign_lengths = get_trip_length_for_onetime_visitors(foreign_grouped)
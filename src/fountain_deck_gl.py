@@ -3,15 +3,22 @@ Takes Pandas formatted data and creates JSON data files formatted to be consumed
 by the fountain visualization made with Deck.GL
 """
 
-from utils.database import dbutils
+from utils.database import dbutils, dbcache
+from utils.export import jsonutils
 from features import network_analysis as na
 from output import cdr_fountain as cdr
 import json
 import os
 import pandas as pd
+import numpy as np
 import math
 
 
+# Number of decimals kept for floats in the JSON outputs, about 1cm for
+# coordinates, the same as the node circles are rounded to
+JSON_PRECISION = 7
+
+
 class FountainType:
     MUSEUM = 1
     CDR = 2
@@ -52,7 +59,33 @@ def create_geojson(
         tuple (dict, dict): the geojson object containing all of the feature
             definitions and the object containing all the location names by id
     """
-    location_dict = {
+    location_dict = create_location_dict()
+
+    features = list(create_features(nodes, edges, location_dict,
+                                    to_col_name=to_col_name,
+                                    from_col_name=from_col_name,
+                                    weight_col_name=weight_col_name,
+                                    geometries=geometries,
+                                    props=props,
+                                    fountain_type=fountain_type))
+
+    geojson = {
+        'type': 'FeatureCollection',
+        'features': features
+    }
+
+    return geojson, location_dict
+
+
+def create_location_dict():
+    """
+    Create the dictionary of location names with the entries for the nodes
+    that aren't locations
+
+    Returns:
+        dict: the names and printable names of the source, start and end nodes
+    """
+    return {
         'source': {
             'name': 'Unknown',
             'fullName': 'Unknown'
@@ -69,6 +102,40 @@ def create_geojson(
         }
     }
 
+
+def create_features(
+        nodes,
+        edges,
+        location_dict,
+        to_col_name="to",
+        from_col_name="from",
+        weight_col_name="weight",
+        geometries=None,
+        props=None,
+        fountain_type=FountainType.CDR
+):
+    """
+    Create the geojson features of the fountain one node at a time, so that
+    they can be written out without holding all of them in memory. The names
+    of each node are added to location_dict as its feature is made.
+
+    Args:
+        nodes (list): The list of nodes that will be used for the visualization.
+            Each node in the list is a tuple of (id, lat, lon, name, full_name)
+        edges (Pandas.DataFrame): The weight for each edge to and from a pair
+            of nodes contained in the node list, as for create_geojson
+        location_dict (dict): dictionary of all of the names and printable names
+            for every location by node_id, made with create_location_dict
+        to_col_name (string): Name of the edges DataFrame column for to node
+        from_col_name (string): Name of the edges DataFrame column for from node
+        weight_col_name (string): Name of the edges DataFrame column for weight
+        geometries (dict): polygon geometry and area for each unique region id
+        props (dict): Additional properties to include in a geojson Feature
+        fountain_type (int): Type of fountain to create feature for
+
+    Yields:
+        dict: the geojson feature definition object of the next node
+    """
     groupby_names = [to_col_name, from_col_name, weight_col_name]
     group_perc = create_percentage_column(edges, 'perc_to', weight_col_name,
                                           groupby_names)
@@ -76,17 +143,19 @@ def create_geojson(
     updated_edges = create_percentage_column(group_perc, 'perc_from',
                                              weight_col_name, groupby_names)
 
-    features = [create_feature(f, updated_edges, location_dict,
-                               geometries=geometries,
-                               props=props,
-                               fountain_type=fountain_type) for f in nodes]
-
-    geojson = {
-        'type': 'FeatureCollection',
-        'features': features
-    }
+    flow_index = create_flow_index(updated_edges, to_col_name=to_col_name,
+                                   from_col_name=from_col_name,
+                                   weight_col_name=weight_col_name)
 
-    return geojson, location_dict
+    for node in nodes:
+        yield create_feature(node, updated_edges, location_dict,
+                             geometries=geometries,
+                             props=props,
+                             to_col_name=to_col_name,
+                             from_col_name=from_col_name,
+                             weight_col_name=weight_col_name,
+                             fountain_type=fountain_type,
+                             flow_index=flow_index)
 
 
 def create_percentage_column(df, perc_col_name, weight_col_name, group_names):
@@ -106,10 +175,11 @@ def create_percentage_column(df, perc_col_name, weight_col_name, group_names):
     df[perc_col_name] = df[weight_col_name]
     group_sum = df.groupby(group_names).agg({perc_col_name: 'sum'})
 
-    group_perc = group_sum.groupby(level=0) \
-        .apply(lambda x: 100 * x / float(x.sum()))
+    totals = group_sum.groupby(level=0)[perc_col_name].transform('sum')
+    group_sum[perc_col_name] = 100 * group_sum[perc_col_name] / \
+        totals.astype(float)
 
-    return group_perc.reset_index()
+    return group_sum.reset_index()
 
 
 def process_geometries_geojson(geometries):
@@ -133,6 +203,64 @@ def process_geometries_geojson(geometries):
     return geo_dict
 
 
+def normalize_node_ids(ids):
+    """
+    Converts node ids to the strings used as node ids in the geojson. Float
+    ids, e.g. tower ids read into a float column, lose their decimals.
+
+    Args:
+        ids (Pandas.Series): The node ids
+
+    Returns:
+        list: The node id strings
+    """
+    return [str(int(node_id)) if isinstance(node_id, float) else str(node_id)
+            for node_id in ids.tolist()]
+
+
+def create_flow_index(edges, to_col_name="to", from_col_name="from",
+                      weight_col_name="weight"):
+    """
+    Indexes the flows in and out of every node in a single pass over the
+    edges, for create_feature. The flows of each node are in the order of the
+    edges, the same as create_flows makes them.
+
+    Args:
+        edges (Pandas.DataFrame): The weight for each edge to and from a pair
+            of nodes, with the perc_to and perc_from columns added by
+            create_geojson
+        to_col_name (string): Name of the edges DataFrame column for to node
+        from_col_name (string): Name of the edges DataFrame column for from node
+        weight_col_name (string): Name of the edges DataFrame column for weight
+
+    Returns:
+        dict: the inFlows and outFlows objects by node id in 'in' and 'out',
+            and the total weight of the edges into each node in 'in_weight'
+    """
+    in_flows = {}
+    out_flows = {}
+    in_weight = {}
+
+    rows = zip(normalize_node_ids(edges[to_col_name]),
+               normalize_node_ids(edges[from_col_name]),
+               edges[weight_col_name].tolist(),
+               edges['perc_to'].tolist(),
+               edges['perc_from'].tolist())
+
+    for to_id, from_id, weight, perc_to, perc_from in rows:
+        in_flows.setdefault(to_id, {})[from_id] = {
+            'weight': weight,
+            'percentage': perc_to
+        }
+        out_flows.setdefault(from_id, {})[to_id] = {
+            'weight': weight,
+            'percentage': perc_from
+        }
+        in_weight[to_id] = in_weight.get(to_id, 0) + weight
+
+    return {'in': in_flows, 'out': out_flows, 'in_weight': in_weight}
+
+
 def create_feature(
         datum,
         edges,
@@ -142,7 +270,8 @@ def create_feature(
         to_col_name="to",
         from_col_name="from",
         weight_col_name="weight",
-        fountain_type=FountainType.CDR
+        fountain_type=FountainType.CDR,
+        flow_index=None
 ):
     """
     Create a feature geojson object for the specified node in the fountain
@@ -162,6 +291,8 @@ def create_feature(
         weight_col_name (string): Name of the edges DataFrame column for to node
             Only used for creating geojson from CDR data, not museums
         fountain_type (int): Type of fountain to create feature for
+        flow_index (dict): Optional flows of every node made with
+            create_flow_index, which saves scanning the edges for each node
 
     Returns (dict): a geojson feature definition object for the supplied datum
     """
@@ -171,12 +302,15 @@ def create_feature(
     lon = float(lon)
     node_id = str(node_id)
 
-    edges[to_col_name] = edges[to_col_name].apply(
-        lambda row: str(int(row)) if isinstance(row, float) else str(row))
-    edges[from_col_name] = edges[from_col_name].apply(
-        lambda row: str(int(row)) if isinstance(row, float) else str(row))
+    flows = None
+    if flow_index is not None:
+        flows = (flow_index['in'].get(node_id, {}),
+                 flow_index['out'].get(node_id, {}))
+    else:
+        edges[to_col_name] = normalize_node_ids(edges[to_col_name])
+        edges[from_col_name] = normalize_node_ids(edges[from_col_name])
 
-    edges = edges.loc[(edges[to_col_name] == node_id) | (edges[from_col_name] == node_id)]
+        edges = edges.loc[(edges[to_col_name] == node_id) | (edges[from_col_name] == node_id)]
 
     if geometries is not None and node_id in geometries:
         geometry = geometries[node_id]['geometry']
@@ -188,8 +322,12 @@ def create_feature(
         start_props = props[node_id]
 
     if fountain_type is FountainType.MUSEUM:
-        total_fc_visits = edges[(edges[to_col_name] == node_id)].sum()
-        total_fc_visits = str(int(total_fc_visits[weight_col_name]))
+        if flow_index is not None:
+            total_fc_visits = flow_index['in_weight'].get(node_id, 0)
+        else:
+            total_fc_visits = edges[(edges[to_col_name] == node_id)].sum()
+            total_fc_visits = total_fc_visits[weight_col_name]
+        total_fc_visits = str(int(total_fc_visits))
         if start_props is not None:
             start_props['totalFcVisits'] = total_fc_visits
         else:
@@ -199,7 +337,8 @@ def create_feature(
         'type': 'Feature',
         'geometry': geometry,
         'properties': create_properties(node_id, name, full_name, [lon, lat],
-                                        edges, location_dict, props=start_props)
+                                        edges, location_dict, props=start_props,
+                                        flows=flows)
     }
 
     return feature
@@ -284,7 +423,8 @@ def create_properties(
         centroid,
         edges,
         location_dict,
-        props=None
+        props=None,
+        flows=None
 ):
     """
     Create the additional properties object for the geojson. This contains
@@ -304,11 +444,16 @@ def create_properties(
         location_dict (dict): dictionary of all of the names and printable names
             for every location by id.
         props (dict): the optional starting properties for each unique id node
+        flows (tuple): the optional in and out flows of the node, instead of
+            finding them in the edges with create_flows
 
     Returns:
         dict: the newly created properties object for the geojson feature
     """
-    in_flows, out_flows = create_flows(edges, node_id)
+    if flows is not None:
+        in_flows, out_flows = flows
+    else:
+        in_flows, out_flows = create_flows(edges, node_id)
 
     if props is None:
         props = {}
@@ -399,33 +544,36 @@ def format_cdr_properties(
 
     Returns:
         (dict): object with a key for each tower node id and a value that is an
-            object with values for area and density of that node
+            object with values for area and density of that node, None for a
+            density that is missing
     """
 
-    props = {}
-    ids = densities[id_col_name].unique()
-
-    for tower_id in ids:
-        area = None
-        tower_id = str(int(tower_id))
+    tower_ids = densities[id_col_name].astype(int).astype(str).values
+    first_match = ~pd.Series(tower_ids).duplicated().values
+    tower_ids = tower_ids[first_match]
 
-        if tower_id in geometries:
-            area = geometries[tower_id]['area']
+    areas = dict((tower_id, geometry['area'])
+                 for tower_id, geometry in geometries.items())
+    area = np.array([areas.get(tower_id) for tower_id in tower_ids],
+                    dtype=float)
 
-        density = None
-        densities[id_col_name] = densities[id_col_name].apply(int).apply(str)
+    # Density per unit of area where the area is known, then scaled so that
+    # the densest tower has a density of 1
+    density = densities[density_col_name].values[first_match].astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = np.where(area > 0, density / area, density)
 
-        if area is not None and area > 0:
-            densities[density_col_name] = densities[density_col_name] / area
+    maximum = np.nanmax(density) if np.isfinite(density).any() else 1.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        density = density / (maximum or 1.0)
 
-        maximum = densities[density_col_name].max()
-        densities[density_col_name] = densities[density_col_name] / maximum
-
-        first_match = densities[densities[id_col_name] == tower_id].head(1)
-        if not first_match.empty:
-            density = first_match[density_col_name].iloc[0]
+    props = {}
+    for tower_id, tower_density in zip(tower_ids, density.tolist()):
+        if math.isnan(tower_density):
+            tower_density = None
 
-        props[tower_id] = {'area': area, 'density': density}
+        props[tower_id] = {'area': areas.get(tower_id),
+                           'density': tower_density}
 
     return props
 
@@ -452,24 +600,19 @@ def format_firenzecard_properties(
             aka total visitors, to that museum.
     """
 
-    props = {}
-    ids = museums[id_col_name].unique()
-
-    for museum_id in ids:
-        museum_id = str(int(museum_id))
-        museums[id_col_name] = museums[id_col_name].apply(str)
-        first_match = museums[museums[id_col_name] == museum_id].head(1)
-
-        total_visits = None
-        if not first_match.empty:
-            total_visits = first_match[visitors_col_name].iloc[0]
+    first_match = museums.drop_duplicates(id_col_name)
+    museum_ids = first_match[id_col_name].astype(int).astype(str)
+    total_visits = first_match[visitors_col_name].tolist()
 
-        props[str(museum_id)] = {'totalVisits': total_visits}
+    props = {}
+    for museum_id, visits in zip(museum_ids, total_visits):
+        props[museum_id] = {'totalVisits': visits}
 
     return props
 
 
-def firenzecard_main(db_connection, fountain_json_path, dict_path):
+def firenzecard_main(db_connection, fountain_json_path, dict_path,
+                     precision=None, compress=()):
     """
     Main function for producing the appropriate JSON files to feed into the
     Firenze card museum fountain visualization made with Deck.GL
@@ -478,6 +621,10 @@ def firenzecard_main(db_connection, fountain_json_path, dict_path):
         db_connection (Psycopg.connection): The database connection
         fountain_json_path (string): file path for the fountain JSON output
         dict_path (string): file path for the node name dictionary JSON output
+        precision (int): optional number of decimals to round floats to in
+            the JSON output
+        compress (list): compressed copies of the JSON output to write next
+            to it, any of 'gzip' and 'brotli'
     """
 
     query = """
@@ -516,7 +663,7 @@ def firenzecard_main(db_connection, fountain_json_path, dict_path):
             ORDER BY museum_id ASC
             """
 
-    museum_totals = pd.read_sql(museum_totals_query, con=db_connection)
+    museum_totals = dbcache.read_sql_cached(museum_totals_query, db_connection)
     props = format_firenzecard_properties(museum_totals)
 
     network_query = """
@@ -528,25 +675,25 @@ def firenzecard_main(db_connection, fountain_json_path, dict_path):
     FROM optourism.firenze_card_logs
     """
 
-    network_df = pd.read_sql(network_query, con=db_connection)
+    network_df = dbcache.read_sql_cached(network_query, db_connection)
     network_df['total_people'] = 1
     dynamic_edges = na.make_dynamic_firenze_card_edgelist(network_df,
                                                           location='museum_id')
 
     edges = na.make_static_firenze_card_edgelist(dynamic_edges)
-    geojson, location_dict = create_geojson(records, edges, props=props,
-                                            fountain_type=FountainType.MUSEUM)
-
-    with open(fountain_json_path, 'w') as outfile:
-        json.dump(geojson, outfile, indent=2)
+    location_dict = create_location_dict()
+    features = create_features(records, edges, location_dict, props=props,
+                               fountain_type=FountainType.MUSEUM)
 
-    with open(dict_path, 'w') as outfile:
-        json.dump(location_dict, outfile, indent=2)
+    jsonutils.write_feature_collection(features, fountain_json_path,
+                                       precision=precision, compress=compress)
+    jsonutils.write_json(location_dict, dict_path, compress=compress)
 
 
 def cdr_main(db_connection, table_name, fountain_json_path, dict_path,
-             edges_pickle, density_pickle, end_nodes_path=None,
-             start_nodes_path=None, geojson_path=None):
+             edges_pickle=None, density_pickle=None, end_nodes_path=None,
+             start_nodes_path=None, geojson_path=None, chunk_size=None,
+             precision=None, compress=()):
     """
     Main function for producing the appropriate JSON files to feed into the
     Telecom CDR fountain visualization made with Deck.GL
@@ -557,13 +704,21 @@ def cdr_main(db_connection, table_name, fountain_json_path, dict_path,
             which to make the nodes and edges
         fountain_json_path (string): file path for the fountain JSON output
         dict_path (string): file path for the node name dictionary JSON output
-        edges_pickle (string): file path for pickle object with edges
-        density_pickle (string): file path for pickle object with node densities
+        edges_pickle (string): optional file path for pickle object with
+            edges, read instead of computing the edges when it exists
+        density_pickle (string): optional file path for pickle object with
+            node densities, read along with edges_pickle
         end_nodes_path (string): file path for output csv of most common end
             nodes in ranked order
         start_nodes_path (string): file path for output csv of most common start
             nodes in ranked order
         geojson_path (string): file path for tower voronoi geojson definitions
+        chunk_size (int): Optional number of dwell time records to process at
+            a time, for tables too large to hold in memory
+        precision (int): optional number of decimals to round floats to in
+            the JSON output
+        compress (list): compressed copies of the JSON output to write next
+            to it, any of 'gzip' and 'brotli'
     """
 
     query = """
@@ -598,42 +753,43 @@ def cdr_main(db_connection, table_name, fountain_json_path, dict_path,
     region_records = cursor.fetchall()
     all_records = records + region_records
 
-    if os.path.isfile(edges_pickle) and os.path.isfile(density_pickle):
+    if edges_pickle and density_pickle and os.path.isfile(edges_pickle) \
+            and os.path.isfile(density_pickle):
         edges = pd.read_pickle(edges_pickle)
         density = pd.read_pickle(density_pickle)
 
     else:
-        edges, density = cdr.get_network_edges(db_connection, table_name,
-                                               end_file_path=end_nodes_path,
-                                               start_file_path=start_nodes_path)
-        edges.to_pickle(edges_pickle)
-        density.to_pickle(density_pickle)
+        edges, density = cdr.get_network_edges(
+            db_connection, table_name, end_file_path=end_nodes_path,
+            start_file_path=start_nodes_path, chunk_size=chunk_size)
+
+        if edges_pickle and density_pickle:
+            edges.to_pickle(edges_pickle)
+            density.to_pickle(density_pickle)
 
     with open(geojson_path) as f:
         voronoi_geometries = process_geometries_geojson(json.load(f))
 
     props = format_cdr_properties(voronoi_geometries, density)
-    geojson, location_dict = create_geojson(all_records, edges,
-                                            props=props,
-                                            geometries=voronoi_geometries)
+    location_dict = create_location_dict()
+    features = create_features(all_records, edges, location_dict,
+                               props=props, geometries=voronoi_geometries)
 
-    with open(fountain_json_path, 'w') as outfile:
-        json.dump(geojson, outfile, indent=2)
-
-    with open(dict_path, 'w') as outfile:
-        json.dump(location_dict, outfile, indent=2)
+    jsonutils.write_feature_collection(features, fountain_json_path,
+                                       precision=precision, compress=compress)
+    jsonutils.write_json(location_dict, dict_path, compress=compress)
 
 
 if __name__ == '__main__':
-    conn = dbutils.connect()
-
     curr_dir = os.path.dirname(os.path.abspath(__file__))
 
     output_path = os.path.join(curr_dir, 'output',
                                'museum_fountain.json')
     location_dict_path = os.path.join(curr_dir, 'output',
                                       'museum_dict.json')
-    firenzecard_main(conn, output_path, location_dict_path)
+    with dbutils.session() as conn:
+        firenzecard_main(conn, output_path, location_dict_path,
+                         precision=JSON_PRECISION, compress=['gzip'])
 
     cdr_path = os.path.join(curr_dir, 'output', 'cdr_daytripper_fountain.json')
     cdr_dict_path = os.path.join(curr_dir, 'output', 'cdr_daytripper_dict.json')
@@ -651,6 +807,8 @@ if __name__ == '__main__':
 
     table_name = 'optourism.foreigners_daytripper_dwell_time'
 
-    cdr_main(conn, table_name, cdr_path, cdr_dict_path, edges_pickle,
-             density_pickle, end_nodes_path=end_node_csv,
-             start_nodes_path=start_node_csv, geojson_path=geojson_path)
+    with dbutils.session() as conn:
+        cdr_main(conn, table_name, cdr_path, cdr_dict_path, edges_pickle,
+                 density_pickle, end_nodes_path=end_node_csv,
+                 start_nodes_path=start_node_csv, geojson_path=geojson_path,
+                 precision=JSON_PRECISION, compress=['gzip'])
@@ -2,7 +2,7 @@ import pandas as pd
 import numpy as np
 import os
 import json
-from ..utils.database import dbutils
+from ..utils.database import dbutils, dbcache
 
 
 def get_dwell_time_df(db_connection, table_name):
@@ -18,8 +18,29 @@ def get_dwell_time_df(db_connection, table_name):
         FROM %(name)s
     """ % {'name': table_name}
 
-    users = pd.read_sql(query, con=db_connection)
+    users = dbcache.read_sql_cached(query, db_connection,
+                                    reader=dbutils.read_sql_bulk,
+                                    dtype={'cust_id': np.int64,
+                                           'tower_id': np.int64},
+                                    timedelta_columns=['dwell_time'])
 
+    return get_transitions(users)
+
+
+def get_transitions(users):
+    """
+    Merges consecutive dwell records of a customer at the same tower and keeps
+    the stays of at least 20 minutes that are in Florence, or that are just
+    before or after a stay in Florence
+
+    Args:
+        users (Pandas.DataFrame): The dwell records as read by
+            get_dwell_time_df, ordered by customer and time
+
+    Returns:
+        Pandas.DataFrame: The stays with the columns cust_id, tower_id,
+            near_airport, dwell_time and in_florence
+    """
     users['key'] = (
     (users['tower_id'] != users['prev_tower_id']) | (
     users['cust_id'] != users['prev_cust_id'])).astype(int).cumsum()
@@ -28,10 +49,9 @@ def get_dwell_time_df(db_connection, table_name):
         sort=False)['dwell_time'].sum().reset_index()
 
     transitions = groups.loc[groups['dwell_time'] >= pd.Timedelta('20 minutes')]
-    transitions['in_florence'] = transitions.apply(
-        lambda x: (x['in_florence_comune'] | x['near_airport']), axis=1)
-    del transitions['in_florence_comune']
-    del transitions['key']
+    transitions = transitions.drop(['in_florence_comune', 'key'], axis=1)
+    transitions['in_florence'] = groups['in_florence_comune'] | \
+        groups['near_airport']
 
     curated = transitions.loc[(transitions['in_florence'] == True) |
                               ((transitions['cust_id'] == transitions[
@@ -61,21 +81,85 @@ def get_tower_vertices(db_connection, table_name):
         ON towers.id = cdr.tower_id
     """ % {'name': table_name}
 
-    return pd.read_sql(query, con=db_connection)
+    return dbcache.read_sql_cached(query, db_connection)
 
 
-def get_network_edges(connection,
-                      table_name='optourism.foreigners_daytripper_dwell_time',
-                      end_file_path=None,
-                      start_file_path=None,
-                      density_file_path=None):
+def get_tower_regions(users, tower_vertices):
+    """
+    Gets the node each stay belongs to in the fountain: the tower itself for
+    stays in Florence, and the region of the tower for stays outside of it
+
+    Args:
+        users (Pandas.DataFrame): The stays as returned by get_dwell_time_df
+        tower_vertices (Pandas.DataFrame): The towers as returned by
+            get_tower_vertices. The first region listed for a tower is used.
+
+    Returns:
+        Pandas.Series: The tower id or region name of each stay
+    """
+    region_by_tower = tower_vertices.drop_duplicates('tower_id').set_index(
+        'tower_id')['region_name']
+    regions = users['tower_id'].map(region_by_tower)
+
+    return pd.Series(np.where(users['in_florence'] == True,
+                              users['tower_id'].astype(object), regions),
+                     index=users.index)
+
+
+def get_dwell_time_chunks(db_connection, table_name, chunk_size=500000):
+    """
+    Reads the dwell time records in chunks that never split the records of a
+    customer, and merges each chunk into stays with get_transitions. Runs of
+    records at the same tower never cross customers, so every chunk is
+    processed on its own.
+
+    Args:
+        db_connection (Psycopg.connection): The database connection
+        table_name (string): The name of the dwell time table
+        chunk_size (int): Number of records to read from the database at a
+            time
+
+    Yields:
+        Pandas.DataFrame: The stays of the customers in the next chunk
+    """
+    query = """
+      SELECT
+          cust_id,
+          prev_cust_id,
+          tower_id,
+          prev_tower_id,
+          dwell_time,
+          near_airport,
+          in_florence_comune
+        FROM %(name)s
+        ORDER BY cust_id, date_time_m
+    """ % {'name': table_name}
+
+    for users in dbutils.read_sql_chunks(query, db_connection,
+                                         chunk_size=chunk_size):
+        users['dwell_time'] = pd.to_timedelta(users['dwell_time'])
+
+        yield get_transitions(users)
 
-    users = get_dwell_time_df(connection, table_name)
-    tower_vertices = get_tower_vertices(connection, table_name)
 
-    users['tower_region'] = users.apply(lambda x: tower_vertices.loc[
-        tower_vertices['tower_id'] == x['tower_id']].iloc[0]['region_name'] if
-    x['in_florence'] == False else x['tower_id'], axis=1)
+def get_network_counts(users, tower_vertices):
+    """
+    Counts the edges, dwell time per tower and first and last locations in
+    Florence of a set of customers. The counts of disjoint sets of customers
+    can be combined with sum_network_counts.
+
+    Args:
+        users (Pandas.DataFrame): The stays as returned by get_transitions
+        tower_vertices (Pandas.DataFrame): The towers as returned by
+            get_tower_vertices
+
+    Returns:
+        dict: Pandas.Series of the number of moves per ('to', 'from') node
+            pair in 'edges', the minutes spent per Florence tower in
+            'density', and the number of customers by the node they start
+            and end their visit at in 'starts' and 'ends'
+    """
+    users['tower_region'] = get_tower_regions(users, tower_vertices)
 
     users['prev_tower_id'] = users['tower_region'].shift(1)
 
@@ -85,45 +169,124 @@ def get_network_edges(connection,
     filtered = users.loc[(users['in_florence'] == True) &
                               (users['tower_region'] != users['prev_tower_id'])]
 
-    grouping = filtered.groupby(
-        ['tower_region', 'prev_tower_id']).count().reset_index()
-
-    grouping.rename(columns={'cust_id': 'weight', 'tower_region': 'to', 'prev_tower_id': 'from'}, inplace=True)
-    edges = grouping.filter(['to', 'from', 'weight'], axis=1)
+    edges = filtered.groupby(['tower_region', 'prev_tower_id']).size()
 
     users['dwell_time_minutes'] = users['dwell_time'] / np.timedelta64(1, 'm')
-    relative_region_density = users.loc[users['in_florence'] == True].groupby(
-        'tower_id').sum()
+    in_florence = users.loc[users['in_florence'] == True]
+
+    density = in_florence.groupby('tower_id')['dwell_time_minutes'].sum()
+
+    customers = in_florence.groupby('cust_id')['tower_region']
+    starts = customers.first().value_counts()
+    ends = customers.last().value_counts()
+
+    return {'edges': edges, 'density': density, 'starts': starts,
+            'ends': ends}
+
+
+def sum_network_counts(counts):
+    """
+    Adds up the counts of get_network_counts for disjoint sets of customers
+
+    Args:
+        counts (list): The dicts returned by get_network_counts
+
+    Returns:
+        dict: The summed counts, in the format of get_network_counts
+    """
+    summed = {}
+
+    for name in ['edges', 'density', 'starts', 'ends']:
+        series = pd.concat([count[name] for count in counts])
+        summed[name] = series.groupby(
+            level=list(range(series.index.nlevels)), sort=False).sum()
+
+    return summed
+
+
+def get_location_weights(counts):
+    """
+    Ranks nodes by the number of customers that start or end their visit at
+    them, like get_most_common_location
 
-    filtered_density = relative_region_density.filter(
-        ['tower_id', 'dwell_time_minutes'])
-    sorted_density = filtered_density.sort_values('dwell_time_minutes',
-                                                  ascending=False)
+    Args:
+        counts (Pandas.Series): The number of customers per node, as in the
+            'starts' and 'ends' of get_network_counts
 
-    sorted_density = sorted_density.reset_index('tower_id')
-    sorted_density.rename(columns={'dwell_time_minutes': 'density'}, inplace=True)
+    Returns:
+        Pandas.DataFrame: The columns tower_region, weight and percentage,
+            ordered by descending weight
+    """
+    weights = pd.DataFrame({'tower_region': counts.index.values,
+                            'weight': counts.values},
+                           columns=['tower_region', 'weight'])
+    weights = weights.sort_values('tower_region').reset_index(drop=True)
+    weights = weights.sort_values('weight', ascending=False)
+    weights['percentage'] = weights['weight'] / weights['weight'].sum()
+
+    return weights
+
+
+def get_network_edges(connection,
+                      table_name='optourism.foreigners_daytripper_dwell_time',
+                      end_file_path=None,
+                      start_file_path=None,
+                      density_file_path=None,
+                      chunk_size=None):
+    """
+    Gets the edges between towers and regions that customers move along and
+    the time spent at each tower in Florence, for the fountain visualization
+
+    Args:
+        connection (Psycopg.connection): The database connection
+        table_name (string): The name of the dwell time table
+        end_file_path (string): Optional file path for a CSV of the nodes
+            customers most commonly end their visit at
+        start_file_path (string): Optional file path for a CSV of the nodes
+            customers most commonly start their visit at
+        density_file_path (string): Optional file path for a CSV of the
+            density per tower
+        chunk_size (int): Optional number of dwell time records to read and
+            count at a time, so that the whole table is never held in memory
+
+    Returns:
+        tuple: The edges with the columns to, from and weight, and the
+            density with the columns tower_id and density
+    """
+    tower_vertices = get_tower_vertices(connection, table_name)
+
+    if chunk_size:
+        chunks = get_dwell_time_chunks(connection, table_name, chunk_size)
+    else:
+        chunks = [get_dwell_time_df(connection, table_name)]
+
+    counts = None
+    for users in chunks:
+        chunk_counts = get_network_counts(users, tower_vertices)
+        counts = chunk_counts if counts is None else \
+            sum_network_counts([counts, chunk_counts])
+
+    edges = counts['edges'].groupby(level=[0, 1]).sum().reset_index()
+    edges.columns = ['to', 'from', 'weight']
+
+    sorted_density = counts['density'].sort_index().sort_values(
+        ascending=False).reset_index()
+    sorted_density.columns = ['tower_id', 'density']
 
     if density_file_path:
         sorted_density.to_csv(density_file_path, index=False)
 
     if end_file_path:
-        ending = users[users['in_florence'] == True].groupby(['cust_id']).last()
-        end_weights = get_most_common_location(ending)
-        end_weights['percentage'] = end_weights['weight'] / end_weights[
-            'weight'].sum()
-
+        end_weights = get_location_weights(counts['ends'])
         end_weights.to_csv(end_file_path, index=False)
 
     if start_file_path:
-        beginning = users[users['in_florence'] == True].groupby(['cust_id']).first()
-        start_weights = get_most_common_location(beginning)
-        start_weights['percentage'] = start_weights['weight'] / start_weights['weight'].sum()
-
+        start_weights = get_location_weights(counts['starts'])
         start_weights.to_csv(start_file_path, index=False)
 
     return edges, sorted_density
 
 
 if __name__ == '__main__':
-    connection = dbutils.connect()
-    edges, densities = get_network_edges(connection)
+    with dbutils.session() as connection:
+        edges, densities = get_network_edges(connection)
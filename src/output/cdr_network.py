@@ -6,26 +6,23 @@ from ..utils.database import dbutils
 
 # TODO: Cleanup
 def hourly_graph():
-    connection = dbutils.connect()
-
-    foreigners = pd.read_sql("""
-        SELECT 
-          prev_tower_id, 
-          tower_id, 
-          count(*) AS weight 
-        FROM optourism.foreigners_path_records_joined 
-        WHERE tower_id != prev_tower_id 
-          AND EXTRACT(HOUR FROM date_time_m) = 22 
-          AND delta < (INTERVAL '30 minutes') 
-        GROUP BY tower_id, prev_tower_id
-    """, con=connection)
-
-    tower_vertices = pd.read_sql("""
-        SELECT DISTINCT tower_id, lat, lon 
-        FROM optourism.foreigners_path_records_joined
-    """, con=connection)
-
-    connection.close()
+    with dbutils.session() as connection:
+        foreigners = pd.read_sql("""
+            SELECT 
+              prev_tower_id, 
+              tower_id, 
+              count(*) AS weight 
+            FROM optourism.foreigners_path_records_joined 
+            WHERE tower_id != prev_tower_id 
+              AND EXTRACT(HOUR FROM date_time_m) = 22 
+              AND delta < (INTERVAL '30 minutes') 
+            GROUP BY tower_id, prev_tower_id
+        """, con=connection)
+
+        tower_vertices = pd.read_sql("""
+            SELECT DISTINCT tower_id, lat, lon 
+            FROM optourism.foreigners_path_records_joined
+        """, con=connection)
 
     foreigners['tower_id'] = foreigners['tower_id'].apply(
         lambda x: 'tower-%s' % x)
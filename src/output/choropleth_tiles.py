@@ -0,0 +1,331 @@
+"""
+Renders the Voronoi choropleth of the tower activity as a pyramid of web map
+tiles, one MBTiles file per frame, e.g. per hour of the day. The report can
+then pan, zoom and scrub through the frames without rendering whole images.
+
+Each tile is rendered for every frame at once: the cell under each pixel is
+looked up once, after which a frame is only an index into the colors of the
+cells for that frame.
+"""
+
+import io
+import math
+import multiprocessing
+import os
+import sqlite3
+
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image
+
+from . import florence_city_map
+from ..utils.plotting import gpdutils
+from ..utils.database import dbutils
+
+TILE_SIZE = 256
+MIN_ZOOM = 10
+MAX_ZOOM = 16
+
+# Number of MBTiles files written to at the same time. More frames than this
+# are rendered in several passes over the tiles.
+MAX_OPEN_FRAMES = 64
+
+_tile_cells = None
+_tile_colors = None
+
+
+def get_tile_range(bounds, zoom):
+    """
+    Gets the web map tiles covering a bounding box
+
+    Args:
+        bounds (tuple): the (west, south, east, north) bounds in degrees
+        zoom (int): the zoom level
+
+    Returns:
+        tuple (range, range): the x and y coordinates of the tiles
+    """
+    west, south, east, north = bounds
+    tiles = 2 ** zoom
+
+    def tile_x(lon):
+        return int((lon + 180.0) / 360.0 * tiles)
+
+    def tile_y(lat):
+        lat = math.radians(lat)
+        return int((1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) /
+                    math.pi) / 2.0 * tiles)
+
+    return (range(max(tile_x(west), 0), min(tile_x(east), tiles - 1) + 1),
+            range(max(tile_y(north), 0), min(tile_y(south), tiles - 1) + 1))
+
+
+def get_tile_pixels(x, y, zoom, size=TILE_SIZE):
+    """
+    Gets the coordinates of the pixel centers of a web map tile
+
+    Args:
+        x (int): the x coordinate of the tile
+        y (int): the y coordinate of the tile, from the north
+        zoom (int): the zoom level
+        size (int): the width and height of the tile in pixels
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray): the longitude and latitude of
+            each pixel, row by row from the north west corner
+    """
+    offsets = (np.arange(size) + 0.5) / size
+    tiles = 2.0 ** zoom
+
+    lon = (x + offsets) / tiles * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi *
+                                       (1 - 2 * (y + offsets) / tiles))))
+
+    lon, lat = np.meshgrid(lon, lat)
+
+    return lon.ravel(), lat.ravel()
+
+
+def get_frame_colors(values, colormap='Greens', alpha=0.7, vmax=None):
+    """
+    Colors the cells of every frame on one scale, so that the frames can be
+    compared with each other
+
+    Args:
+        values (numpy.ndarray): the value of each cell in each frame, as an
+            array of frames x cells, NaN for cells without a value
+        colormap (string): name of the matplotlib colormap
+        alpha (float): opacity of the cells
+        vmax (float): the value with the darkest color, the largest value by
+            default
+
+    Returns:
+        numpy.ndarray: the RGBA color of each cell in each frame as uint8,
+            transparent for cells without a value
+    """
+    values = np.asarray(values, dtype=float)
+
+    if vmax is None:
+        vmax = np.nanmax(values) if np.isfinite(values).any() else 1.0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scaled = np.clip(values / (vmax or 1.0), 0, 1)
+
+    lookup = plt.get_cmap(colormap)(np.linspace(0, 1, 256))
+    lookup[:, 3] = alpha
+    lookup = np.round(lookup * 255).astype(np.uint8)
+
+    colors = lookup[np.nan_to_num(scaled * 255).astype(np.int64)]
+    colors[np.isnan(values)] = 0
+
+    return colors
+
+
+def _init_worker(cells, colors):
+    global _tile_cells, _tile_colors
+
+    _tile_cells = cells
+    _tile_colors = colors
+
+
+def render_tile(tile):
+    """
+    Renders a tile for every frame in a worker process
+
+    Args:
+        tile (tuple): the (zoom, x, y) of the tile
+
+    Returns:
+        tuple: the tile and its PNG data per frame, None for the frames in
+            which it is transparent
+    """
+    zoom, x, y = tile
+    lon, lat = get_tile_pixels(x, y, zoom)
+    labels = gpdutils.assign_points_to_cells(lon, lat, _tile_cells)
+
+    images = [None] * len(_tile_colors)
+    if (labels < 0).all():
+        return tile, images
+
+    inside = labels >= 0
+    for frame, colors in enumerate(_tile_colors):
+        pixels = np.zeros((TILE_SIZE * TILE_SIZE, 4), dtype=np.uint8)
+        pixels[inside] = colors[labels[inside]]
+
+        if not pixels[:, 3].any():
+            continue
+
+        data = io.BytesIO()
+        Image.fromarray(pixels.reshape(TILE_SIZE, TILE_SIZE, 4),
+                        'RGBA').save(data, 'PNG')
+        images[frame] = data.getvalue()
+
+    return tile, images
+
+
+def open_mbtiles(path, metadata):
+    """
+    Creates an MBTiles file, replacing any existing file
+
+    Args:
+        path (string): file path for the MBTiles output
+        metadata (dict): the values of the metadata table, e.g. name and
+            bounds
+
+    Returns:
+        sqlite3.Connection: the connection to write the tiles with
+    """
+    if os.path.isfile(path):
+        os.remove(path)
+
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+    connection.execute("""
+        CREATE TABLE tiles (
+          zoom_level INTEGER,
+          tile_column INTEGER,
+          tile_row INTEGER,
+          tile_data BLOB
+        )
+    """)
+    connection.execute("""
+        CREATE UNIQUE INDEX tile_index
+          ON tiles (zoom_level, tile_column, tile_row)
+    """)
+    connection.executemany('INSERT INTO metadata VALUES (?, ?)',
+                           sorted((key, str(value))
+                                  for key, value in metadata.items()))
+
+    return connection
+
+
+def render_tiles(cells, values, names, output_dir, zooms=None,
+                 processes=None, colormap='Greens', vmax=None):
+    """
+    Renders the choropleth of the cells as web map tiles, one MBTiles file
+    per frame, with the tiles rendered across a pool of processes
+
+    Args:
+        cells (Geopandas.GeoSeries): The polygon cells in EPSG:4326
+        values (numpy.ndarray): the value of each cell in each frame, as an
+            array of frames x cells, NaN for cells without a value
+        names (list): the name of each frame, used for its file name
+        output_dir (string): The directory to write the MBTiles files to
+        zooms (list): the zoom levels to render, MIN_ZOOM to MAX_ZOOM default
+        processes (int): Number of processes, defaults to the number of CPUs
+        colormap (string): name of the matplotlib colormap
+        vmax (float): the value with the darkest color, the largest value of
+            all frames by default
+
+    Returns:
+        list: the file paths of the MBTiles files
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    zooms = zooms or range(MIN_ZOOM, MAX_ZOOM + 1)
+    cells = list(cells)
+    colors = get_frame_colors(values, colormap=colormap, vmax=vmax)
+
+    west, south, east, north = gpd.GeoSeries(cells).total_bounds
+    bounds = (west, south, east, north)
+
+    tiles = []
+    for zoom in zooms:
+        xs, ys = get_tile_range(bounds, zoom)
+        tiles.extend((zoom, x, y) for x in xs for y in ys)
+
+    paths = [os.path.join(output_dir, '%s.mbtiles' % name) for name in names]
+
+    for start in range(0, len(names), MAX_OPEN_FRAMES):
+        frames = range(start, min(start + MAX_OPEN_FRAMES, len(names)))
+        connections = [open_mbtiles(paths[frame], {
+            'name': names[frame],
+            'type': 'overlay',
+            'version': '1.0',
+            'format': 'png',
+            'bounds': '%f,%f,%f,%f' % bounds,
+            'minzoom': min(zooms),
+            'maxzoom': max(zooms)
+        }) for frame in frames]
+
+        pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                    initargs=(cells, colors[frames[0]:
+                                                            frames[-1] + 1]))
+        try:
+            for (zoom, x, y), images in pool.imap_unordered(render_tile,
+                                                            tiles):
+                # MBTiles rows count from the south
+                row = 2 ** zoom - 1 - y
+
+                for connection, data in zip(connections, images):
+                    if data is not None:
+                        connection.execute(
+                            'INSERT INTO tiles VALUES (?, ?, ?, ?)',
+                            (zoom, x, row, sqlite3.Binary(data)))
+        finally:
+            pool.close()
+            pool.join()
+
+            for connection in connections:
+                connection.commit()
+                connection.close()
+
+    return paths
+
+
+def hourly_main(db_connection, output_dir, date_mask=None, by_date=False,
+                zooms=None, processes=None):
+    """
+    Renders the tiles of the number of users per area of each Voronoi cell,
+    one MBTiles file per hour of the day, or per date and hour
+
+    Args:
+        db_connection (Psycopg.connection): The database connection
+        output_dir (string): The directory to write the MBTiles files to
+        date_mask (function): Optional function selecting the dates to count
+            from the dates of the count cube, as for
+            florence_city_map.plot_voronoi_per_hour
+        by_date (bool): whether to render every date separately, instead of
+            summing the dates for each hour
+        zooms (list): the zoom levels to render
+        processes (int): Number of processes, defaults to the number of CPUs
+
+    Returns:
+        list: the file paths of the MBTiles files
+    """
+    voronoi_geo = florence_city_map.get_voronoi(db_connection)
+    cube = florence_city_map.get_tower_count_cube(db_connection, voronoi_geo)
+    areas = voronoi_geo['area'].values
+
+    mask = np.ones(len(cube['dates']), dtype=bool)
+    if date_mask is not None:
+        mask = date_mask(cube['dates'])
+
+    values = []
+    names = []
+    if by_date:
+        for date_index in np.flatnonzero(mask):
+            date = str(cube['dates'][date_index])
+            day = np.arange(len(mask)) == date_index
+
+            for hour in range(24):
+                values.append(florence_city_map.sum_counts(
+                    cube, date_mask=day, hours=[hour]) / areas)
+                names.append('%s_hour_%02d' % (date, hour))
+    else:
+        for hour in range(24):
+            values.append(florence_city_map.sum_counts(
+                cube, date_mask=mask, hours=[hour]) / areas)
+            names.append('hour_%02d' % hour)
+
+    return render_tiles(voronoi_geo.geometry, np.array(values), names,
+                        output_dir, zooms=zooms, processes=processes)
+
+
+if __name__ == '__main__':
+    curr_dir = os.path.dirname(os.path.abspath(__file__))
+
+    with dbutils.session() as connection:
+        hourly_main(connection, os.path.join(curr_dir, 'choropleth', 'tiles'))
@@ -1,26 +1,42 @@
 import pandas as pd
 import geopandas as gpd
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.collections import PatchCollection
+from matplotlib.figure import Figure
 from matplotlib.patches import Polygon
+from PIL import Image
 import logging as log
+import multiprocessing
 import os
 
 from ..features import firenzecard, cdr
-from ..utils.plotting import gpdutils
-from ..utils.database import dbutils
+from ..utils.plotting import gpdutils, voronoicache
+from ..utils.database import dbutils, dbcache
 
 # TODO: put these shapefiles in the DB
 SHAPEFILE_DIR = '/mnt/data/shared/aws-data/public-data/Shapefiles'
 museum_pts_path = '%s/firenzecard-shapefile/firenzecard.shp' % SHAPEFILE_DIR
 
 
+# The Florence boundary per EPSG code, since reading it means reading the
+# shapefile of every commune in Italy
+_florence_shapes = {}
+
+# The figure, cached background and Voronoi collection of a frame rendering
+# worker process
+_frame_renderer = None
+
+
 def get_florence_shape(epsg=4326):
-    italy_regions_path = '%s/boundaries-regions-2015/Com2015_WGS84_g/IT_com_WGS84.shp' % SHAPEFILE_DIR
-    italy_regions_shp = gpd.read_file(italy_regions_path).to_crs(epsg=epsg)
+    if epsg not in _florence_shapes:
+        italy_regions_path = '%s/boundaries-regions-2015/Com2015_WGS84_g/IT_com_WGS84.shp' % SHAPEFILE_DIR
+        italy_regions_shp = gpd.read_file(italy_regions_path).to_crs(epsg=epsg)
 
-    return italy_regions_shp[italy_regions_shp['COMUNE'] == 'Firenze']
+        _florence_shapes[epsg] = \
+            italy_regions_shp[italy_regions_shp['COMUNE'] == 'Firenze']
+
+    return _florence_shapes[epsg].copy()
 
 
 def get_voronoi(db_connection, florence_shp=None, pts=None):
@@ -30,7 +46,7 @@ def get_voronoi(db_connection, florence_shp=None, pts=None):
     if pts is None:
         pts = get_towers_in_florence(db_connection)
 
-    return gpdutils.make_voronoi_in_shp(pts, florence_shp)
+    return voronoicache.make_voronoi_in_shp(pts, florence_shp)
 
 
 def get_attractions_in_florence(db_connection, florence_shp=None):
@@ -56,13 +72,13 @@ def get_towers_in_florence(db_connection):
 def get_voronoi_with_counts(db_connection, hour, voronoi_geo=None,
                             tower_pts=None):
 
-    tower_counts = pd.read_sql((
+    tower_counts = dbcache.read_sql_cached((
         'SELECT SUM(foreign_users) AS total_foreign, '
         'SUM(italian_users) AS total_italian, '
         'lat, lon, tower_id '
         'FROM optourism.city_towers_hourly '
         'WHERE date_part(\'hour\', date_hour) = %s '
-        'GROUP BY tower_id, lat, lon') % hour, con=db_connection)
+        'GROUP BY tower_id, lat, lon') % hour, db_connection)
 
     if voronoi_geo is None:
         voronoi_geo = get_voronoi(db_connection, pts=tower_pts)
@@ -82,16 +98,135 @@ def get_voronoi_with_counts(db_connection, hour, voronoi_geo=None,
     return voronoi_with_counts
 
 
+NATIONALITIES = ['foreign', 'italian']
+
+
+def get_tower_count_cube(db_connection, voronoi_geo):
+    """
+    Gets the number of users per Voronoi cell, date, hour of the day and
+    nationality with a single query, so that any slice of it can be plotted
+    without querying the database again
+
+    Args:
+        db_connection (Psycopg.connection): The database connection
+        voronoi_geo (Geopandas.GeoDataFrame): The Voronoi cells of the towers,
+            with the lat and lon of their tower
+
+    Returns:
+        dict: the 'counts' as an array of cells x dates x 24 hours x
+            nationalities, with the cells in the order of voronoi_geo and the
+            nationalities in the order of NATIONALITIES. It is NaN where a
+            tower has no record for a date and hour. The 'dates' of the
+            second axis are a numpy datetime64[D] array.
+    """
+    tower_counts = dbcache.read_sql_cached("""
+        SELECT
+          lat,
+          lon,
+          date_trunc('day', date_hour) AS date,
+          extract(HOUR FROM date_hour) AS hour,
+          SUM(foreign_users) AS foreign_users,
+          SUM(italian_users) AS italian_users
+        FROM optourism.city_towers_hourly
+        GROUP BY lat, lon, date, hour
+        """, db_connection)
+
+    cells = pd.DataFrame({'lat': voronoi_geo['lat'].values,
+                          'lon': voronoi_geo['lon'].values,
+                          'cell': np.arange(len(voronoi_geo))})
+    tower_counts = tower_counts.merge(cells, how='inner', on=['lat', 'lon'])
+
+    dates = pd.to_datetime(tower_counts['date']).values.astype('datetime64[D]')
+    unique_dates, date_index = np.unique(dates, return_inverse=True)
+    hours = tower_counts['hour'].values.astype(int)
+
+    counts = np.full((len(voronoi_geo), len(unique_dates), 24,
+                      len(NATIONALITIES)), np.nan)
+    for index, nationality in enumerate(NATIONALITIES):
+        counts[tower_counts['cell'].values, date_index, hours, index] = \
+            tower_counts['%s_users' % nationality].values.astype(float)
+
+    return {'counts': counts, 'dates': unique_dates}
+
+
+def get_date_mask(dates, weekdays=None, start=None, end=None):
+    """
+    Selects dates of a count cube, e.g. to compare weekdays with weekends
+
+    Args:
+        dates (numpy.ndarray): The dates of the count cube
+        weekdays (list): Optional days of the week to keep, 0 for Monday
+            through 6 for Sunday
+        start (string): Optional first date to keep, e.g. '2016-07-01'
+        end (string): Optional last date to keep
+
+    Returns:
+        numpy.ndarray: the boolean mask of the dates to keep
+    """
+    mask = np.ones(len(dates), dtype=bool)
+
+    if weekdays is not None:
+        # 1970-01-01 was a Thursday
+        weekday = (dates.astype('datetime64[D]').astype(np.int64) + 3) % 7
+        mask &= np.isin(weekday, weekdays)
+
+    if start is not None:
+        mask &= dates >= np.datetime64(start, 'D')
+
+    if end is not None:
+        mask &= dates <= np.datetime64(end, 'D')
+
+    return mask
+
+
+def sum_counts(cube, date_mask=None, hours=None, nationalities=None):
+    """
+    Sums a slice of a count cube per Voronoi cell
+
+    Args:
+        cube (dict): The count cube from get_tower_count_cube
+        date_mask (numpy.ndarray): Optional boolean mask of the dates to sum
+        hours (list): Optional hours of the day to sum
+        nationalities (list): Optional nationalities to sum, all by default
+
+    Returns:
+        numpy.ndarray: the count of each cell, NaN for cells without any
+            record in the slice
+    """
+    counts = cube['counts']
+
+    if date_mask is not None:
+        counts = counts[:, date_mask]
+
+    if hours is not None:
+        counts = counts[:, :, hours]
+
+    if nationalities is not None:
+        counts = counts[..., [NATIONALITIES.index(nationality)
+                              for nationality in nationalities]]
+
+    counts = counts.reshape(len(counts), -1)
+    totals = np.nansum(counts, axis=1)
+    totals[np.isnan(counts).all(axis=1)] = np.nan
+
+    return totals
+
+
 def plot_polygon_collection(ax, geoms, values=None, colormap='Greens',
                             facecolor=None, edgecolor=None, alpha=0.7,
                             linewidth=1.0, **kwargs):
 
-    """ Plot a collection of Polygon geometries """
+    """
+    Plot a collection of Polygon geometries. MultiPolygons, e.g. cells
+    clipped to the Florence boundary, are drawn as one patch per polygon,
+    each with the value of its geometry.
+    """
 
+    polygons, positions = gpdutils.get_polygon_parts(geoms)
     patches = []
 
-    for poly in geoms:
-        a = np.asarray(poly.exterior)
+    for poly in polygons:
+        a = np.asarray(poly.exterior.coords)
         patches.append(Polygon(a))
 
     patches = PatchCollection(patches,
@@ -102,7 +237,7 @@ def plot_polygon_collection(ax, geoms, values=None, colormap='Greens',
                               **kwargs)
 
     if values is not None:
-        patches.set_array(values)
+        patches.set_array(np.asarray(values)[positions])
         patches.set_cmap(colormap)
 
     ax.add_collection(patches, autolim=True)
@@ -110,7 +245,148 @@ def plot_polygon_collection(ax, geoms, values=None, colormap='Greens',
     return patches
 
 
-def plot_voronoi_per_hour(db_connection):
+def _init_frame_worker(florence_shp, attractions, geoms, clim, figsize,
+                       dpi, colormap):
+    """
+    Draws the static layers of the frames once in a worker process, and
+    keeps the rendered background to draw each frame's cells on
+    """
+    global _frame_renderer
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_aspect('equal', 'datalim')
+
+    florence_shp.plot(ax=ax, color='lightblue')
+    attractions.plot(ax=ax, color='red')
+
+    col = plot_polygon_collection(ax, geoms, values=np.zeros(len(geoms)),
+                                  colormap=colormap)
+    col.set_clim(*clim)
+    col.set_visible(False)
+
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    col.set_visible(True)
+
+    # Each frame's values are given per cell, and the patches are per
+    # polygon of a cell
+    positions = gpdutils.get_polygon_parts(geoms)[1]
+
+    _frame_renderer = canvas, background, col, positions
+
+
+def _render_frame(task):
+    """
+    Renders one frame in a worker process, by restoring the background and
+    drawing only the Voronoi cells on it
+    """
+    values, path = task
+    canvas, background, col, positions = _frame_renderer
+
+    canvas.restore_region(background)
+    col.set_array(values[positions])
+    col.axes.draw_artist(col)
+
+    renderer = canvas.get_renderer()
+    pixels = np.frombuffer(canvas.buffer_rgba(), dtype=np.uint8)
+    pixels = pixels.reshape(int(renderer.height), int(renderer.width), 4)
+    Image.fromarray(pixels, 'RGBA').save(path)
+
+    return path
+
+
+def render_frames(florence_shp, attractions, geoms, values, paths,
+                  figsize=(10, 8), dpi=300, colormap='Greens',
+                  processes=None):
+    """
+    Renders a choropleth of the Voronoi cells per frame across a pool of
+    processes. The Florence shape and the attractions are drawn once per
+    process, and each frame only draws the cells over them. All of the
+    frames share one color scale, so they can be compared.
+
+    Args:
+        florence_shp (Geopandas.GeoDataFrame): The Florence boundary
+        attractions (Geopandas.GeoDataFrame): The attraction points
+        geoms (Geopandas.GeoSeries): The polygons of the Voronoi cells
+        values (numpy.ndarray): the value of each cell in each frame, as an
+            array of frames x cells
+        paths (list): the PNG file path of each frame
+        figsize (tuple): the figure size in inches
+        dpi (int): the resolution of the frames
+        colormap (string): name of the matplotlib colormap
+        processes (int): Number of processes, defaults to the number of CPUs
+
+    Returns:
+        list: the file paths of the frames
+    """
+    values = np.asarray(values, dtype=float)
+    clim = (0, 1)
+    if np.isfinite(values).any():
+        clim = (np.nanmin(values), np.nanmax(values))
+
+    pool = multiprocessing.Pool(processes, initializer=_init_frame_worker,
+                                initargs=(florence_shp, attractions,
+                                          list(geoms), clim, figsize, dpi,
+                                          colormap))
+    try:
+        for path in pool.imap(_render_frame, zip(values, paths)):
+            log.info('saved frame %s' % path)
+    finally:
+        pool.close()
+        pool.join()
+
+    return paths
+
+
+def save_animation(paths, output_path, duration=500, width=None):
+    """
+    Encodes frames into an animated GIF or WebP, by the file extension
+
+    Args:
+        paths (list): the image file paths of the frames, in order
+        output_path (string): file path of the animation
+        duration (int): how long each frame is shown, in milliseconds
+        width (int): Optional width to scale the frames down to
+    """
+    frames = []
+    for path in paths:
+        frame = Image.open(path)
+
+        if width is not None and frame.width > width:
+            height = int(round(frame.height * width / float(frame.width)))
+            frame = frame.resize((width, height), Image.LANCZOS)
+
+        if output_path.lower().endswith('.gif'):
+            frame = frame.convert('RGB').convert('P', palette=Image.ADAPTIVE)
+
+        frames.append(frame)
+
+    frames[0].save(output_path, save_all=True, append_images=frames[1:],
+                   duration=duration, loop=0)
+
+
+def plot_voronoi_per_hour(db_connection, date_mask=None, prefix='hour',
+                          processes=None, animation=None,
+                          animation_width=1000):
+    """
+    Plots the number of users per area of each Voronoi cell, one image per
+    hour of the day. The counts of all of the hours are loaded at once, so
+    each image only indexes the count cube, and the images are rendered by
+    render_frames in a pool of processes.
+
+    Args:
+        db_connection (Psycopg.connection): The database connection
+        date_mask (function): Optional function selecting the dates to count
+            from the dates of the count cube, e.g.
+            lambda dates: get_date_mask(dates, weekdays=[5, 6])
+        prefix (string): Prefix of the image file names
+        processes (int): Number of processes, defaults to the number of CPUs
+        animation (string): Optional extension, 'gif' or 'webp', of an
+            animation of the hours to save along with the images
+        animation_width (int): width in pixels of the animation frames
+    """
     florence_shp = get_florence_shape()
 
     towers = get_towers_in_florence(db_connection)
@@ -118,41 +394,30 @@ def plot_voronoi_per_hour(db_connection):
     attractions = get_attractions_in_florence(db_connection,
                                               florence_shp=florence_shp)
 
-    fig = plt.figure(figsize=(10, 8), dpi=300)
-    ax = plt.gca()
-    plt.axes().set_aspect('equal', 'datalim')
-
-    florence_shp.plot(ax=ax, color='lightblue')
-    # towers.plot(ax=ax, color='navy')
-    attractions.plot(ax=ax, color='red')
+    voronoi_geo = get_voronoi(db_connection, florence_shp=florence_shp,
+                              pts=towers)
+    cube = get_tower_count_cube(db_connection, voronoi_geo)
+    areas = voronoi_geo['area'].values
 
-    voronoi_with_counts = None
-    col = None
+    if date_mask is not None:
+        date_mask = date_mask(cube['dates'])
 
-    for hour in range(24):
-        if voronoi_with_counts is None:
-            voronoi_with_counts = get_voronoi_with_counts(db_connection, hour,
-                                                          tower_pts=towers)
+    values = [sum_counts(cube, date_mask=date_mask, hours=[hour]) / areas
+              for hour in range(24)]
 
-            col = plot_polygon_collection(ax, voronoi_with_counts.geometry, values=voronoi_with_counts['count_area'])
-        else:
-            voronoi_with_counts = get_voronoi_with_counts(db_connection, hour,
-                                                          tower_pts=towers)
-            col.set_array(voronoi_with_counts['count_area'])
+    curr_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(curr_dir, 'choropleth', '%s_%s.png' % (prefix, hour))
+             for hour in range(24)]
 
-        curr_dir = os.path.dirname(os.path.abspath(__file__))
-        filename = 'hour_%s.png' % hour
-        path = os.path.join(curr_dir, 'choropleth', filename)
+    render_frames(florence_shp, attractions, voronoi_geo.geometry, values,
+                  paths, processes=processes)
 
-        fig.savefig(path, dpi=300)
-        print('saved image for hour ' + str(hour))
-
-    plt.clf()
-    plt.close()
+    if animation is not None:
+        path = os.path.join(curr_dir, 'choropleth',
+                            '%s.%s' % (prefix, animation))
+        save_animation(paths, path, width=animation_width)
 
 
 if __name__ == '__main__':
-    connection = dbutils.connect()
-    plot_voronoi_per_hour(connection)
-    connection.close()
-
+    with dbutils.session() as connection:
+        plot_voronoi_per_hour(connection)
@@ -1,70 +1,104 @@
 from utils.database import dbutils
-import json
-import requests
-import polyline
-import cPickle as pickle
+from utils.export import jsonutils, binaryutils
+from utils.routing import cache, fetch, routers
+import datetime
+import multiprocessing
 import os
+import numpy as np
+import pandas as pd
 
 
-def get_routes(location_pairs, routes_path, get_time=False):
+ROUTE_PAIR_COLUMNS = ['prev_lon', 'prev_lat', 'lon', 'lat']
+
+# Routing profile of the routes on the OpenStreetMap extract
+LOCAL_PROFILE = 'foot'
+
+
+def get_router():
     """
-    Gets the driving route from Open Street Routing Machine for an array
-    of pairs of coordinates. Decodes the returned polyline routes into an
-    array or lat/lon tuples. Saves the resulting paths as a pickle.
+    Gets the router for the paths. Routes in-process on the OpenStreetMap
+    extract at $FLORENCE_OSM_PATH when it is set, and with the public Open
+    Source Routing Machine server otherwise.
 
-    Args:
-        location_pairs (dictionary): The set of location pairs to query for
-        routes_path (string): The file path for the routes pickle
-        get_time (bool): whether or not to save the duration for route
+    Returns:
+        routers.Router: the router
+    """
+    osm_path = os.environ.get('FLORENCE_OSM_PATH')
+
+    if osm_path:
+        return routers.LocalRouter.from_osm(osm_path, profile=LOCAL_PROFILE)
+
+    return routers.OSRMRouter()
+
+
+def get_router_name():
+    """
+    Gets the name of the routes of the router from get_router, without
+    loading the street graph, to read its routes from the route cache
 
     Returns:
-        array: The routes between all of the supplied pairs of locations
+        string: the router name, see routers.Router.name
     """
+    if os.environ.get('FLORENCE_OSM_PATH'):
+        return routers.get_router_name(routers.LocalRouter.kind,
+                                       LOCAL_PROFILE)
+
+    return routers.OSRMRouter().name
 
-    # TODO: Change this to being walking directions. Use google maps routing.
 
-    routes = {}
-    if os.path.isfile(routes_path):
-        routes = pickle.load(open(routes_path, 'rb'))
+def get_routes(location_pairs, routes_path, get_time=False, router=None,
+               workers=fetch.FETCH_WORKERS):
+    """
+    Gets the route for an array of pairs of coordinates as an array of
+    lat/lon tuples. The routes are kept in a SQLite route cache, which is
+    written as they are fetched, so only the routes missing from it are
+    fetched.
+
+    Args:
+        location_pairs (dictionary): The set of location pairs to query for
+        routes_path (string): The file path for the SQLite route cache
+        get_time (bool): whether or not to save the duration for route,
+            these are fetched in batches with table queries
+        router (routers.Router): The router to use, get_router by default.
+            Its routes are kept apart from those of other routers in the
+            route cache.
+        workers (int): The number of queries to make at the same time
 
-    for location_pair_key in location_pairs:
-        if location_pair_key not in routes:
-            location = location_pairs[location_pair_key]
-            url = 'http://router.project-osrm.org/route/v1/driving/%s' % \
-                  location
-            response = requests.get(url)
-            route = response.json()['routes'][0]
+    Returns:
+        array: The routes between all of the supplied pairs of locations
+    """
 
-            if get_time:
-                routes[location_pair_key] = {
-                    'duration': route['duration'],
-                    'distance': route['distance']
-                }
-            else:
-                routes[location_pair_key] = polyline.decode(route['geometry'])
+    router = router or get_router()
 
-    pickle.dump(routes, open(routes_path, 'wb'))
+    with cache.RouteCache(routes_path, router.name) as route_cache:
+        if get_time:
+            fetch.fetch_durations(router, location_pairs, route_cache,
+                                  workers=workers)
+        else:
+            fetch.fetch_routes(router, location_pairs, route_cache,
+                               workers=workers)
 
-    return routes
+        return route_cache.load(location_pairs, get_time=get_time)
 
 
-def get_tower_pairs(query):
+def get_tower_pairs(query, routes_path, router=None):
     """
     Gets the pairs of sequential towers that exist in a set of CDR records.
     Only adds transitions between towers that exist in one users records.
 
     Args:
         query (string): The POSTGRES query to retrieve the set of CDR records
+        routes_path (string): The file path for the SQLite route cache
+        router (routers.Router): The router to use, as for get_routes
 
     Returns:
         array: The routes between all of the pairs of towers
     """
 
-    conn = dbutils.connect()
-    cursor = conn.cursor()
-
-    cursor.execute(query)
-    records = cursor.fetchall()
+    with dbutils.session() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query)
+        records = cursor.fetchall()
 
     prev_user = None
     prev_tower = None
@@ -84,30 +118,30 @@ def get_tower_pairs(query):
         prev_lon = lon
         prev_lat = lat
 
-    return get_routes(tower_pairs)
+    return get_routes(tower_pairs, routes_path, router=router)
 
 
-def museum_main(routes_path):
+def museum_main(routes_path, router=None):
     """
     Calculates routes between every pair of museums that are visited in a row
 
     Args:
-        routes_path (string): path for output museum routes pickle
+        routes_path (string): path for the museum SQLite route cache
+        router (routers.Router): The router to use, get_router by default
     """
 
     # TODO: Finish this so that it creates paths. Need to complete walking
     # directions implementation for routes first
 
-    conn = dbutils.connect()
-    cursor = conn.cursor()
-
     museum_location_query = """
         SELECT latitude, longitude, string 
         FROM optourism.firenze_card_locations;
     """
 
-    cursor.execute(museum_location_query)
-    records = cursor.fetchall()
+    with dbutils.session() as conn:
+        cursor = conn.cursor()
+        cursor.execute(museum_location_query)
+        records = cursor.fetchall()
 
     museum_pairs = {}
 
@@ -125,106 +159,434 @@ def museum_main(routes_path):
                                                 end_lat)
             museum_pairs[key] = location
 
-    return get_routes(museum_pairs, routes_path, get_time=True)
+    return get_routes(museum_pairs, routes_path, get_time=True,
+                      router=router)
 
 
-def cdr_main(routes_path, output_path):
+def create_route_index(routes):
     """
-    Retrieves a set of CDR records for users with notable paths and
-    interpolates these paths with routes between their tower locations
-    equally spaced over the time gap.
-    Creates a JSON data file to feed into the deck.gl paths visualization.
+    Concatenates the routes between pairs of tower locations into one array
+    of points, so that the points of many routes can be gathered at once
 
     Args:
-        routes_path (string): The file path for the routes pickle
-        output_path (string): The file path for the output json
+        routes (dict): The routes between pairs of tower locations from
+            get_routes, as lists of lat/lon pairs
+
+    Returns:
+        dict: the 'pairs' of tower locations of the routes as a DataFrame of
+            prev_lon, prev_lat, lon, lat and route_id, the (lat, lon)
+            'points' of all of the routes and the 'offsets' at which each
+            route starts in them, with the end of the last route at the end
+    """
+    # Only routes keyed by a pair of locations can be matched to records
+    keys = [key for key in routes if key.count(';') == 1]
+    lengths = np.array([len(routes[key]) for key in keys], dtype=np.int64)
+
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    points = np.array([point for key in keys for point in routes[key]],
+                      dtype=float).reshape(-1, 2)
+
+    # The keys are parsed once, so that the tower locations of the records
+    # can be matched to them as numbers instead of formatting keys
+    locations = np.array([[value for point in routers.parse_coordinates(key)
+                           for value in point] for key in keys],
+                         dtype=float).reshape(-1, 4)
+    pairs = pd.DataFrame(locations, columns=ROUTE_PAIR_COLUMNS)
+    pairs['route_id'] = np.arange(len(keys))
+
+    return {
+        'pairs': pairs.drop_duplicates(ROUTE_PAIR_COLUMNS),
+        'points': points,
+        'offsets': offsets
+    }
+
+
+def get_route_ids(prev_lon, prev_lat, lon, lat, route_index):
+    """
+    Looks up the routes between pairs of tower locations
+
+    Args:
+        prev_lon (numpy.ndarray): longitudes of the towers moved from
+        prev_lat (numpy.ndarray): latitudes of the towers moved from
+        lon (numpy.ndarray): longitudes of the towers moved to
+        lat (numpy.ndarray): latitudes of the towers moved to
+        route_index (dict): The routes from create_route_index
+
+    Returns:
+        numpy.ndarray: the id of the route of each pair, -1 when there is none
+    """
+    pairs = pd.DataFrame({'prev_lon': prev_lon, 'prev_lat': prev_lat,
+                          'lon': lon, 'lat': lat}, columns=ROUTE_PAIR_COLUMNS)
+    route_ids = pairs.merge(route_index['pairs'], how='left',
+                            on=ROUTE_PAIR_COLUMNS)['route_id']
+
+    return route_ids.fillna(-1).values.astype(np.int64)
+
+
+def interpolate_paths(records, route_index):
+    """
+    Interpolates the paths of users with the routes between their tower
+    locations, equally spaced over the time gap between the records. Every
+    record becomes a point of the path, preceded by the points of the route
+    from the previous tower when the user changed towers.
+
+    Args:
+        records (Pandas.DataFrame): The CDR records of the users with the
+            columns cust_id, lon, lat, minutes and tower_id, ordered by user
+            and time
+        route_index (dict): The routes from create_route_index
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray): the [lon, lat, time] points of
+            the paths, and the index of the first point of each user's path
+            followed by the number of points
     """
+    user = records['cust_id'].values
+    tower = records['tower_id'].values
+    lon = records['lon'].values.astype(float)
+    lat = records['lat'].values.astype(float)
+    time = records['minutes'].values.astype(float)
+    count = len(records)
+
+    first = np.ones(count, dtype=bool)
+    first[1:] = user[1:] != user[:-1]
+
+    moved = np.zeros(count, dtype=bool)
+    moved[1:] = ~first[1:] & (tower[1:] != tower[:-1])
+    moved = np.flatnonzero(moved)
+
+    # The number of route points inserted before each record
+    route_ids = np.full(count, -1, dtype=np.int64)
+    route_ids[moved] = get_route_ids(lon[moved - 1], lat[moved - 1],
+                                     lon[moved], lat[moved], route_index)
+
+    offsets = route_index['offsets']
+    lengths = np.where(route_ids >= 0,
+                       offsets[route_ids + 1] - offsets[route_ids], 0)
+
+    starts = np.cumsum(lengths + 1) - (lengths + 1)
+    record = np.repeat(np.arange(count), lengths + 1)
+    step = np.arange(len(record)) - starts[record]
 
-    conn = dbutils.connect()
-    cursor = conn.cursor()
+    path_lon = lon[record]
+    path_lat = lat[record]
+    path_time = time[record]
 
-    routes_query = """
-        SELECT 
-          paths.cust_id, 
-          paths.lon, 
-          paths.lat, 
-          date_part('hour', paths.date_time_m) AS hour, 
-          date_part('minute', paths.date_time_m) AS minute,
+    # Route points get the time of the previous record plus equal steps
+    on_route = step < lengths[record]
+    route_record = record[on_route]
+    route_step = step[on_route]
+    points = route_index['points'][offsets[route_ids[route_record]] +
+                                   route_step]
+    delta = (time[route_record] - time[route_record - 1]) / \
+        (lengths[route_record] + 1)
+
+    path_lat[on_route] = points[:, 0]
+    path_lon[on_route] = points[:, 1]
+    path_time[on_route] = time[route_record - 1] + delta * (route_step + 1)
+
+    user_starts = np.append(starts[first], len(record))
+
+    return np.column_stack([path_lon, path_lat, path_time]), user_starts
+
+
+def get_trips(chunks, routes, as_arrays=False):
+    """
+    Interpolates the path of each user with the routes between their tower
+    locations, equally spaced over the time gap between the records
+
+    Args:
+        chunks (iterable): The CDR records of the users as DataFrames with
+            the columns cust_id, lon, lat, minutes and tower_id, ordered by
+            user and time, e.g. from dbutils.read_sql_chunks. The records
+            of a user must all be in the same chunk.
+        routes (dict): The routes between pairs of tower locations from
+            get_routes
+        as_arrays (bool): whether to give the segments as numpy arrays
+            instead of lists, which is faster when they aren't written to
+            JSON
+
+    Yields:
+        dict: The trip of the next user, with its color, startTime, endTime
+            and segments of [lon, lat, time]
+    """
+    route_index = create_route_index(routes)
+    id_counter = 0
+
+    for records in chunks:
+        if records.empty:
+            continue
+
+        path, user_starts = interpolate_paths(records, route_index)
+        segments = path if as_arrays else path.tolist()
+
+        for start, end in zip(user_starts[:-1].tolist(),
+                              user_starts[1:].tolist()):
+            yield {
+                'color': id_counter,
+                'startTime': float(segments[start][2]),
+                'segments': segments[start:end],
+                'endTime': float(segments[end - 1][2])
+            }
+
+            id_counter += 1
+
+
+def get_paths_query(start, end, countries=None, min_days_active=None,
+                    max_days_active=None, sample_rate=None):
+    """
+    Builds the query for the CDR records of the paths in a time window. The
+    window is a range on date_time_m, so that an index on it can be used,
+    and the time of each record is given in minutes since the window start.
+
+    Args:
+        start (datetime): Start of the time window
+        end (datetime): End of the time window, exclusive
+        countries (list): Optional countries to keep the customers of
+        min_days_active (int): Optional least number of days a customer was
+            active
+        max_days_active (int): Optional number of days active below which
+            customers are kept
+        sample_rate (float): Optional share of the customers to keep. The
+            sample is drawn from a hash of the customer id, so the same
+            customers are kept in every window.
+
+    Returns:
+        tuple (string, dict): the query and its parameters
+    """
+    conditions = ['paths.date_time_m >= %(start)s',
+                  'paths.date_time_m < %(end)s']
+    params = {'start': start, 'end': end}
+
+    if countries is not None:
+        conditions.append('paths.country = ANY(%(countries)s)')
+        params['countries'] = list(countries)
+
+    if min_days_active is not None:
+        conditions.append('features.days_active >= %(min_days_active)s')
+        params['min_days_active'] = min_days_active
+
+    if max_days_active is not None:
+        conditions.append('features.days_active < %(max_days_active)s')
+        params['max_days_active'] = max_days_active
+
+    if sample_rate is not None and sample_rate < 1:
+        conditions.append(
+            '(hashtext(paths.cust_id::TEXT) & 2147483647) < %(sample_limit)s')
+        params['sample_limit'] = int(sample_rate * 2147483648)
+
+    query = """
+        SELECT
+          paths.cust_id,
+          paths.lon,
+          paths.lat,
+          extract(EPOCH FROM paths.date_time_m - %%(start)s) / 60 AS minutes,
           paths.tower_id
         FROM optourism.foreigners_path_records_joined AS paths
           JOIN optourism.foreigners_features AS features
           ON features.cust_id = paths.cust_id
-            AND (
-              date_part('day', paths.date_time_m) = 27 
-                OR 
-              date_part('day', paths.date_time_m) = 28
-            )
-            AND date_part('month', paths.date_time_m) = 7
-            AND features.days_active < 15
-        ORDER BY cust_id ASC, hour ASC, minute ASC; 
+        WHERE %s
+        ORDER BY paths.cust_id ASC, paths.date_time_m ASC
+    """ % '\n          AND '.join(conditions)
+
+    return query, params
+
+
+def export_paths(routes, output_path, start, end, precision=None,
+                 compress=(), binary=False, chunk_size=500000, **filters):
     """
+    Interpolates the paths of the users in a time window and writes them out
+    for the deck.gl paths visualization. The records are streamed from the
+    database in chunks of whole users, the paths of each chunk are
+    interpolated at once and the trips written out one at a time.
 
-    cursor.execute(routes_query)
-    records = cursor.fetchall()
-    clean_records = []
+    Args:
+        routes (dict): The routes between pairs of tower locations from
+            get_routes
+        output_path (string): The file path for the output
+        start (datetime): Start of the time window
+        end (datetime): End of the time window, exclusive
+        precision (int): optional number of decimals to round floats to in
+            the JSON output
+        compress (list): compressed copies of the JSON output to write next
+            to it, any of 'gzip' and 'brotli'
+        binary (bool): whether to write the trips as binary typed arrays to
+            output_path, with the JSON header next to it, instead of JSON
+        chunk_size (int): Number of records to interpolate at a time
+        filters: The customer filters and sample rate of get_paths_query
 
-    data = None
-    prev_user = None
-    prev_time = None
-    prev_tower = None
-    prev_lat = None
-    prev_lon = None
-    id_counter = 0
+    Returns:
+        int: the number of trips written
+    """
+    query, params = get_paths_query(start, end, **filters)
 
-    routes = pickle.load(open(routes_path, 'rb'))
+    with dbutils.session() as conn:
+        chunks = dbutils.read_sql_chunks(query, conn, key_column='cust_id',
+                                         chunk_size=chunk_size, params=params)
+        trips = get_trips(chunks, routes, as_arrays=binary)
 
-    for index in range(len(records)):
-        user, lon, lat, hour, minute, tower = records[index]
-        timestamp = hour * 60 + minute
+        if binary:
+            return binaryutils.write_trips_binary(trips,
+                                                  output_path)['pathCount']
 
-        if prev_user is not None and prev_user != user:
-            data['endTime'] = prev_time
-            clean_records.append(data)
+        return jsonutils.write_json_array(trips, output_path,
+                                          precision=precision,
+                                          compress=compress)
 
-        if prev_user is None or prev_user != user:
-            data = {
-                'color': id_counter,
-                'startTime': timestamp,
-                'segments': []
-            }
 
-            id_counter += 1
-        elif prev_tower is not None and prev_tower != tower:
-            key = '{0},{1};{2},{3}'.format(prev_lon, prev_lat, lon, lat)
+def _export_window(task):
+    """
+    Exports the paths of one time window in a worker process
+    """
+    routes_path, router_name, output_path, start, end, options = task
 
-            if key in routes:
+    with cache.RouteCache(routes_path, router_name) as route_cache:
+        routes = route_cache.load()
 
-                route = routes[key]
-                delta = (timestamp - prev_time) / (len(route) + 1)
+    return export_paths(routes, output_path, start, end, **options)
 
-                for i in range(len(route)):
-                    stop_lat, stop_lon = route[i]
-                    segment = [stop_lon, stop_lat, prev_time + delta * (i + 1)]
-                    data['segments'].append(segment)
 
-        data['segments'].append([lon, lat, timestamp])
+def export_windows(routes_path, output_dir, start, end,
+                   window=datetime.timedelta(days=1), processes=None,
+                   binary=False, router_name=None, **options):
+    """
+    Exports the paths in consecutive time windows, e.g. one file per day, so
+    that the visualization can load one time slice at a time. The windows
+    are exported in parallel, each by a worker process with its own
+    database connection. An index.json in output_dir lists the windows with
+    their start, end, file name and number of trips. The times in each file
+    are minutes since the start of its window.
 
-        prev_user = user
-        prev_time = timestamp
-        prev_tower = tower
-        prev_lat = lat
-        prev_lon = lon
+    Args:
+        routes_path (string): The file path for the SQLite route cache
+        output_dir (string): The directory to write the files to
+        start (datetime): Start of the first window
+        end (datetime): End of the last window, exclusive
+        window (datetime.timedelta): Length of the windows
+        processes (int): Number of processes, defaults to the number of CPUs
+        binary (bool): whether to write binary typed arrays instead of JSON
+        router_name (string): The router whose routes are read from the
+            route cache, that of get_router by default
+        options: Other options of export_paths, e.g. the customer filters
 
-    with open(output_path, 'w') as outfile:
-        json.dump(clean_records, outfile)
+    Returns:
+        list: the windows as listed in the index
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    extension = 'bin' if binary else 'json'
+    options['binary'] = binary
+
+    windows = []
+    tasks = []
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + window, end)
+        name = 'trips_%s.%s' % (window_start.strftime('%Y%m%dT%H%M'),
+                                extension)
+
+        windows.append({'start': window_start.isoformat(),
+                        'end': window_end.isoformat(),
+                        'path': name})
+        tasks.append((routes_path, router_name or get_router_name(),
+                      os.path.join(output_dir, name),
+                      window_start, window_end, options))
+
+        window_start = window_end
+
+    pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(),
+                                    len(tasks) or 1))
+    try:
+        counts = pool.map(_export_window, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    for window_info, count in zip(windows, counts):
+        window_info['trips'] = count
+
+    jsonutils.write_json(windows, os.path.join(output_dir, 'index.json'))
+
+    return windows
+
+
+def cdr_main(routes_path, output_path, precision=None, compress=(),
+             binary=False, chunk_size=500000,
+             start=datetime.datetime(2016, 7, 27),
+             end=datetime.datetime(2016, 7, 29), max_days_active=15,
+             router_name=None, **filters):
+    """
+    Retrieves a set of CDR records for users with notable paths and
+    interpolates these paths with routes between their tower locations
+    equally spaced over the time gap.
+    Creates a JSON data file to feed into the deck.gl paths visualization.
+
+    Args:
+        routes_path (string): The file path for the SQLite route cache
+        output_path (string): The file path for the output json
+        precision (int): optional number of decimals to round floats to in
+            the JSON output
+        compress (list): compressed copies of the JSON output to write next
+            to it, any of 'gzip' and 'brotli'
+        binary (bool): whether to write the trips as binary typed arrays to
+            output_path, with the JSON header next to it, instead of JSON
+        chunk_size (int): Number of records to interpolate at a time
+        start (datetime): Start of the time window
+        end (datetime): End of the time window, exclusive
+        max_days_active (int): Number of days active below which customers
+            are kept
+        router_name (string): The router whose routes are read from the
+            route cache, that of get_router by default
+        filters: Other customer filters and the sample rate of
+            get_paths_query
+
+    Returns:
+        int: the number of trips written
+    """
+
+    router_name = router_name or get_router_name()
+
+    with cache.RouteCache(routes_path, router_name) as route_cache:
+        routes = route_cache.load()
+
+    return export_paths(routes, output_path, start, end, precision=precision,
+                        compress=compress, binary=binary,
+                        chunk_size=chunk_size,
+                        max_days_active=max_days_active, **filters)
 
 
 if __name__ == '__main__':
     curr_dir = os.path.dirname(os.path.abspath(__file__))
     pickle_path = os.path.join(curr_dir, 'output', 'tower_routes.p')
+    routes_path = os.path.join(curr_dir, 'output', 'tower_routes.sqlite')
     cdr_output_path = os.path.join(curr_dir, 'output', 'tower_routes.json')
 
-    cdr_main(pickle_path, cdr_output_path)
+    # Routes fetched before the SQLite route cache are imported into it, as
+    # routes of the public OSRM server they were fetched from
+    if os.path.isfile(pickle_path):
+        with cache.RouteCache(routes_path) as route_cache:
+            route_cache.import_pickle(pickle_path)
+
+    cdr_main(routes_path, cdr_output_path, precision=6, compress=['gzip'])
+
+    cdr_binary_path = os.path.join(curr_dir, 'output', 'tower_routes.bin')
+    cdr_main(routes_path, cdr_binary_path, binary=True)
+
+    # One binary file per day of the summer, for loading time slices
+    export_windows(routes_path, os.path.join(curr_dir, 'output', 'paths'),
+                   datetime.datetime(2016, 6, 1),
+                   datetime.datetime(2016, 10, 1), binary=True,
+                   max_days_active=15)
 
     museum_pickle_path = os.path.join(curr_dir, 'output', 'museum_routes.p')
-    museum_main(museum_pickle_path)
+    museum_routes_path = os.path.join(curr_dir, 'output',
+                                      'museum_routes.sqlite')
+
+    if os.path.isfile(museum_pickle_path):
+        with cache.RouteCache(museum_routes_path) as route_cache:
+            route_cache.import_pickle(museum_pickle_path)
+
+    museum_main(museum_routes_path)
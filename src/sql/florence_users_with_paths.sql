@@ -253,6 +253,11 @@ CREATE TABLE optourism.foreigners_path_records_joined AS
     )
   ORDER BY records.cust_id ASC, records.date_time_m ASC;
 
+-- Index the record times for the time windows of the path exports in
+-- paths_deck_gl.py
+CREATE INDEX foreigners_path_records_joined_date_time_m_idx
+  ON optourism.foreigners_path_records_joined (date_time_m);
+
 -- Make alternate joined table for dwell time calculations
 CREATE TABLE optourism.foreigners_path_records_dwell_time AS
   SELECT
@@ -0,0 +1,332 @@
+"""
+Local columnar cache for the results of database queries. Results are stored
+as Parquet or Feather files in CACHE_DIR ($FLORENCE_CACHE_DIR if it is set),
+keyed by a hash of the query and its parameters, and read back
+memory-mapped. A cached result is refreshed when it is older than its time to
+live or when one of the tables it reads from has been modified since, and the
+least recently used results are evicted once the cache grows past
+CACHE_MAX_BYTES.
+
+The cache is off unless $FLORENCE_CACHE is set to 1 or enable() is called,
+because the modification check lags behind the database: it compares the row
+counters of pg_stat_user_tables, which Postgres updates in the background
+rather than as part of the writing transaction. A result read within a few
+seconds of a commit to one of its tables (up to a minute on a busy server)
+can still be the old one. Only use the cache for tables that are loaded once
+and then read, as the optourism tables are, or pass a ttl. Views named in a
+query are checked through the tables they read from.
+
+Parquet and Feather need pyarrow. Without it results are cached as pickles.
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CACHE_DIR = os.environ.get('FLORENCE_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache',
+                                        'florence'))
+CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+CACHE_FORMAT = 'parquet'
+ENABLED = os.environ.get('FLORENCE_CACHE', '0') not in ('', '0')
+
+_TABLE_PATTERN = re.compile(r'\b(?:from|join)\s+([a-z_][\w.]*)',
+                            re.IGNORECASE)
+
+
+def get_cache_key(query, params=None, reader_kwargs=None):
+    """
+    Hashes a query with its parameters and reader options into a cache key
+
+    Args:
+        query (string): The POSTGRES query
+        params (dict): Parameters passed along with the query
+        reader_kwargs (dict): Options passed to the reader, e.g. dtypes
+
+    Returns:
+        string: the hex digest identifying the query result
+    """
+    normalized = ' '.join(query.split())
+    description = json.dumps([normalized, params, reader_kwargs],
+                             sort_keys=True, default=str)
+
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def get_query_tables(query):
+    """
+    Finds the names the tables a query reads from could have. This can
+    include names that aren't tables, e.g. the column in EXTRACT(DAY FROM x),
+    which get_table_versions leaves out.
+
+    Args:
+        query (string): The POSTGRES query
+
+    Returns:
+        list: the sorted unique names, e.g. ['optourism.cdr_foreigners']
+    """
+    return sorted(set(name.lower() for name in _TABLE_PATTERN.findall(query)))
+
+
+def enable(enabled=True):
+    """
+    Turns the cache on or off for the rest of the process, see the module
+    docstring for when a cached result can be out of date
+
+    Args:
+        enabled (bool): whether read_sql_cached uses the cache
+    """
+    global ENABLED
+    ENABLED = enabled
+
+
+def get_table_versions(db_connection, tables):
+    """
+    Gets a fingerprint of the current contents of tables from the Postgres
+    statistics. It changes when rows are inserted, updated or deleted and
+    when a table is rewritten, e.g. by REFRESH MATERIALIZED VIEW or TRUNCATE.
+    The fingerprint of a view is that of the tables it reads from. The
+    statistics are updated shortly after a commit, not with it, so a
+    fingerprint taken right after a write can still be the old one.
+
+    Args:
+        db_connection (Psycopg.connection): The database connection
+        tables (list): The table names, optionally schema qualified
+
+    Returns:
+        dict: the fingerprint of each of the tables that exists
+    """
+    if not tables:
+        return {}
+
+    cursor = db_connection.cursor()
+    cursor.execute("""
+        WITH RECURSIVE relations(name, relid) AS (
+            SELECT t.name, to_regclass(t.name)::oid
+            FROM unnest(%(tables)s::text[]) AS t(name)
+            WHERE to_regclass(t.name) IS NOT NULL
+          UNION
+            SELECT relations.name, depend.refobjid
+            FROM relations
+              JOIN pg_rewrite AS rewrite
+              ON rewrite.ev_class = relations.relid
+              JOIN pg_depend AS depend
+              ON depend.classid = 'pg_rewrite'::regclass
+                AND depend.objid = rewrite.oid
+                AND depend.refclassid = 'pg_class'::regclass
+                AND depend.refobjid != relations.relid
+        )
+        SELECT
+          relations.name,
+          s.relid,
+          pg_relation_filenode(s.relid),
+          s.n_tup_ins,
+          s.n_tup_upd,
+          s.n_tup_del
+        FROM relations
+          JOIN pg_stat_user_tables AS s
+          ON s.relid = relations.relid
+        ORDER BY relations.name, s.relid
+    """, {'tables': list(tables)})
+    rows = cursor.fetchall()
+    cursor.close()
+
+    versions = {}
+    for row in rows:
+        version = '%s:%s:%s:%s:%s' % tuple(row[1:])
+        if row[0] in versions:
+            version = '%s;%s' % (versions[row[0]], version)
+        versions[row[0]] = version
+
+    return versions
+
+
+def _read_pandas(query, db_connection, params=None, **kwargs):
+    return pd.read_sql(query, con=db_connection, params=params, **kwargs)
+
+
+def read_sql_cached(query, db_connection, params=None, tables=None, ttl=None,
+                    reader=None, cache_dir=None, max_bytes=None,
+                    cache_format=None, **reader_kwargs):
+    """
+    Reads the results of a query from the local cache, or from the database
+    when they are not cached yet or the cached copy is out of date. Unless
+    the cache is enabled the query is always read from the database.
+
+    Args:
+        query (string): The POSTGRES query to read the data with
+        db_connection (Psycopg.connection): The database connection
+        params (dict): Optional parameters to pass along with the query
+        tables (list): Tables whose modification invalidates the result,
+            defaults to the tables named in the query
+        ttl (int): Optional number of seconds after which the result is
+            read from the database again
+        reader (function): Function reading the query from the database, with
+            the arguments of dbutils.read_sql_bulk. Defaults to pd.read_sql.
+            It is only called when the result isn't cached.
+        cache_dir (string): Directory for the cache files, CACHE_DIR default
+        max_bytes (int): Size of the cache directory above which the least
+            recently used results are evicted, CACHE_MAX_BYTES default
+        cache_format (string): 'parquet' or 'feather', CACHE_FORMAT default
+        reader_kwargs: Additional options for the reader, e.g. dtype
+
+    Returns:
+        Pandas.DataFrame: The results of the query
+    """
+    reader = reader or _read_pandas
+
+    if not ENABLED:
+        return reader(query, db_connection, params=params, **reader_kwargs)
+
+    cache_dir = cache_dir or CACHE_DIR
+    cache_format = cache_format or CACHE_FORMAT
+
+    if pyarrow is None:
+        cache_format = 'pickle'
+
+    if tables is None:
+        tables = get_query_tables(query)
+
+    key = get_cache_key(query, params, reader_kwargs)
+    data_path = os.path.join(cache_dir, '%s.%s' % (key, cache_format))
+    meta_path = os.path.join(cache_dir, '%s.json' % key)
+
+    versions = get_table_versions(db_connection, tables)
+
+    # Without a table to check or a time to live a cached result could never
+    # be refreshed, so it isn't cached at all
+    if not versions and ttl is None:
+        return reader(query, db_connection, params=params, **reader_kwargs)
+
+    if _is_fresh(data_path, meta_path, versions, ttl):
+        os.utime(data_path, None)
+        return _read_cache_file(data_path, cache_format)
+
+    data = reader(query, db_connection, params=params, **reader_kwargs)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    _write_cache_file(data, data_path, cache_format)
+    _write_json({'query': query, 'created': time.time(),
+                 'versions': versions}, meta_path)
+
+    evict(cache_dir, max_bytes or CACHE_MAX_BYTES)
+
+    return data
+
+
+def _is_fresh(data_path, meta_path, versions, ttl):
+    """
+    Checks that a cached result exists, is within its time to live and was
+    made from the current versions of its tables
+    """
+    if not os.path.isfile(data_path) or not os.path.isfile(meta_path):
+        return False
+
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+
+    if ttl is not None and time.time() - meta['created'] > ttl:
+        return False
+
+    return meta['versions'] == versions
+
+
+def _read_cache_file(path, cache_format):
+    if cache_format == 'parquet':
+        table = pyarrow.parquet.read_table(pyarrow.memory_map(path, 'r'))
+        return table.to_pandas()
+
+    if cache_format == 'feather':
+        return pyarrow.feather.read_table(path, memory_map=True).to_pandas()
+
+    return pd.read_pickle(path)
+
+
+def _write_cache_file(data, path, cache_format):
+    """
+    Writes a result to a temporary file first, so that a reader never sees a
+    partially written result
+    """
+    temp_path = '%s.tmp' % path
+
+    if cache_format == 'parquet':
+        pyarrow.parquet.write_table(pyarrow.Table.from_pandas(data),
+                                    temp_path)
+    elif cache_format == 'feather':
+        pyarrow.feather.write_feather(data.reset_index(drop=True), temp_path)
+    else:
+        data.to_pickle(temp_path)
+
+    os.rename(temp_path, path)
+
+
+def _write_json(obj, path):
+    temp_path = '%s.tmp' % path
+
+    with open(temp_path, 'w') as outfile:
+        json.dump(obj, outfile, default=str)
+
+    os.rename(temp_path, path)
+
+
+def evict(cache_dir=None, max_bytes=None):
+    """
+    Removes the least recently used results from the cache until it is no
+    larger than max_bytes
+
+    Args:
+        cache_dir (string): Directory for the cache files, CACHE_DIR default
+        max_bytes (int): Size limit of the cache, CACHE_MAX_BYTES default
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    total = 0
+
+    for name in os.listdir(cache_dir):
+        key, extension = os.path.splitext(name)
+        if extension in ('.json', '.tmp'):
+            continue
+
+        path = os.path.join(cache_dir, name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, path, key))
+        total += stat.st_size
+
+    for accessed, path, key in sorted(entries):
+        if total <= max_bytes:
+            break
+
+        total -= os.path.getsize(path)
+        os.remove(path)
+
+        meta_path = os.path.join(cache_dir, '%s.json' % key)
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+
+
+def clear(cache_dir=None):
+    """
+    Removes every result from the cache
+
+    Args:
+        cache_dir (string): Directory for the cache files, CACHE_DIR default
+    """
+    evict(cache_dir, max_bytes=0)
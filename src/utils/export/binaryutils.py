@@ -0,0 +1,127 @@
+"""
+Binary columnar output for the trips of the deck.gl paths visualization in
+viz/paths. The trips are written as flat little-endian typed arrays into a
+single binary file, with a small JSON header giving the byte offset and
+length of each array, so the browser can hand the arrays to WebGL without
+parsing them.
+
+    positions     Float32  lon, lat of every vertex of every path
+    timestamps    Float32  time of every vertex, in minutes
+    startIndices  Uint32   index of the first vertex of every path, followed
+                           by the total number of vertices
+    colors        Uint32   color index of every path
+"""
+
+import json
+import tempfile
+
+import numpy as np
+
+# Size in bytes up to which the timestamps are buffered in memory before the
+# buffer spills to a temporary file
+SPOOL_SIZE = 64 * 1024 * 1024
+
+
+def write_trips_binary(trips, path, header_path=None):
+    """
+    Writes trips as binary typed arrays, one trip at a time. Only the
+    timestamps and the per path arrays are buffered until the end.
+
+    Args:
+        trips (iterable): the trips as made by paths_deck_gl.get_trips, dicts
+            with a color index and segments of [lon, lat, time]
+        path (string): file path for the binary output
+        header_path (string): file path for the JSON header, path + '.json'
+            by default
+
+    Returns:
+        dict: the header describing the arrays in the binary file
+    """
+    header_path = header_path or '%s.json' % path
+
+    start_indices = [0]
+    colors = []
+
+    with open(path, 'wb') as outfile, \
+            tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as timestamps:
+        for trip in trips:
+            segments = np.asarray(trip['segments'], dtype=np.float64)
+            segments = segments.reshape(-1, 3)
+
+            outfile.write(segments[:, :2].astype('<f4').tobytes())
+            timestamps.write(segments[:, 2].astype('<f4').tobytes())
+
+            start_indices.append(start_indices[-1] + len(segments))
+            colors.append(trip['color'])
+
+        vertex_count = start_indices[-1]
+
+        timestamps.seek(0)
+        while True:
+            data = timestamps.read(1024 * 1024)
+            if not data:
+                break
+            outfile.write(data)
+
+        outfile.write(np.asarray(start_indices, dtype='<u4').tobytes())
+        outfile.write(np.asarray(colors, dtype='<u4').tobytes())
+
+    path_count = len(colors)
+    arrays = [
+        ('positions', 'Float32Array', 2, vertex_count),
+        ('timestamps', 'Float32Array', 1, vertex_count),
+        ('startIndices', 'Uint32Array', 1, path_count + 1),
+        ('colors', 'Uint32Array', 1, path_count)
+    ]
+
+    header = {
+        'pathCount': path_count,
+        'vertexCount': vertex_count,
+        'arrays': {}
+    }
+
+    byte_offset = 0
+    for name, array_type, size, count in arrays:
+        header['arrays'][name] = {
+            'type': array_type,
+            'size': size,
+            'byteOffset': byte_offset,
+            'length': count * size
+        }
+        byte_offset += count * size * 4
+
+    with open(header_path, 'w') as outfile:
+        json.dump(header, outfile, separators=(',', ':'))
+
+    return header
+
+
+def read_trips_binary(path, header_path=None):
+    """
+    Reads the arrays written by write_trips_binary
+
+    Args:
+        path (string): file path for the binary file
+        header_path (string): file path for the JSON header, path + '.json'
+            by default
+
+    Returns:
+        dict: the numpy array for each of the arrays in the header
+    """
+    header_path = header_path or '%s.json' % path
+
+    with open(header_path) as infile:
+        header = json.load(infile)
+
+    dtypes = {'Float32Array': '<f4', 'Uint32Array': '<u4'}
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        start = spec['byteOffset']
+        array = data[start:start + spec['length'] * 4].view(
+            dtypes[spec['type']])
+        arrays[name] = array.reshape(-1, spec['size']) if spec['size'] > 1 \
+            else array
+
+    return arrays
@@ -0,0 +1,216 @@
+"""
+Streaming JSON output for the data files of the deck.gl visualizations in
+viz/. Items are serialized and written one at a time with compact separators,
+so writing a file needs no more memory than its largest item, and gzip or
+brotli compressed copies can be written next to it in the same pass.
+
+Brotli needs the brotli package.
+"""
+
+import gzip
+import json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SEPARATORS = (',', ':')
+
+
+class BrotliFile(object):
+    """
+    Minimal writable file that brotli compresses everything written to it
+    """
+
+    def __init__(self, path):
+        if brotli is None:
+            raise ImportError('Writing brotli files needs the brotli package')
+
+        self.file = open(path, 'wb')
+        self.compressor = brotli.Compressor()
+
+    def write(self, data):
+        self.file.write(self.compressor.process(data))
+
+    def close(self):
+        self.file.write(self.compressor.finish())
+        self.file.close()
+
+
+def open_outputs(path, compress=()):
+    """
+    Opens a file for writing along with its compressed siblings
+
+    Args:
+        path (string): file path for the uncompressed output
+        compress (list): the compressed copies to write, 'gzip' for path.gz
+            and 'brotli' for path.br
+
+    Returns:
+        list: the files opened for writing in binary mode
+    """
+    outputs = [open(path, 'wb')]
+
+    for encoding in compress:
+        if encoding == 'gzip':
+            outputs.append(gzip.open('%s.gz' % path, 'wb'))
+        elif encoding == 'brotli':
+            outputs.append(BrotliFile('%s.br' % path))
+        else:
+            raise ValueError('Unknown compression %s' % encoding)
+
+    return outputs
+
+
+def round_floats(obj, precision):
+    """
+    Rounds all of the floats in a JSON serializable object
+
+    Args:
+        obj: the object made of dicts, lists, tuples and scalars to round
+        precision (int): number of decimals to keep
+
+    Returns:
+        the object with all of its floats rounded
+    """
+    if isinstance(obj, float):
+        return round(obj, precision)
+
+    if isinstance(obj, dict):
+        return dict((key, round_floats(value, precision))
+                    for key, value in obj.items())
+
+    if isinstance(obj, (list, tuple)):
+        return [round_floats(value, precision) for value in obj]
+
+    return obj
+
+
+def dumps(obj, precision=None):
+    """
+    Serializes an object to compact JSON
+
+    Args:
+        obj: the JSON serializable object
+        precision (int): optional number of decimals to round floats to
+
+    Returns:
+        bytes: the UTF-8 encoded JSON
+    """
+    if precision is not None:
+        obj = round_floats(obj, precision)
+
+    data = json.dumps(obj, separators=SEPARATORS)
+
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+
+    return data
+
+
+def write_json(obj, path, precision=None, compress=()):
+    """
+    Writes an object as compact JSON
+
+    Args:
+        obj: the JSON serializable object
+        path (string): file path for the JSON output
+        precision (int): optional number of decimals to round floats to
+        compress (list): compressed copies to write next to the output, any
+            of 'gzip' and 'brotli'
+    """
+    data = dumps(obj, precision)
+    outputs = open_outputs(path, compress)
+
+    try:
+        for output in outputs:
+            output.write(data)
+    finally:
+        for output in outputs:
+            output.close()
+
+
+def write_json_array(items, path, precision=None, compress=()):
+    """
+    Writes a JSON array one item at a time
+
+    Args:
+        items (iterable): the JSON serializable items of the array, e.g. a
+            generator that makes them one at a time
+        path (string): file path for the JSON output
+        precision (int): optional number of decimals to round floats to
+        compress (list): compressed copies to write next to the output, any
+            of 'gzip' and 'brotli'
+
+    Returns:
+        int: the number of items written
+    """
+    return write_json_stream(path, items, precision=precision,
+                             compress=compress)
+
+
+def write_feature_collection(features, path, precision=None, compress=()):
+    """
+    Writes a GeoJSON FeatureCollection one feature at a time
+
+    Args:
+        features (iterable): the GeoJSON Feature objects, e.g. a generator
+            that makes them one at a time
+        path (string): file path for the GeoJSON output
+        precision (int): optional number of decimals to round floats to
+        compress (list): compressed copies to write next to the output, any
+            of 'gzip' and 'brotli'
+
+    Returns:
+        int: the number of features written
+    """
+    return write_json_stream(path, features,
+                             head=b'{"type":"FeatureCollection","features":',
+                             tail=b'}', precision=precision,
+                             compress=compress)
+
+
+def write_json_stream(path, items, head=b'', tail=b'', precision=None,
+                      compress=()):
+    """
+    Writes head, then the items as a JSON array, then tail to a file and its
+    compressed siblings
+
+    Args:
+        path (string): file path for the JSON output
+        items (iterable): the JSON serializable items of the array
+        head (bytes): JSON to write before the array
+        tail (bytes): JSON to write after the array
+        precision (int): optional number of decimals to round floats to
+        compress (list): compressed copies to write next to the output, any
+            of 'gzip' and 'brotli'
+
+    Returns:
+        int: the number of items written
+    """
+    outputs = open_outputs(path, compress)
+    count = 0
+
+    def write(data):
+        for output in outputs:
+            output.write(data)
+
+    try:
+        write(head)
+        write(b'[')
+
+        for item in items:
+            if count > 0:
+                write(b',')
+
+            write(dumps(item, precision))
+            count += 1
+
+        write(b']')
+        write(tail)
+    finally:
+        for output in outputs:
+            output.close()
+
+    return count
@@ -1,8 +1,53 @@
 import pandas as pd
 import geopandas as gpd
 import shapely as sp
+import shapely.geometry
 import numpy as np
 from scipy.spatial import Voronoi
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+# Shapely 2 has vectorized functions over arrays of geometries. With older
+# versions the same operations fall back to prepared geometries in a loop.
+SHAPELY_2 = hasattr(sp, 'points')
+
+
+def points_from_xy(x, y):
+    """
+    Makes point geometries from arrays of coordinates, in one vectorized
+    call where geopandas supports it
+
+    Args:
+        x (array): the x coordinates, e.g. longitudes
+        y (array): the y coordinates, e.g. latitudes
+
+    Returns:
+        list: the point geometries, as a geometry array on newer geopandas
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    if hasattr(gpd, 'points_from_xy'):
+        return gpd.points_from_xy(x, y)
+
+    return [sp.geometry.Point(xy) for xy in zip(x, y)]
+
+
+def get_coordinates(points):
+    """
+    Gets the coordinates of point geometries as an array
+
+    Args:
+        points (Geopandas.GeoSeries): The point geometries
+
+    Returns:
+        numpy.ndarray: the x and y coordinates of each point
+    """
+    if SHAPELY_2:
+        return sp.get_coordinates(np.asarray(points.values, dtype=object))
+
+    return np.array([[point.x, point.y] for point in points],
+                    dtype=float).reshape(-1, 2)
 
 
 def convert_point_csv_to_data_frame(path, lat_key='lat', lon_key='lon',
@@ -31,8 +76,7 @@ def convert_point_csv_to_data_frame(path, lat_key='lat', lon_key='lon',
     csv_points = pd.read_csv(path, encoding=encoding, sep=separator,
                              index_col=index_col, decimal=decimal)
 
-    zipped_data = zip(csv_points[lon_key], csv_points[lat_key])
-    geo_points = [sp.geometry.Point(xy) for xy in zipped_data]
+    geo_points = points_from_xy(csv_points[lon_key], csv_points[lat_key])
     crs = {'init': 'epsg:' + str(epsg)}
 
     return gpd.GeoDataFrame(csv_points, crs=crs, geometry=geo_points)\
@@ -56,8 +100,7 @@ def convert_point_data_to_data_frame(data, lat_key='lat', lon_key='lon',
         format of a GeoPandas GeoDataFrame
     """
 
-    zipped_data = zip(data[lon_key], data[lat_key])
-    geo_points = [sp.geometry.Point(xy) for xy in zipped_data]
+    geo_points = points_from_xy(data[lon_key], data[lat_key])
     crs = {'init': 'epsg:' + str(epsg)}
 
     return gpd.GeoDataFrame(data, crs=crs, geometry=geo_points)\
@@ -78,34 +121,262 @@ def get_points_inside_shape(points, shape):
             the shape
     """
 
-    return points[points.within(shape.unary_union)]
+    return points[within_shape(points.geometry, shape.unary_union)]
 
 
-def create_voronoi(points, epsg=4326):
+def within_shape(geometries, shape):
     """
-    Make a voronoi diagram geometry out of point definitions
+    Checks which geometries are within a shape, testing them against the
+    prepared shape
 
     Args:
-        points (Geopandas.GeoDataFrame): The centroid points for the voronoi
+        geometries (Geopandas.GeoSeries): The geometries to check, e.g.
+            points or polygons
+        shape (shapely.geometry.base.BaseGeometry): The containing shape
+
+    Returns:
+        numpy.ndarray: whether each geometry is within the shape
+    """
+    if SHAPELY_2:
+        values = np.asarray(geometries.values, dtype=object)
+        types = sp.get_type_id(values)
+
+        sp.prepare(shape)
+
+        # Points are tested on their coordinates without making geometries
+        if len(values) and (types == 0).all():
+            coordinates = get_coordinates(geometries)
+            return sp.contains_xy(shape, coordinates[:, 0], coordinates[:, 1])
+
+        return sp.within(values, shape)
+
+    prepared = prep(shape)
+
+    return np.array([prepared.contains(geometry) for geometry in geometries],
+                    dtype=bool)
+
+
+def assign_points_to_cells(x, y, cells, nearest=False):
+    """
+    Finds the polygon cell, e.g. the Voronoi cell of a tower, that each of a
+    set of points is in. The cells are indexed in an STRtree, so each point
+    is only tested against the few cells whose bounds contain it. With
+    Shapely 1 each cell is instead tested against the arrays of points
+    within its bounds, and the nearest cells are found one point at a time.
+
+    Args:
+        x (array): the x coordinates of the points, e.g. longitudes
+        y (array): the y coordinates of the points, e.g. latitudes
+        cells (Geopandas.GeoSeries): The polygon cells
+        nearest (bool): whether to assign points that are in no cell to the
+            nearest cell, instead of leaving them unassigned
+
+    Returns:
+        numpy.ndarray: the position in cells of the cell of each point, -1
+            for points that are in no cell. A point on the border of two
+            cells is assigned to the first of them.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    geometries = list(cells)
+    assigned = np.full(len(x), -1, dtype=np.int64)
+
+    if not geometries or not len(x):
+        return assigned
+
+    if SHAPELY_2:
+        tree = STRtree(geometries)
+        points = sp.points(x, y)
+
+        point_index, cell_index = tree.query(points, predicate='intersects')
+
+        # Keep the first cell of points on the border of several cells
+        order = np.lexsort((cell_index, point_index))
+        point_index, first = np.unique(point_index[order], return_index=True)
+        assigned[point_index] = cell_index[order][first]
+
+        if nearest:
+            unassigned = np.flatnonzero(assigned < 0)
+            point_index, cell_index = tree.query_nearest(
+                points[unassigned], all_matches=False)
+            assigned[unassigned[point_index]] = cell_index
+
+        return assigned
+
+    # Shapely 1 has no vectorized predicates on arrays of geometries, but
+    # shapely.vectorized tests one geometry against arrays of coordinates.
+    # Each cell is tested against the unassigned points within its bounds,
+    # in order, so points on a border go to the first cell as above.
+    from shapely import vectorized
+
+    for position, geometry in enumerate(geometries):
+        if geometry.is_empty:
+            continue
+
+        min_x, min_y, max_x, max_y = geometry.bounds
+        candidates = np.flatnonzero((assigned < 0) &
+                                    (x >= min_x) & (x <= max_x) &
+                                    (y >= min_y) & (y <= max_y))
+        if not len(candidates):
+            continue
+
+        cell_x = x[candidates]
+        cell_y = y[candidates]
+        inside = vectorized.contains(geometry, cell_x, cell_y) | \
+            vectorized.touches(geometry, cell_x, cell_y)
+        assigned[candidates[inside]] = position
+
+    if nearest:
+        for index in np.flatnonzero(assigned < 0):
+            point = sp.geometry.Point(x[index], y[index])
+            distances = [geometry.distance(point)
+                         if not geometry.is_empty else np.inf
+                         for geometry in geometries]
+            assigned[index] = int(np.argmin(distances))
+
+    return assigned
+
+
+def get_polygon_parts(geometries):
+    """
+    Splits geometries into their polygons, e.g. the cells clipped to a
+    concave shape, which can fall apart into several polygons or, where the
+    clipping leaves lines or points, into a geometry collection
+
+    Args:
+        geometries (iterable): The geometries to split
+
+    Returns:
+        tuple (list, numpy.ndarray): the non-empty polygons, and the position
+            in geometries of the geometry each of them is part of
+    """
+    polygons = []
+    positions = []
+
+    for position, geometry in enumerate(geometries):
+        parts = [geometry]
+
+        while parts:
+            part = parts.pop(0)
+
+            if part is None or part.is_empty:
+                continue
+
+            if part.geom_type == 'Polygon':
+                polygons.append(part)
+                positions.append(position)
+            elif hasattr(part, 'geoms'):
+                parts.extend(part.geoms)
+
+    return polygons, np.array(positions, dtype=np.int64)
+
+
+def get_voronoi_regions(coordinates):
+    """
+    Gets the Voronoi region of every point as a bounded polygon. The points
+    are mirrored across each side of a box around them, which makes the
+    sides of the box the outer edges of the outer regions, so that no region
+    is unbounded.
+
+    Args:
+        coordinates (numpy.ndarray): The x and y coordinates of the points,
+            which must be distinct
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray): the coordinates of the vertices
+            of the regions, in counterclockwise order around each region,
+            and the index of the point whose region each vertex belongs to
+    """
+    count = len(coordinates)
+    low = coordinates.min(axis=0)
+    high = coordinates.max(axis=0)
+    margin = max((high - low).max(), 1e-6)
+    low = low - margin
+    high = high + margin
+
+    mirrors = []
+    for axis, side in [(0, low), (0, high), (1, low), (1, high)]:
+        mirror = coordinates.copy()
+        mirror[:, axis] = 2 * side[axis] - coordinates[:, axis]
+        mirrors.append(mirror)
+
+    vor = Voronoi(np.vstack([coordinates] + mirrors))
+
+    regions = [vor.regions[region] for region in vor.point_region[:count]]
+    lengths = np.array([len(region) for region in regions])
+    vertices = vor.vertices[np.concatenate(regions).astype(np.int64)]
+    point_index = np.repeat(np.arange(count), lengths)
+
+    # Regions are convex, so sorting their vertices by the angle around
+    # their mean gives the order of their outline
+    centers = np.zeros((count, 2))
+    np.add.at(centers, point_index, vertices)
+    centers /= lengths[:, np.newaxis]
+
+    offsets = vertices - centers[point_index]
+    angles = np.arctan2(offsets[:, 1], offsets[:, 0])
+    order = np.lexsort((angles, point_index))
+
+    return vertices[order], point_index[order]
+
+
+def make_polygons(vertices, point_index, count):
+    """
+    Makes polygons out of the vertices of the Voronoi regions
+
+    Args:
+        vertices (numpy.ndarray): The coordinates of the vertices in order
+        point_index (numpy.ndarray): The polygon of each vertex, ascending
+        count (int): The number of polygons
+
+    Returns:
+        numpy.ndarray: the polygons, as an object array
+    """
+    if SHAPELY_2:
+        return sp.polygons(sp.linearrings(vertices, indices=point_index))
+
+    starts = np.searchsorted(point_index, np.arange(count + 1))
+    polygons = np.empty(count, dtype=object)
+    for index in range(count):
+        polygons[index] = sp.geometry.Polygon(
+            vertices[starts[index]:starts[index + 1]])
+
+    return polygons
+
+
+def create_voronoi(points, epsg=4326, shape=None):
+    """
+    Make a voronoi diagram geometry out of point definitions. Every point gets
+    its cell, including the outer ones, which are bounded by a box around the
+    points or by the shape.
+
+    Args:
+        points (Geopandas.GeoDataFrame): The centroid points for the voronoi,
+            at distinct locations
         epsg (int): spatial reference system code for geospatial data
+        shape (Geopandas.GeoDataFrame): Optional shape to clip the cells to
 
     Returns:
-        Geopandas.GeoDataFrame: The polygon geometry for the voronoi diagram
+        Geopandas.GeoDataFrame: The polygon geometry for the voronoi diagram,
+            with the cell of each point at the index of the point. Cells of
+            points outside the shape can be empty, and cells clipped to a
+            concave shape can be MultiPolygons, see get_polygon_parts.
     """
+    coordinates = get_coordinates(points.geometry)
+    vertices, point_index = get_voronoi_regions(coordinates)
+    cells = make_polygons(vertices, point_index, len(coordinates))
 
-    np_points = [np.array([pt.x, pt.y]) for pt in np.array(points.geometry)]
-    vor = Voronoi(np_points)
+    if shape is not None:
+        boundary = shape.unary_union
 
-    lines = [
-        sp.geometry.LineString(vor.vertices[line])
-        for line in vor.ridge_vertices
-        if -1 not in line
-    ]
+        if SHAPELY_2:
+            cells = sp.intersection(cells, boundary)
+        else:
+            cells = [cell.intersection(boundary) for cell in cells]
 
-    voronoi_poly = sp.ops.polygonize(lines)
     crs = {'init': 'epsg:' + str(epsg)}
-    return gpd.GeoDataFrame(crs=crs, geometry=list(voronoi_poly))\
-        .to_crs(epsg=epsg)
+    return gpd.GeoDataFrame(crs=crs, geometry=list(cells),
+                            index=points.index).to_crs(epsg=epsg)
 
 
 def make_voronoi_in_shp(points, shape, epsg=4326):
@@ -121,15 +392,15 @@ def make_voronoi_in_shp(points, shape, epsg=4326):
 
     Returns:
         Geopandas.GeoDataFrame: The polygon geometry for the voronoi diagram
-            embedded inside the shape
+            clipped to the shape, with the columns of the points. Points
+            whose cell is entirely outside the shape are left out.
     """
-    voronoi_geo = create_voronoi(points, epsg=epsg)
-    voronoi_geo_in_shape = get_points_inside_shape(voronoi_geo, shape)
+    voronoi_geo = create_voronoi(points, epsg=epsg, shape=shape)
 
-    shape_with_voronoi = gpd.sjoin(points, voronoi_geo_in_shape, how="inner",
-                                   op='within')
+    point_data = pd.DataFrame(points)
+    del point_data['geometry']
 
-    del shape_with_voronoi['geometry']
+    voronoi_geo = gpd.GeoDataFrame(point_data, crs=voronoi_geo.crs,
+                                   geometry=voronoi_geo.geometry)
 
-    return voronoi_geo_in_shape.merge(shape_with_voronoi, left_index=True,
-                                      right_on='index_right')
+    return voronoi_geo[~voronoi_geo.geometry.is_empty]
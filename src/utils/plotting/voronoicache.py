@@ -0,0 +1,107 @@
+"""
+Local cache of Voronoi tessellations. A tessellation is stored as a
+GeoPackage in CACHE_DIR, keyed by a hash of its points and of the boundary
+it is clipped to, with the area of each cell precomputed. Every pipeline
+that tessellates the same towers in the same boundary reads back the same
+cells instead of rebuilding them. Only the cells are cached, by the position
+of their point, and the columns of the points of each caller are attached
+to them when they are read back.
+"""
+
+import hashlib
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from . import gpdutils
+from ..database import dbcache
+
+CACHE_DIR = os.path.join(dbcache.CACHE_DIR, 'voronoi')
+
+# Changes whenever gpdutils.make_voronoi_in_shp makes different cells, so
+# that tessellations cached by an earlier version are not read back
+CACHE_VERSION = 3
+
+
+def get_tessellation_key(points, shape, epsg=4326):
+    """
+    Hashes the points and boundary of a tessellation into a cache key. Only
+    the coordinates of the points are hashed, since only the cells are
+    cached.
+
+    Args:
+        points (Geopandas.GeoDataFrame): The centroid points for the voronoi
+        shape (Geopandas.GeoDataFrame): The shape containing the voronoi
+        epsg (int): spatial reference system code for geospatial data
+
+    Returns:
+        string: the hex digest identifying the tessellation
+    """
+    coordinates = np.array([[point.x, point.y] for point in points.geometry],
+                           dtype='<f8')
+
+    digest = hashlib.sha1()
+    digest.update(coordinates.tobytes())
+    digest.update(shape.unary_union.wkb)
+    digest.update(('%s:%s' % (epsg, CACHE_VERSION)).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def make_voronoi_in_shp(points, shape, epsg=4326, cache_dir=None):
+    """
+    Gets the voronoi diagram of points embedded in a shape from the cache,
+    making and caching it when it isn't cached yet
+
+    Args:
+        points (Geopandas.GeoDataFrame): The centroid points for the voronoi
+        shape (Geopandas.GeoDataFrame): The shapefile to contain the voronoi
+            inside
+        epsg (int): spatial reference system code for geospatial data
+        cache_dir (string): Directory for the cache files, CACHE_DIR default
+
+    Returns:
+        Geopandas.GeoDataFrame: The polygon geometry for the voronoi diagram
+            embedded inside the shape as made by gpdutils.make_voronoi_in_shp,
+            with the area of each cell
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    key = get_tessellation_key(points, shape, epsg)
+    path = os.path.join(cache_dir, '%s.gpkg' % key)
+
+    if os.path.isfile(path):
+        return _attach_points(gpd.read_file(path), points)
+
+    cells = gpdutils.create_voronoi(points, epsg=epsg, shape=shape)
+    cells['position'] = np.arange(len(points))
+    cells = cells[~cells.geometry.is_empty].reset_index(drop=True)
+    cells['area'] = cells.geometry.area
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Written to a temporary file first, so that a reader never sees a
+    # partially written tessellation
+    temp_path = os.path.join(cache_dir, '%s.tmp.gpkg' % key)
+    cells.to_file(temp_path, driver='GPKG')
+    os.rename(temp_path, path)
+
+    return _attach_points(cells, points)
+
+
+def _attach_points(cells, points):
+    """
+    Gives the cached cells the columns of the points they are the cells of,
+    the way gpdutils.make_voronoi_in_shp does
+    """
+    point_data = pd.DataFrame(points).iloc[cells['position'].values]
+    del point_data['geometry']
+
+    voronoi_geo = gpd.GeoDataFrame(point_data.reset_index(drop=True),
+                                   crs=cells.crs,
+                                   geometry=cells.geometry.values)
+    voronoi_geo['area'] = cells['area'].values
+
+    return voronoi_geo
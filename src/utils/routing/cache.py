@@ -0,0 +1,233 @@
+"""
+SQLite store for the routes fetched from a router. Every route is committed
+as soon as it is stored, so an interrupted fetch keeps the routes it already
+got and a rerun only fetches the missing ones. The routes of different
+routers and profiles are kept apart in the same file, so that e.g. walking
+routes are never read back for driving.
+"""
+
+import json
+import sqlite3
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# The router of the routes stored before they were kept apart by router,
+# and of the routes pickled by earlier versions of paths_deck_gl: the public
+# OSRM server, which only has the driving profile
+DEFAULT_ROUTER = 'osrm/driving'
+
+
+class RouteCache(object):
+    """
+    Routes between pairs of locations of one router, keyed by the location
+    pair. A route has a geometry, a duration or both.
+
+        with cache.RouteCache('routes.sqlite', router.name) as route_cache:
+            routes = route_cache.load()
+
+    Args:
+        path (string): file path for the SQLite database, created if needed
+        router (string): the name of the router and profile of the routes,
+            see routers.Router.name, DEFAULT_ROUTER by default
+    """
+
+    def __init__(self, path, router=None):
+        self.path = path
+        self.router = router or DEFAULT_ROUTER
+        self.connection = sqlite3.connect(path)
+
+        # The write ahead log makes each commit cheap and lets other
+        # processes read the routes while they are fetched
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+        # Caches written before the routes were kept apart by router have a
+        # routes table without a router column, whose routes are moved to
+        # the new table as routes of DEFAULT_ROUTER
+        columns = [row[1] for row in self.connection.execute(
+            'PRAGMA table_info(routes)')]
+        upgrade = columns and 'router' not in columns
+
+        if upgrade:
+            self.connection.execute(
+                'ALTER TABLE routes RENAME TO routes_unnamed')
+
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS routes (
+              router TEXT NOT NULL,
+              key TEXT NOT NULL,
+              geometry TEXT,
+              duration REAL,
+              distance REAL,
+              PRIMARY KEY (router, key)
+            )
+        """)
+
+        if upgrade:
+            self.connection.execute("""
+                INSERT INTO routes
+                SELECT ?, key, geometry, duration, distance
+                FROM routes_unnamed
+            """, (DEFAULT_ROUTER,))
+            self.connection.execute('DROP TABLE routes_unnamed')
+
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT count(*) FROM routes WHERE router = ?',
+            (self.router,)).fetchone()[0]
+
+    def __contains__(self, key):
+        return self.connection.execute(
+            'SELECT 1 FROM routes WHERE router = ? AND key = ?',
+            (self.router, key)).fetchone() is not None
+
+    def close(self):
+        self.connection.close()
+
+    def missing(self, keys, geometry=True):
+        """
+        Finds the keys that have no route stored yet
+
+        Args:
+            keys (iterable): the location pair keys
+            geometry (bool): whether a route without a geometry counts as
+                missing, e.g. one stored by a duration table query
+
+        Returns:
+            list: the keys without a route, in the order given
+        """
+        if geometry:
+            query = """
+                SELECT key FROM routes
+                WHERE router = ? AND geometry IS NOT NULL
+            """
+        else:
+            query = """
+                SELECT key FROM routes
+                WHERE router = ? AND duration IS NOT NULL
+            """
+
+        stored = set(row[0] for row in self.connection.execute(
+            query, (self.router,)))
+
+        return [key for key in keys if key not in stored]
+
+    def put(self, key, route):
+        """
+        Stores a route and commits it
+
+        Args:
+            key (string): the location pair key
+            route (dict): the route, with any of 'geometry' as a list of
+                (lat, lon) tuples, 'duration' and 'distance'
+        """
+        self.put_many([(key, route)])
+
+    def put_many(self, routes):
+        """
+        Stores routes and commits them together. Values that a route leaves
+        out keep what was stored for its key before.
+
+        Args:
+            routes (iterable): (key, route) pairs, with routes as for put
+        """
+        rows = []
+        for key, route in routes:
+            geometry = route.get('geometry')
+            if geometry is not None:
+                geometry = json.dumps(geometry, separators=(',', ':'))
+
+            rows.append((key, geometry, route.get('duration'),
+                         route.get('distance')))
+
+        self.connection.executemany("""
+            INSERT OR IGNORE INTO routes (router, key) VALUES (?, ?)
+        """, [(self.router, row[0]) for row in rows])
+        self.connection.executemany("""
+            UPDATE routes SET
+              geometry = coalesce(?, geometry),
+              duration = coalesce(?, duration),
+              distance = coalesce(?, distance)
+            WHERE router = ? AND key = ?
+        """, [row[1:] + (self.router, row[0]) for row in rows])
+        self.connection.commit()
+
+    def load(self, keys=None, get_time=False):
+        """
+        Loads stored routes into memory
+
+        Args:
+            keys (iterable): the location pair keys to load, all by default
+            get_time (bool): whether to load the durations and distances
+                instead of the geometries
+
+        Returns:
+            dict: the geometry of each route as a list of [lat, lon] pairs,
+                or its 'duration' and 'distance' when get_time is set. Keys
+                without a route are left out.
+        """
+        if get_time:
+            query = """
+                SELECT key, duration, distance FROM routes
+                WHERE router = ? AND duration IS NOT NULL
+            """
+        else:
+            query = """
+                SELECT key, geometry FROM routes
+                WHERE router = ? AND geometry IS NOT NULL
+            """
+
+        wanted = None if keys is None else set(keys)
+        routes = {}
+
+        for row in self.connection.execute(query, (self.router,)):
+            if wanted is not None and row[0] not in wanted:
+                continue
+
+            if get_time:
+                routes[row[0]] = {'duration': row[1], 'distance': row[2]}
+            else:
+                routes[row[0]] = json.loads(row[1])
+
+        return routes
+
+    def import_pickle(self, path):
+        """
+        Imports the routes from a pickle written by an earlier version of
+        paths_deck_gl.get_routes as routes of the router of the cache, which
+        should be DEFAULT_ROUTER. Routes already stored are kept.
+
+        Args:
+            path (string): file path for the routes pickle
+
+        Returns:
+            int: the number of routes imported
+        """
+        with open(path, 'rb') as infile:
+            legacy = pickle.load(infile)
+
+        routes = []
+        for key, route in legacy.items():
+            if key in self:
+                continue
+
+            if isinstance(route, dict):
+                routes.append((key, route))
+            else:
+                routes.append((key, {'geometry': [list(point)
+                                                  for point in route]}))
+
+        self.put_many(routes)
+
+        return len(routes)
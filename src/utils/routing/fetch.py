@@ -0,0 +1,202 @@
+"""
+Fetches the routes between many pairs of locations with a pool of threads,
+so that the queries to an HTTP router overlap, and stores each route in a
+RouteCache as soon as it arrives.
+"""
+
+import logging as log
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from . import routers
+
+FETCH_WORKERS = 8
+
+
+def _fetch_route(task):
+    """
+    Fetches one route in a worker thread. Errors are returned rather than
+    raised, so that one failed query doesn't stop the others.
+    """
+    router, key, location = task
+    start, end = routers.parse_coordinates(location)
+
+    try:
+        return key, router.route(start, end), None
+    except Exception as error:
+        return key, None, error
+
+
+def _fetch_table(task):
+    """
+    Fetches the durations of a batch of location pairs in a worker thread
+    with one table query
+    """
+    router, pairs = task
+
+    sources = {}
+    destinations = {}
+    for key, (start, end) in pairs:
+        if start not in sources:
+            sources[start] = len(sources)
+        if end not in destinations:
+            destinations[end] = len(destinations)
+
+    points = sorted(sources, key=sources.get) + \
+        sorted(destinations, key=destinations.get)
+
+    try:
+        durations, distances = router.table(
+            points, sources=range(len(sources)),
+            destinations=range(len(sources), len(points)))
+    except Exception as error:
+        return [], error
+
+    routes = []
+    for key, (start, end) in pairs:
+        row = sources[start]
+        column = destinations[end]
+
+        if np.isfinite(durations[row, column]):
+            routes.append((key, {
+                'duration': float(durations[row, column]),
+                'distance': float(distances[row, column])
+            }))
+
+    return routes, None
+
+
+def get_table_batches(location_pairs, max_table_size=None):
+    """
+    Groups location pairs into batches that each fit in one table query of
+    their start points to their end points
+
+    Args:
+        location_pairs (dict): the 'lon,lat;lon,lat' location of each key
+        max_table_size (int): the most points a table query can have, no
+            limit by default
+
+    Returns:
+        list: the batches, as lists of (key, (start, end)) pairs
+    """
+    pairs = []
+    for key, location in location_pairs.items():
+        start, end = routers.parse_coordinates(location)
+        pairs.append((key, (start, end)))
+
+    # Pairs sharing a start point are kept together, so that a batch has
+    # few sources and the same destinations get reused
+    pairs.sort(key=lambda pair: pair[1])
+
+    if max_table_size is None:
+        return [pairs] if pairs else []
+
+    batches = []
+    batch = []
+    starts = set()
+    ends = set()
+
+    for key, (start, end) in pairs:
+        size = len(starts | set([start])) + len(ends | set([end]))
+
+        if batch and size > max_table_size:
+            batches.append(batch)
+            batch = []
+            starts = set()
+            ends = set()
+
+        batch.append((key, (start, end)))
+        starts.add(start)
+        ends.add(end)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def _run(function, tasks, workers):
+    """
+    Maps a function over tasks in a pool of threads, yielding the results
+    as they finish
+    """
+    if not tasks:
+        return
+
+    pool = ThreadPool(min(workers, len(tasks)))
+    try:
+        for result in pool.imap_unordered(function, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fetch_routes(router, location_pairs, route_cache,
+                 workers=FETCH_WORKERS):
+    """
+    Fetches the routes between the location pairs that aren't cached yet.
+    Routes are stored as they arrive, so an interrupted fetch can be resumed.
+
+    Args:
+        router (routers.Router): the router to query
+        location_pairs (dict): the 'lon,lat;lon,lat' location of each key
+        route_cache (cache.RouteCache): the cache to store the routes in
+        workers (int): the number of queries to make at the same time
+
+    Returns:
+        int: the number of location pairs that failed, or have no route
+    """
+    keys = route_cache.missing(location_pairs)
+    tasks = [(router, key, location_pairs[key]) for key in keys]
+    failed = 0
+
+    for key, route, error in _run(_fetch_route, tasks, workers):
+        if route is None:
+            if error is not None:
+                log.warning('Fetching route %s failed: %s' % (key, error))
+            failed += 1
+            continue
+
+        route_cache.put(key, route)
+
+    log.info('Fetched %d routes, %d failed' % (len(keys) - failed, failed))
+
+    return failed
+
+
+def fetch_durations(router, location_pairs, route_cache,
+                    workers=FETCH_WORKERS):
+    """
+    Fetches the durations and distances of the routes between the location
+    pairs that aren't cached yet, with as few table queries as the router
+    allows. The durations of each query are stored as it finishes.
+
+    Args:
+        router (routers.Router): the router to query
+        location_pairs (dict): the 'lon,lat;lon,lat' location of each key
+        route_cache (cache.RouteCache): the cache to store the routes in
+        workers (int): the number of queries to make at the same time
+
+    Returns:
+        int: the number of location pairs that failed, or have no route
+    """
+    keys = route_cache.missing(location_pairs, geometry=False)
+    batches = get_table_batches(dict((key, location_pairs[key])
+                                     for key in keys),
+                                router.max_table_size)
+    tasks = [(router, batch) for batch in batches]
+    fetched = 0
+
+    for routes, error in _run(_fetch_table, tasks, workers):
+        if error is not None:
+            log.warning('Fetching a table of durations failed: %s' % error)
+
+        route_cache.put_many(routes)
+        fetched += len(routes)
+
+    log.info('Fetched %d durations in %d table queries, %d failed' %
+             (fetched, len(tasks), len(keys) - fetched))
+
+    return len(keys) - fetched
@@ -0,0 +1,230 @@
+"""
+Loads the street network in an OpenStreetMap XML extract (.osm, e.g. from the
+Overpass API or converted from .pbf with osmium) into a compact directed
+graph for routing.
+"""
+
+import numpy as np
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+EARTH_RADIUS = 6371008.8
+
+WALKING_SPEED = 5
+
+# Travel speeds in km/h by highway type for each routing profile. Ways with
+# another highway type can't be used with the profile.
+PROFILES = {
+    'foot': {
+        'speeds': dict((highway, WALKING_SPEED) for highway in [
+            'primary', 'primary_link', 'secondary', 'secondary_link',
+            'tertiary', 'tertiary_link', 'unclassified', 'residential',
+            'living_street', 'service', 'pedestrian', 'footway', 'path',
+            'steps', 'track', 'cycleway', 'bridleway', 'corridor']),
+        'oneway': False,
+        'access_tags': ['access', 'foot']
+    },
+    'driving': {
+        'speeds': {
+            'motorway': 110, 'motorway_link': 60,
+            'trunk': 90, 'trunk_link': 50,
+            'primary': 60, 'primary_link': 40,
+            'secondary': 50, 'secondary_link': 35,
+            'tertiary': 40, 'tertiary_link': 30,
+            'unclassified': 30, 'residential': 25,
+            'living_street': 10, 'service': 15
+        },
+        'oneway': True,
+        'access_tags': ['access', 'vehicle', 'motor_vehicle', 'motorcar']
+    }
+}
+
+NO_ACCESS = set(['no', 'private'])
+
+
+class StreetGraph(object):
+    """
+    Directed street graph in compressed sparse row (CSR) form: the edges out
+    of node i are indices[indptr[i]:indptr[i + 1]], with their travel time in
+    seconds in durations and their length in meters in distances.
+    """
+
+    def __init__(self, lat, lon, indptr, indices, durations, distances):
+        self.lat = lat
+        self.lon = lon
+        self.indptr = indptr
+        self.indices = indices
+        self.durations = durations
+        self.distances = distances
+
+    @property
+    def node_count(self):
+        return len(self.lat)
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Gets the great circle distance in meters between arrays of points
+
+    Args:
+        lat1 (numpy.ndarray): latitudes of the first points in degrees
+        lon1 (numpy.ndarray): longitudes of the first points in degrees
+        lat2 (numpy.ndarray): latitudes of the second points in degrees
+        lon2 (numpy.ndarray): longitudes of the second points in degrees
+
+    Returns:
+        numpy.ndarray: the distances in meters
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(x) for x in (lat1, lon1, lat2, lon2)]
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def get_way_direction(tags, profile):
+    """
+    Gets the directions a way can be travelled in with a profile
+
+    Args:
+        tags (dict): the OSM tags of the way
+        profile (dict): the routing profile, one of PROFILES
+
+    Returns:
+        int: 0 for both directions, 1 for only along the way, -1 for only
+            against it
+    """
+    if not profile['oneway']:
+        return 0
+
+    oneway = tags.get('oneway')
+
+    if oneway in ('yes', 'true', '1'):
+        return 1
+    if oneway == '-1':
+        return -1
+    if oneway is None and (tags.get('junction') == 'roundabout' or
+                           tags.get('highway') in ('motorway',
+                                                   'motorway_link')):
+        return 1
+
+    return 0
+
+
+def read_osm_graph(path, profile='foot'):
+    """
+    Reads the ways of an OSM XML extract that can be travelled with a profile
+    into a StreetGraph. Only the nodes on those ways are kept. When there are
+    parallel edges between two nodes the fastest one is kept.
+
+    Args:
+        path (string): file path for the .osm extract
+        profile (string): the routing profile, 'foot' or 'driving'
+
+    Returns:
+        StreetGraph: the directed street graph
+    """
+    profile = PROFILES[profile]
+    speeds = profile['speeds']
+
+    coordinates = {}
+    sources = []
+    targets = []
+    edge_speeds = []
+
+    for event, element in ElementTree.iterparse(path):
+        if element.tag == 'node':
+            coordinates[int(element.get('id'))] = (float(element.get('lat')),
+                                                   float(element.get('lon')))
+        elif element.tag == 'way':
+            tags = dict((tag.get('k'), tag.get('v'))
+                        for tag in element.iter('tag'))
+            speed = speeds.get(tags.get('highway'))
+
+            if speed is not None and not any(
+                    tags.get(tag) in NO_ACCESS
+                    for tag in profile['access_tags']):
+                refs = [int(nd.get('ref')) for nd in element.iter('nd')]
+                direction = get_way_direction(tags, profile)
+
+                if direction >= 0:
+                    sources.extend(refs[:-1])
+                    targets.extend(refs[1:])
+                    edge_speeds.extend([speed] * (len(refs) - 1))
+                if direction <= 0:
+                    sources.extend(refs[1:])
+                    targets.extend(refs[:-1])
+                    edge_speeds.extend([speed] * (len(refs) - 1))
+
+        if element.tag in ('node', 'way', 'relation'):
+            element.clear()
+
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    edge_speeds = np.asarray(edge_speeds, dtype=np.float64)
+
+    # Ways can reference nodes outside of the extract
+    known = np.array([source in coordinates and target in coordinates
+                      for source, target in zip(sources, targets)],
+                     dtype=bool)
+    sources = sources[known]
+    targets = targets[known]
+    edge_speeds = edge_speeds[known]
+
+    osm_ids, inverse = np.unique(np.concatenate([sources, targets]),
+                                 return_inverse=True)
+    sources = inverse[:len(sources)]
+    targets = inverse[len(sources):]
+
+    lat = np.array([coordinates[osm_id][0] for osm_id in osm_ids])
+    lon = np.array([coordinates[osm_id][1] for osm_id in osm_ids])
+
+    return build_graph(lat, lon, sources, targets, edge_speeds)
+
+
+def build_graph(lat, lon, sources, targets, speeds):
+    """
+    Builds a StreetGraph from edge lists
+
+    Args:
+        lat (numpy.ndarray): latitude of every node
+        lon (numpy.ndarray): longitude of every node
+        sources (numpy.ndarray): node index the edges start at
+        targets (numpy.ndarray): node index the edges end at
+        speeds (numpy.ndarray): travel speed along the edges in km/h
+
+    Returns:
+        StreetGraph: the directed street graph
+    """
+    distances = haversine(lat[sources], lon[sources], lat[targets],
+                          lon[targets])
+    # Zero weights would read as missing edges in scipy.sparse.csgraph
+    durations = np.maximum(distances / (speeds / 3.6), 1e-3)
+
+    keep = sources != targets
+    sources, targets = sources[keep], targets[keep]
+    distances, durations = distances[keep], durations[keep]
+
+    # Order by edge and then duration, and keep the fastest parallel edge
+    order = np.lexsort((durations, targets, sources))
+    sources, targets = sources[order], targets[order]
+    distances, durations = distances[order], durations[order]
+
+    first = np.ones(len(sources), dtype=bool)
+    first[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+    sources, targets = sources[first], targets[first]
+    distances, durations = distances[first], durations[first]
+
+    indptr = np.zeros(len(lat) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(lat)), out=indptr[1:])
+
+    return StreetGraph(lat, lon, indptr, targets.astype(np.int32),
+                       durations, distances)
@@ -0,0 +1,424 @@
+"""
+Routers answer route and travel time queries between coordinates. Every
+router has the same interface, so the code making the queries doesn't depend
+on where the routes come from:
+
+    OSRMRouter   queries an OSRM HTTP server, the public demo server by
+                 default
+    LocalRouter  routes in-process on a street graph loaded from an
+                 OpenStreetMap extract, without any network access
+
+Coordinates are (lon, lat) pairs, in the order OSRM uses.
+"""
+
+import heapq
+import threading
+import time
+
+import numpy as np
+import polyline
+import requests
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial import cKDTree
+
+from . import osm
+
+OSRM_URL = 'http://router.project-osrm.org'
+
+# Responses worth retrying: rate limiting and server errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def format_coordinates(points):
+    """
+    Formats coordinates for an OSRM query, e.g. '11.25,43.77;11.26,43.78'
+
+    Args:
+        points (list): the (lon, lat) pairs
+
+    Returns:
+        string: the coordinates in the format of the OSRM API
+    """
+    return ';'.join('{0},{1}'.format(lon, lat) for lon, lat in points)
+
+
+def parse_coordinates(location):
+    """
+    Parses coordinates in the format of the OSRM API
+
+    Args:
+        location (string): the coordinates, e.g. '11.25,43.77;11.26,43.78'
+
+    Returns:
+        list: the (lon, lat) pairs
+    """
+    return [tuple(float(value) for value in point.split(','))
+            for point in location.split(';')]
+
+
+def get_router_name(kind, profile):
+    """
+    Names the routes of a kind of router with a profile, e.g. 'osrm/driving',
+    which keeps them apart from the routes of other routers in a route cache
+
+    Args:
+        kind (string): the kind of router, e.g. OSRMRouter.kind
+        profile (string): the routing profile, e.g. 'foot'
+
+    Returns:
+        string: the name of the routes
+    """
+    return '%s/%s' % (kind, profile)
+
+
+class Router(object):
+    """
+    Interface of the routers
+    """
+
+    # The most points a table query can have, None when there is no limit
+    max_table_size = None
+
+    # The kind of router and its routing profile, which name its routes
+    kind = None
+    profile = None
+
+    @property
+    def name(self):
+        """
+        The name of the routes of the router, see get_router_name
+        """
+        return get_router_name(self.kind, self.profile)
+
+    def route(self, start, end):
+        """
+        Gets the fastest route between two points
+
+        Args:
+            start (tuple): the (lon, lat) to start from
+            end (tuple): the (lon, lat) to go to
+
+        Returns:
+            dict: the 'geometry' of the route as a list of (lat, lon) tuples,
+                like polyline.decode gives, and its 'duration' in seconds and
+                'distance' in meters. None when there is no route.
+        """
+        raise NotImplementedError
+
+    def table(self, points, sources=None, destinations=None):
+        """
+        Gets the travel time and distance of the fastest route between every
+        pair of points
+
+        Args:
+            points (list): the (lon, lat) pairs
+            sources (list): indices of the points to route from, all of them
+                by default
+            destinations (list): indices of the points to route to, all of
+                them by default
+
+        Returns:
+            tuple (numpy.ndarray, numpy.ndarray): the durations in seconds and
+                distances in meters, from the point of the row to the point of
+                the column. NaN where there is no route.
+        """
+        raise NotImplementedError
+
+
+class OSRMRouter(Router):
+    """
+    Router querying an OSRM server over HTTP. Failed requests are retried
+    with exponential backoff. A router can be shared between threads, each
+    thread gets its own HTTP session.
+
+    Args:
+        profile (string): the OSRM profile, e.g. 'driving' or 'foot'. The
+            public demo server only has 'driving'.
+        base_url (string): the URL of the OSRM server
+        timeout (float): number of seconds to wait for a response
+        retries (int): number of times to retry a failed request
+        backoff (float): number of seconds to wait before the first retry,
+            doubled for every retry after it
+        max_table_size (int): the most coordinates the server accepts in a
+            table request, 100 on the public demo server
+    """
+
+    kind = 'osrm'
+
+    def __init__(self, profile='driving', base_url=OSRM_URL, timeout=30,
+                 retries=3, backoff=1.0, max_table_size=100):
+        self.profile = profile
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_table_size = max_table_size
+        self._local = threading.local()
+
+    def _get(self, service, points, params=None):
+        """
+        Queries an OSRM service, retrying on connection errors, rate limiting
+        and server errors
+
+        Returns:
+            dict: the decoded response. Its 'code' is 'Ok' when the query
+                succeeded, and e.g. 'NoRoute' when there is no route.
+        """
+        url = '%s/%s/v1/%s/%s' % (self.base_url, service, self.profile,
+                                  format_coordinates(points))
+
+        # OSRM expects the ; and , separators in its options unescaped
+        if params:
+            url += '?' + '&'.join('%s=%s' % item
+                                  for item in sorted(params.items()))
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+
+        for attempt in range(self.retries + 1):
+            try:
+                response = session.get(url, timeout=self.timeout)
+
+                if response.status_code not in RETRY_STATUS:
+                    return response.json()
+
+                response.raise_for_status()
+            except (requests.RequestException, ValueError):
+                if attempt == self.retries:
+                    raise
+
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def route(self, start, end):
+        data = self._get('route', [start, end])
+
+        if data.get('code') != 'Ok' or not data.get('routes'):
+            return None
+
+        route = data['routes'][0]
+
+        return {
+            'geometry': polyline.decode(route['geometry']),
+            'duration': route['duration'],
+            'distance': route['distance']
+        }
+
+    def table(self, points, sources=None, destinations=None):
+        params = {'annotations': 'duration,distance'}
+        if sources is not None:
+            params['sources'] = ';'.join(str(index) for index in sources)
+        if destinations is not None:
+            params['destinations'] = ';'.join(str(index)
+                                              for index in destinations)
+
+        data = self._get('table', points, params)
+
+        if data.get('code') != 'Ok':
+            raise ValueError('OSRM table query failed: %s' %
+                             data.get('message', data.get('code')))
+
+        # OSRM gives null where there is no route
+        return (np.array(data['durations'], dtype=float),
+                np.array(data['distances'], dtype=float))
+
+
+class LocalRouter(Router):
+    """
+    Router on a street graph held in memory. Points are snapped to the
+    nearest node of the largest strongly connected part of the graph, so
+    that there is a route between any two of them.
+
+    Single routes are found with A* search using landmarks (ALT): the travel
+    times from and to a few landmarks spread over the graph are computed
+    once, and bound the remaining travel time of every node to the target.
+    Tables are computed with one Dijkstra search per point.
+
+    Args:
+        graph (osm.StreetGraph): the street graph
+        landmarks (int): the number of landmarks for the A* bounds
+        profile (string): the routing profile the graph was read with
+    """
+
+    kind = 'local'
+
+    def __init__(self, graph, landmarks=8, profile='foot'):
+        self.graph = graph
+        self.profile = profile
+        self.matrix = csr_matrix(
+            (graph.durations, graph.indices, graph.indptr),
+            shape=(graph.node_count, graph.node_count))
+
+        count, labels = connected_components(self.matrix, directed=True,
+                                             connection='strong')
+        self.nodes = np.flatnonzero(labels == np.bincount(labels).argmax())
+        self.tree = cKDTree(self._project(graph.lon[self.nodes],
+                                          graph.lat[self.nodes]))
+
+        self.landmarks = self._choose_landmarks(landmarks)
+        self.from_landmarks = dijkstra(self.matrix, indices=self.landmarks)
+        self.to_landmarks = dijkstra(self.matrix.T.tocsr(),
+                                     indices=self.landmarks)
+
+        # Plain lists are much faster than arrays to index one at a time
+        self._indptr = graph.indptr.tolist()
+        self._indices = graph.indices.tolist()
+        self._durations = graph.durations.tolist()
+        self._distances = graph.distances.tolist()
+
+    @classmethod
+    def from_osm(cls, path, profile='foot', landmarks=8):
+        """
+        Makes a router for the streets in an OpenStreetMap XML extract
+
+        Args:
+            path (string): file path for the .osm extract
+            profile (string): the routing profile, 'foot' or 'driving'
+            landmarks (int): the number of landmarks for the A* bounds
+
+        Returns:
+            LocalRouter: the router
+        """
+        return cls(osm.read_osm_graph(path, profile), landmarks=landmarks,
+                   profile=profile)
+
+    def _project(self, lon, lat):
+        """
+        Projects coordinates onto a plane in which distances near the graph
+        are about proportional to distances on the ground
+        """
+        scale = np.cos(np.radians(np.mean(self.graph.lat)))
+
+        return np.column_stack([np.asarray(lon) * scale, np.asarray(lat)])
+
+    def _choose_landmarks(self, count):
+        """
+        Chooses landmarks spread around the graph by repeatedly taking the
+        node farthest from the landmarks chosen so far
+        """
+        landmarks = []
+        nearest = dijkstra(self.matrix, indices=self.nodes[0])
+
+        for _ in range(min(count, len(self.nodes))):
+            landmark = self.nodes[np.argmax(nearest[self.nodes])]
+            landmarks.append(landmark)
+            nearest = np.minimum(nearest,
+                                 dijkstra(self.matrix, indices=landmark))
+
+        return np.array(landmarks)
+
+    def nearest(self, points):
+        """
+        Snaps points to the nearest routable nodes
+
+        Args:
+            points (list): the (lon, lat) pairs
+
+        Returns:
+            numpy.ndarray: the node index of each point
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        distances, positions = self.tree.query(
+            self._project(points[:, 0], points[:, 1]))
+
+        return self.nodes[positions]
+
+    def _bounds(self, target):
+        """
+        Gets a lower bound of the travel time from every node to the target
+        """
+        with np.errstate(invalid='ignore'):
+            bounds = np.maximum(
+                self.from_landmarks[:, [target]] - self.from_landmarks,
+                self.to_landmarks - self.to_landmarks[:, [target]]).max(axis=0)
+
+        return np.nan_to_num(np.maximum(bounds, 0)).tolist()
+
+    def route(self, start, end):
+        source, target = self.nearest([start, end])
+        bounds = self._bounds(target)
+
+        indptr = self._indptr
+        indices = self._indices
+        durations = self._durations
+
+        times = {source: 0.0}
+        previous = {source: None}
+        queue = [(bounds[source], source)]
+        done = set()
+
+        while queue:
+            estimate, node = heapq.heappop(queue)
+
+            if node == target:
+                break
+            if node in done:
+                continue
+            done.add(node)
+
+            time = times[node]
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[edge]
+                neighbor_time = time + durations[edge]
+
+                if neighbor_time < times.get(neighbor, float('inf')):
+                    times[neighbor] = neighbor_time
+                    previous[neighbor] = (node, edge)
+                    heapq.heappush(queue, (neighbor_time + bounds[neighbor],
+                                           neighbor))
+
+        if target not in times:
+            return None
+
+        path = [target]
+        distance = 0.0
+        while previous[path[-1]] is not None:
+            node, edge = previous[path[-1]]
+            distance += self._distances[edge]
+            path.append(node)
+        path.reverse()
+
+        return {
+            'geometry': list(zip(self.graph.lat[path].tolist(),
+                                 self.graph.lon[path].tolist())),
+            'duration': times[target],
+            'distance': distance
+        }
+
+    def table(self, points, sources=None, destinations=None):
+        nodes = self.nearest(points)
+        sources = nodes if sources is None else nodes[list(sources)]
+        targets = nodes if destinations is None else nodes[list(destinations)]
+
+        times, predecessors = dijkstra(self.matrix, indices=sources,
+                                       return_predecessors=True)
+
+        durations = times[:, targets]
+        distances = np.full(durations.shape, np.nan)
+
+        # Sum the lengths of the edges along each of the fastest routes
+        for row, source in enumerate(sources):
+            for column, target in enumerate(targets):
+                if not np.isfinite(durations[row, column]):
+                    continue
+
+                distance = 0.0
+                node = target
+                while node != source:
+                    previous = predecessors[row, node]
+                    distance += self._edge_distance(previous, node)
+                    node = previous
+
+                distances[row, column] = distance
+
+        durations[~np.isfinite(durations)] = np.nan
+
+        return durations, distances
+
+    def _edge_distance(self, source, target):
+        for edge in range(self._indptr[source], self._indptr[source + 1]):
+            if self._indices[edge] == target:
+                return self._distances[edge]
+
+        raise ValueError('No edge from %d to %d' % (source, target))
@@ -6,10 +6,35 @@ import DeckGLOverlay from './deckgl-overlay.js';
 
 import {json as requestJson} from 'd3-request';
 import pathGetter from './get-paths.js';
+import loadTripsBinary from './load-trips-binary.js';
 
 // Set your mapbox token here
 const MAPBOX_TOKEN = process.env.MAPBOX_ACCESS_TOKEN; // eslint-disable-line
 
+// Loop length used until the trips are loaded, in minutes
+const DEFAULT_LOOP_LENGTH = 1800;
+
+// The record times are minutes since the start of the exported window, so the
+// loop runs up to the last timestamp of the trips
+function getLoopLength(trips) {
+  let maxTime = 0;
+
+  if (trips.binary) {
+    const {timestamps} = trips;
+    for (let i = 0; i < timestamps.length; i++) {
+      maxTime = Math.max(maxTime, timestamps[i]);
+    }
+  } else {
+    trips.forEach(trip => {
+      trip.segments.forEach(segment => {
+        maxTime = Math.max(maxTime, segment[2]);
+      });
+    });
+  }
+
+  return Math.ceil(maxTime) || DEFAULT_LOOP_LENGTH;
+}
+
 class Root extends Component {
 
   constructor(props) {
@@ -22,6 +47,7 @@ class Root extends Component {
       },
       buildings: null,
       trips: null,
+      loopLength: DEFAULT_LOOP_LENGTH,
       time: 0
     };
 
@@ -31,11 +57,19 @@ class Root extends Component {
       }
     });
 
-    requestJson('./data/trips.json', (error, response) => {
-      if (!error) {
-        this.setState({trips: response});
-      }
-    });
+    // Prefer the binary trips export and fall back to the JSON one
+    loadTripsBinary('./data/trips.bin')
+      .then(trips => this.setState({trips, loopLength: getLoopLength(trips)}))
+      .catch(() => {
+        requestJson('./data/trips.json', (error, response) => {
+          if (!error) {
+            this.setState({
+              trips: response,
+              loopLength: getLoopLength(response)
+            });
+          }
+        });
+      });
 
     pathGetter();
   }
@@ -54,7 +88,7 @@ class Root extends Component {
 
   _animate() {
     const timestamp = Date.now();
-    const loopLength = 1800;
+    const {loopLength} = this.state;
     const loopTime = 60000;
 
     this.setState({
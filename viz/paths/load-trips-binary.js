@@ -0,0 +1,28 @@
+import axios from 'axios';
+
+const ARRAY_TYPES = {
+  Float32Array,
+  Uint32Array
+};
+
+// Loads the trips written by src/utils/export/binaryutils.py. The arrays are
+// views on the downloaded buffer, so nothing has to be parsed.
+export default function loadTripsBinary(url) {
+  return Promise.all([
+    axios.get(`${url}.json`, {responseType: 'json'}),
+    axios.get(url, {responseType: 'arraybuffer'})
+  ]).then(([{data: header}, {data: buffer}]) => {
+    const trips = {
+      binary: true,
+      length: header.pathCount,
+      vertexCount: header.vertexCount
+    };
+
+    Object.keys(header.arrays).forEach(name => {
+      const {type, byteOffset, length} = header.arrays[name];
+      trips[name] = new ARRAY_TYPES[type](buffer, byteOffset, length);
+    });
+
+    return trips;
+  });
+}
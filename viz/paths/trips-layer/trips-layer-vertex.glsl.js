@@ -21,7 +21,8 @@
 export default `\
 #define SHADER_NAME trips-layer-vertex-shader
 
-attribute vec3 positions;
+attribute vec2 positions;
+attribute float timestamps;
 attribute vec3 colors;
 
 uniform float opacity;
@@ -32,13 +33,13 @@ varying float vTime;
 varying vec4 vColor;
 
 void main(void) {
-  vec2 p = preproject(positions.xy);
+  vec2 p = preproject(positions);
   // the magic de-flickering factor
-  vec4 shift = vec4(0., 0., mod(positions.z, trailLength) * 1e-4, 0.);
+  vec4 shift = vec4(0., 0., mod(timestamps, trailLength) * 1e-4, 0.);
 
   gl_Position = project(vec4(p, 1., 1.)) + shift;
 
   vColor = vec4(colors / 255.0, opacity);
-  vTime = 1.0 - (currentTime - positions.z) / trailLength;
+  vTime = 1.0 - (currentTime - timestamps) / trailLength;
 }
 `;
@@ -22,7 +22,8 @@ export default class TripsLayer extends Layer {
 
     attributeManager.add({
       indices: {size: 1, update: this.calculateIndices, isIndexed: true},
-      positions: {size: 3, update: this.calculatePositions},
+      positions: {size: 2, update: this.calculatePositions},
+      timestamps: {size: 1, update: this.calculateTimestamps},
       colors: {size: 3, update: this.calculateColors}
     });
 
@@ -68,13 +69,24 @@ export default class TripsLayer extends Layer {
       return;
     }
 
+    // Binary trips from load-trips-binary.js already have the path offsets
+    if (data.binary) {
+      const {startIndices} = data;
+      const pathLengths = new Array(data.length);
+      for (let i = 0; i < data.length; i++) {
+        pathLengths[i] = startIndices[i + 1] - startIndices[i];
+      }
+      this.setState({pathLengths, vertexCount: data.vertexCount});
+      return;
+    }
+
     const {getPath} = this.props;
     let vertexCount = 0;
-    const pathLengths = data.reduce((acc, d) => {
+    const pathLengths = data.map(d => {
       const l = getPath(d).length;
       vertexCount += l;
-      return [...acc, l];
-    }, []);
+      return l;
+    });
     this.setState({pathLengths, vertexCount});
   }
 
@@ -111,7 +123,13 @@ export default class TripsLayer extends Layer {
   calculatePositions(attribute) {
     const {data, getPath} = this.props;
     const {vertexCount} = this.state;
-    const positions = new Float32Array(vertexCount * 3);
+
+    if (data.binary) {
+      attribute.value = data.positions;
+      return;
+    }
+
+    const positions = new Float32Array(vertexCount * 2);
 
     let index = 0;
     for (let i = 0; i < data.length; i++) {
@@ -120,12 +138,32 @@ export default class TripsLayer extends Layer {
         const pt = path[j];
         positions[index++] = pt[0];
         positions[index++] = pt[1];
-        positions[index++] = pt[2];
       }
     }
     attribute.value = positions;
   }
 
+  calculateTimestamps(attribute) {
+    const {data, getPath} = this.props;
+    const {vertexCount} = this.state;
+
+    if (data.binary) {
+      attribute.value = data.timestamps;
+      return;
+    }
+
+    const timestamps = new Float32Array(vertexCount);
+
+    let index = 0;
+    for (let i = 0; i < data.length; i++) {
+      const path = getPath(data[i]);
+      for (let j = 0; j < path.length; j++) {
+        timestamps[index++] = path[j][2];
+      }
+    }
+    attribute.value = timestamps;
+  }
+
   calculateColors(attribute) {
     const {data, getColor} = this.props;
     const {pathLengths, vertexCount} = this.state;
@@ -133,7 +171,7 @@ export default class TripsLayer extends Layer {
 
     let index = 0;
     for (let i = 0; i < data.length; i++) {
-      const color = getColor(data[i]);
+      const color = getColor(data.binary ? {color: data.colors[i]} : data[i]);
       const l = pathLengths[i];
       for (let j = 0; j < l; j++) {
         colors[index++] = color[0];